@@ -0,0 +1,838 @@
+#define _GNU_SOURCE
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdarg.h>
+#include <stdbool.h>
+#include <string.h>
+#include <ctype.h>
+#include <errno.h>
+#include <time.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <dirent.h>
+#include <ftw.h>
+#include <tar.h>
+#include <sys/file.h>
+#include <sys/stat.h>
+#include "cache.h"
+#include "common.h"
+#include "debug.h"
+#include "error.h"
+#include "extract.h"
+#include "util.h"
+
+/**
+ * Persistent, content-addressed bundle cache
+ *
+ * Each archive is extracted (and its program patched) once into
+ *   <cache root>/<archive digest>/
+ * and reused by every later launch of the same archive.
+ *
+ * Each entry has a lock file <cache root>/<archive digest>.lock:
+ * - Launchers hold a shared lock for as long as they use the entry.
+ * - An exclusive lock is held to populate or evict the entry.
+ * An entry is populated in a temporary directory which is then atomically
+ * renamed into place, so an entry which exists is always complete. Each entry
+ * records the digest of its archive in DIGEST_FILENAME.
+ *
+ * A fixed bundle dir (set at build time) is managed the same way, as the only
+ * entry of a "cache" in its parent directory. The parent may also belong to
+ * root (e.g. /opt/app, populated at install time), or be a sticky directory
+ * shared with other users.
+ *
+ * Shared bundles are entries of a per-user cache in $TMPDIR which only live as
+ * long as they are in use: the shared locks act as a reference count, and the
+ * last launcher to exit (i.e. the first to get the exclusive lock without
+ * waiting) removes the entry. The kernel releases the locks of launchers
+ * which crash, so they can't keep an entry alive, and whoever next finds an
+ * unused entry removes it.
+ */
+
+/* Enable the cache in the default location */
+#define STATICX_CACHE           "STATICX_CACHE"
+/* Enable the cache in the given location */
+#define STATICX_CACHE_DIR       "STATICX_CACHE_DIR"
+/* Evict least-recently used entries when the cache exceeds this size */
+#define STATICX_CACHE_MAX_SIZE  "STATICX_CACHE_MAX_SIZE"
+/* Evict entries not used for this many seconds */
+#define STATICX_CACHE_MAX_AGE   "STATICX_CACHE_MAX_AGE"
+/* Share one bundle dir between concurrent launches of the same archive */
+#define STATICX_SHARED_BUNDLE   "STATICX_SHARED_BUNDLE"
+#define TMPDIR                  "TMPDIR"
+
+#define LOCK_SUFFIX     ".lock"
+
+/* How long to wait for the lock of a fixed bundle dir before giving up */
+#define FIXED_LOCK_TIMEOUT_MS   10000
+#define LOCK_POLL_MS            10
+#define TMP_SUFFIX      ".tmp-"
+
+/* Lock file for the entry in use by this process; held until exit */
+static int m_lock_fd = -1;
+
+/* Root of the shared bundle in use by this process, if any */
+static char *m_shared_root;
+
+static char *
+xstrdup(const char *s)
+{
+    char *result = strdup(s);
+    if (!result)
+        error(2, 0, "Failed to allocate string");
+    return result;
+}
+
+static void __attribute__((format(printf, 2, 3)))
+xasprintf(char **result, const char *fmt, ...)
+{
+    va_list ap;
+    va_start(ap, fmt);
+    int rc = vasprintf(result, fmt, ap);
+    va_end(ap);
+    if (rc < 0)
+        error(2, 0, "Failed to allocate string");
+}
+
+static char *
+entry_path(const char *root, const char *name, const char *suffix)
+{
+    char *result;
+    if (asprintf(&result, "%s/%s%s", root, name, suffix) < 0)
+        error(2, 0, "Failed to allocate path string");
+    return result;
+}
+
+static char *
+get_cache_root(void)
+{
+    const char *dir = getenv(STATICX_CACHE_DIR);
+    if (dir && *dir)
+        return xstrdup(dir);
+
+    if (!getenv(STATICX_CACHE))
+        return NULL;
+
+    /* https://specifications.freedesktop.org/basedir-spec/latest/ */
+    const char *xdg = getenv("XDG_CACHE_HOME");
+    if (xdg && xdg[0] == '/')
+        return path_join(xdg, "staticx");
+
+    const char *home = getenv("HOME");
+    if (home && home[0] == '/')
+        return entry_path(home, ".cache", "/staticx");
+
+    return NULL;
+}
+
+static char *
+get_shared_root(void)
+{
+    if (!getenv(STATICX_SHARED_BUNDLE))
+        return NULL;
+
+    const char *tmproot = getenv(TMPDIR) ?: "/tmp";
+    char *result;
+    if (asprintf(&result, "%s/staticx-shared-%u", tmproot, (unsigned)geteuid()) < 0)
+        error(2, 0, "Failed to allocate path string");
+    return result;
+}
+
+/**
+ * Ensure the cache root exists and is private to the current user.
+ * Anyone who can write to the cache can control what we execute.
+ */
+static bool
+check_cache_root(const char *root)
+{
+    if (mkdirs(root, 0700) < 0) {
+        fprintf(stderr, "staticx: Failed to create cache dir %s: %m\n", root);
+        return false;
+    }
+
+    struct stat st;
+    if (lstat(root, &st) < 0) {
+        fprintf(stderr, "staticx: Failed to stat cache dir %s: %m\n", root);
+        return false;
+    }
+
+    if (!S_ISDIR(st.st_mode) || st.st_uid != geteuid() || (st.st_mode & 022)) {
+        fprintf(stderr, "staticx: Not using cache dir %s: "
+                "not a directory private to this user\n", root);
+        return false;
+    }
+
+    return true;
+}
+
+/**
+ * Open and lock a lock file.
+ *
+ * A lock file may be unlinked by whoever holds its exclusive lock, so after
+ * acquiring the lock we verify that it is still the file at the given path.
+ * A lock file owned by anyone but us or root (e.g. created by another user in
+ * a sticky dir) is refused, with EPERM.
+ *
+ * Returns the locked file descriptor, or -1 on error (including EWOULDBLOCK
+ * if LOCK_NB was given and the lock is held by someone else).
+ */
+static int
+lock_file(const char *path, int op)
+{
+    for (;;) {
+        int fd = open(path, O_RDWR | O_CREAT | O_CLOEXEC | O_NOFOLLOW, 0600);
+        if (fd < 0)
+            return -1;
+
+        struct stat st;
+        if (fstat(fd, &st) < 0 || (st.st_uid != geteuid() && st.st_uid != 0)) {
+            close(fd);
+            errno = EPERM;
+            return -1;
+        }
+
+        while (flock(fd, op) < 0) {
+            if (errno == EINTR)
+                continue;
+            int saved_errno = errno;
+            close(fd);
+            errno = saved_errno;
+            return -1;
+        }
+
+        struct stat fst, pst;
+        if (fstat(fd, &fst) == 0 && stat(path, &pst) == 0
+                && fst.st_dev == pst.st_dev && fst.st_ino == pst.st_ino)
+            return fd;
+
+        /* The lock file was replaced while we waited; try again */
+        close(fd);
+    }
+}
+
+/**
+ * Like lock_file(), but gives up (with EWOULDBLOCK) if the lock isn't
+ * acquired within timeout_ms.
+ */
+static int
+lock_file_timed(const char *path, int op, int timeout_ms)
+{
+    for (int waited = 0; ; waited += LOCK_POLL_MS) {
+        int fd = lock_file(path, op | LOCK_NB);
+        if (fd >= 0 || errno != EWOULDBLOCK || waited >= timeout_ms)
+            return fd;
+        usleep(LOCK_POLL_MS * 1000);
+    }
+}
+
+/* Returns the archive digest recorded in a bundle dir, or NULL */
+static char *
+read_bundle_digest(const char *bundle_dir)
+{
+    char *path = path_join(bundle_dir, DIGEST_FILENAME);
+    int fd = open(path, O_RDONLY | O_CLOEXEC);
+    free(path);
+    if (fd < 0)
+        return NULL;
+
+    char buf[DIGEST_LEN + 1];
+    ssize_t n = read(fd, buf, sizeof(buf));
+    close(fd);
+    if (n != DIGEST_LEN)
+        return NULL;
+
+    return strndup(buf, DIGEST_LEN);
+}
+
+static bool
+bundle_is_valid(const char *bundle_dir, const char *digest,
+        const struct archive_index *index)
+{
+    char *bundle_digest = read_bundle_digest(bundle_dir);
+    bool valid = bundle_digest && strcmp(bundle_digest, digest) == 0;
+    free(bundle_digest);
+    if (!valid) {
+        debug_printf("Bundle dir %s is missing or from another archive\n", bundle_dir);
+        return false;
+    }
+
+    /* Only trust a bundle which no one else could have put there */
+    struct stat st;
+    if (lstat(bundle_dir, &st) < 0 || !S_ISDIR(st.st_mode)
+            || (st.st_uid != geteuid() && st.st_uid != 0) || (st.st_mode & 022)) {
+        debug_printf("Bundle dir %s is not ours\n", bundle_dir);
+        return false;
+    }
+
+    char *prog_link = path_join(bundle_dir, PROG_FILENAME);
+    valid = (stat(prog_link, &st) == 0) && S_ISREG(st.st_mode);
+    free(prog_link);
+
+    if (!valid || !index)
+        return valid;
+
+    /**
+     * Make sure no member has gone missing or been truncated, e.g. by a
+     * tmp cleaner. Each member of the archive is checked with a single
+     * lstat(); the program is patched in place, so its size doesn't change.
+     */
+    for (size_t i = 0; i < index->count && valid; i++) {
+        const struct index_entry *e = &index->entries[i];
+        char *path = path_join(bundle_dir, e->name);
+
+        if (lstat(path, &st) < 0) {
+            valid = false;
+        }
+        else if (e->type == REGTYPE || e->type == AREGTYPE) {
+            valid = S_ISREG(st.st_mode) && (uint64_t)st.st_size == e->size;
+        }
+        else if (e->type == LNKTYPE) {
+            valid = S_ISREG(st.st_mode);
+        }
+        else if (e->type == SYMTYPE) {
+            valid = S_ISLNK(st.st_mode);
+        }
+
+        if (!valid)
+            debug_printf("Cached bundle member %s is missing or damaged\n", path);
+        free(path);
+    }
+
+    return valid;
+}
+
+static bool
+is_digest_name(const char *name)
+{
+    size_t n;
+    for (n = 0; name[n]; n++) {
+        if (!isxdigit((unsigned char)name[n]))
+            return false;
+    }
+    return n == 64;
+}
+
+/* Remove leftovers of populate attempts which crashed. Caller holds the lock. */
+static void
+remove_stale_tmpdirs(const char *root, const char *name)
+{
+    DIR *d = opendir(root);
+    if (!d)
+        return;
+
+    char *prefix;
+    if (asprintf(&prefix, "%s" TMP_SUFFIX, name) < 0)
+        error(2, 0, "Failed to allocate string");
+    size_t prefix_len = strlen(prefix);
+
+    struct dirent *de;
+    while ((de = readdir(d)) != NULL) {
+        if (strncmp(de->d_name, prefix, prefix_len) != 0)
+            continue;
+
+        char *path = path_join(root, de->d_name);
+        debug_printf("Removing stale cache tmpdir %s\n", path);
+        remove_tree(path);
+        free(path);
+    }
+
+    free(prefix);
+    closedir(d);
+}
+
+static void
+write_bundle_digest(const char *bundle_dir, const char *digest)
+{
+    char *path = path_join(bundle_dir, DIGEST_FILENAME);
+    int fd = open(path, O_WRONLY | O_CREAT | O_EXCL | O_CLOEXEC, 0400);
+    if (fd < 0 || write_all(fd, digest, strlen(digest)) < 0)
+        error(2, errno, "Failed to write %s", path);
+    close(fd);
+    free(path);
+}
+
+/**
+ * Populate an entry. If reason is given, a failure to create or replace the
+ * entry returns false with *reason set, rather than being fatal.
+ */
+static bool
+populate_entry(const char *root, const char *name, const char *digest,
+        const char *bundle_dir, bundle_prepare_fn prepare, char **reason)
+{
+    remove_stale_tmpdirs(root, name);
+
+    char *template = entry_path(root, name, TMP_SUFFIX "XXXXXX");
+    if (!mkdtemp(template)) {
+        if (!reason)
+            error(2, errno, "Failed to create temporary directory in %s", root);
+        xasprintf(reason, "failed to create temporary directory in %s: %m", root);
+        free(template);
+        return false;
+    }
+
+    debug_printf("Populating cache entry %s via %s\n", bundle_dir, template);
+    prepare(template, bundle_dir);
+    write_bundle_digest(template, digest);
+
+    /* An invalid entry may be left over e.g. from a user tampering with it */
+    if (remove_tree(bundle_dir) < 0 && errno != ENOENT) {
+        if (!reason)
+            error(2, errno, "Failed to remove invalid cache entry %s", bundle_dir);
+        xasprintf(reason, "failed to remove invalid bundle %s: %m", bundle_dir);
+        remove_tree(template);
+        free(template);
+        return false;
+    }
+
+    if (rename(template, bundle_dir) < 0) {
+        if (!reason)
+            error(2, errno, "Failed to rename %s to %s", template, bundle_dir);
+        xasprintf(reason, "failed to rename %s to %s: %m", template, bundle_dir);
+        remove_tree(template);
+        free(template);
+        return false;
+    }
+
+    free(template);
+    return true;
+}
+
+/******************************************************************************/
+/* Eviction */
+
+struct cache_entry
+{
+    char *name;
+    time_t mtime;
+    unsigned long long size;
+};
+
+static unsigned long long m_tree_size;
+
+static int
+tree_size_fn(const char *fpath, const struct stat *sb,
+        int typeflag, struct FTW *ftwbuf)
+{
+    m_tree_size += (unsigned long long)sb->st_blocks * 512;
+    return 0;
+}
+
+static unsigned long long
+tree_size(const char *path)
+{
+    m_tree_size = 0;
+    nftw(path, tree_size_fn, 20, FTW_PHYS);
+    return m_tree_size;
+}
+
+static int
+cmp_entry_mtime(const void *a, const void *b)
+{
+    const struct cache_entry *ea = a, *eb = b;
+    return (ea->mtime > eb->mtime) - (ea->mtime < eb->mtime);
+}
+
+static unsigned long long
+getenv_ull(const char *name, const char *suffixes)
+{
+    const char *val = getenv(name);
+    if (!val || !*val)
+        return 0;
+
+    char *end;
+    errno = 0;
+    unsigned long long result = strtoull(val, &end, 10);
+    if (errno || end == val)
+        goto bad;
+
+    /* Each successive suffix is a multiple of 1024 */
+    if (*end) {
+        const char *s = suffixes ? strchr(suffixes, toupper((unsigned char)*end)) : NULL;
+        if (!s || end[1])
+            goto bad;
+        for (size_t n = s - suffixes + 1; n > 0; n--)
+            result *= 1024;
+    }
+    return result;
+
+bad:
+    fprintf(stderr, "staticx: Ignoring invalid %s=%s\n", name, val);
+    return 0;
+}
+
+static bool
+evict_entry(const char *root, const char *name)
+{
+    char *bundle_dir = path_join(root, name);
+    char *lock_path = entry_path(root, name, LOCK_SUFFIX);
+    bool result = false;
+
+    /* Never wait; if someone holds the lock the entry is in use */
+    int fd = lock_file(lock_path, LOCK_EX | LOCK_NB);
+    if (fd < 0) {
+        debug_printf("Not evicting %s: %m\n", bundle_dir);
+        goto out;
+    }
+
+    debug_printf("Evicting cache entry %s\n", bundle_dir);
+    remove_stale_tmpdirs(root, name);
+    if (remove_tree(bundle_dir) < 0 && errno != ENOENT) {
+        fprintf(stderr, "staticx: Failed to evict %s: %m\n", bundle_dir);
+    }
+    else {
+        unlink(lock_path);
+        result = true;
+    }
+    close(fd);
+
+out:
+    free(lock_path);
+    free(bundle_dir);
+    return result;
+}
+
+static void
+cache_evict(const char *root, const char *keep)
+{
+    unsigned long long max_size = getenv_ull(STATICX_CACHE_MAX_SIZE, "KMGT");
+    unsigned long long max_age = getenv_ull(STATICX_CACHE_MAX_AGE, NULL);
+    if (!max_size && !max_age)
+        return;
+
+    DIR *d = opendir(root);
+    if (!d)
+        return;
+
+    struct cache_entry *entries = NULL;
+    size_t nentries = 0;
+    unsigned long long total = 0;
+
+    struct dirent *de;
+    while ((de = readdir(d)) != NULL) {
+        if (!is_digest_name(de->d_name))
+            continue;
+
+        struct stat st;
+        if (fstatat(dirfd(d), de->d_name, &st, AT_SYMLINK_NOFOLLOW) < 0
+                || !S_ISDIR(st.st_mode))
+            continue;
+
+        entries = realloc(entries, (nentries + 1) * sizeof(*entries));
+        if (!entries)
+            error(2, 0, "Failed to allocate cache entries");
+
+        char *path = path_join(root, de->d_name);
+        struct cache_entry *e = &entries[nentries++];
+        e->name = xstrdup(de->d_name);
+        e->mtime = st.st_mtime;
+        e->size = tree_size(path);
+        total += e->size;
+        free(path);
+    }
+    closedir(d);
+
+    /* Least-recently used first */
+    qsort(entries, nentries, sizeof(*entries), cmp_entry_mtime);
+
+    time_t now = time(NULL);
+    for (size_t i = 0; i < nentries; i++) {
+        struct cache_entry *e = &entries[i];
+
+        bool expired = max_age && (now - e->mtime) > (time_t)max_age;
+        bool over_size = max_size && total > max_size;
+
+        if ((expired || over_size) && strcmp(e->name, keep) != 0) {
+            if (evict_entry(root, e->name))
+                total -= e->size;
+        }
+        free(e->name);
+    }
+    free(entries);
+}
+
+/******************************************************************************/
+
+/**
+ * Lock an entry's lock file for get_entry(). If reason is given, the lock is
+ * only waited for up to FIXED_LOCK_TIMEOUT_MS, and failure returns -1 with
+ * *reason set, rather than being fatal.
+ */
+static int
+lock_entry(const char *lock_path, int op, char **reason)
+{
+    int fd = reason ? lock_file_timed(lock_path, op, FIXED_LOCK_TIMEOUT_MS)
+                    : lock_file(lock_path, op);
+    if (fd < 0) {
+        if (!reason)
+            error(2, errno, "Failed to lock %s", lock_path);
+        if (errno == EWOULDBLOCK)
+            xasprintf(reason, "timed out waiting for the lock on %s", lock_path);
+        else if (errno == EPERM)
+            xasprintf(reason, "%s is owned by another user", lock_path);
+        else
+            xasprintf(reason, "failed to lock %s: %m", lock_path);
+    }
+    return fd;
+}
+
+/**
+ * Get the entry `name` under root for the archive with the given digest,
+ * populating it if necessary. Returns with m_lock_fd holding a shared lock
+ * on the entry, and *populated set if this process populated it.
+ *
+ * If reason is given, failing to lock, create, or replace the entry returns
+ * NULL with *reason set, rather than being fatal; e.g. in a sticky dir, where
+ * others can create (and hold the locks of) entries before us.
+ */
+static char *
+get_entry(const char *root, const char *name, const char *digest,
+        const struct archive_index *index, bundle_prepare_fn prepare,
+        bool *populated, char **reason)
+{
+    char *bundle_dir = path_join(root, name);
+    char *lock_path = entry_path(root, name, LOCK_SUFFIX);
+    *populated = false;
+
+    for (;;) {
+        /* Fast path: the entry is already there */
+        m_lock_fd = lock_entry(lock_path, LOCK_SH, reason);
+        if (m_lock_fd < 0)
+            goto fail;
+
+        if (bundle_is_valid(bundle_dir, digest, index))
+            break;
+        close(m_lock_fd);
+
+        /* Populate it, unless someone else did while we waited */
+        m_lock_fd = lock_entry(lock_path, LOCK_EX, reason);
+        if (m_lock_fd < 0)
+            goto fail;
+
+        if (!bundle_is_valid(bundle_dir, digest, index)) {
+            if (!populate_entry(root, name, digest, bundle_dir, prepare, reason)) {
+                close(m_lock_fd);
+                m_lock_fd = -1;
+                goto fail;
+            }
+            *populated = true;
+        }
+
+        /**
+         * flock() can't atomically downgrade the lock, so release it and
+         * start over. The entry could be evicted in the meantime, but that
+         * only costs us another iteration.
+         */
+        close(m_lock_fd);
+    }
+
+    free(lock_path);
+    return bundle_dir;
+
+fail:
+    free(lock_path);
+    free(bundle_dir);
+    return NULL;
+}
+
+char *
+cache_get_bundle(const char *digest, const struct archive_index *index,
+        bundle_prepare_fn prepare)
+{
+    char *root = get_cache_root();
+    if (!root) {
+        debug_printf("Bundle cache disabled\n");
+        return NULL;
+    }
+
+    if (!check_cache_root(root)) {
+        free(root);
+        return NULL;
+    }
+
+    bool populated;
+    char *bundle_dir = get_entry(root, digest, digest, index, prepare, &populated, NULL);
+    debug_printf("Using cached bundle dir %s\n", bundle_dir);
+
+    /* Record the use for LRU eviction */
+    if (!populated && utimensat(AT_FDCWD, bundle_dir, NULL, 0) < 0)
+        debug_printf("Failed to touch %s: %m\n", bundle_dir);
+
+    /* Only new entries can grow the cache, so that is when we evict */
+    if (populated)
+        cache_evict(root, digest);
+
+    free(root);
+    return bundle_dir;
+}
+
+/**
+ * Check the parent of a fixed bundle dir (creating it if necessary). It must
+ * be a directory owned by us or root, which no one else can write to unless
+ * it's sticky (so they can't replace our entries).
+ *
+ * Returns NULL if it's usable, or why not.
+ */
+static char *
+check_fixed_root(const char *root)
+{
+    char *reason = NULL;
+    struct stat st;
+
+    if (mkdirs(root, 0700) < 0)
+        xasprintf(&reason, "failed to create %s: %m", root);
+    else if (lstat(root, &st) < 0)
+        xasprintf(&reason, "failed to stat %s: %m", root);
+    else if (!S_ISDIR(st.st_mode))
+        xasprintf(&reason, "%s is not a directory", root);
+    else if (st.st_uid != geteuid() && st.st_uid != 0)
+        xasprintf(&reason, "%s is owned by uid %u, not this user or root",
+                root, (unsigned)st.st_uid);
+    else if ((st.st_mode & 022) && !(st.st_mode & S_ISVTX))
+        xasprintf(&reason, "%s is writable by other users, and not sticky", root);
+
+    return reason;
+}
+
+bool
+cache_use_fixed_bundle(const char *bundle_dir, const char *digest,
+        const struct archive_index *index, bundle_prepare_fn prepare)
+{
+    char *path = xstrdup(bundle_dir);
+    char *slash = strrchr(path, '/');
+    const char *name = slash + 1;
+    *slash = '\0';
+    const char *root = (slash == path) ? "/" : path;
+    char *reason = NULL;
+    char *digest_path = path_join(bundle_dir, DIGEST_FILENAME);
+    struct stat st;
+
+    if (!*name) {
+        reason = xstrdup("it has no name");
+    }
+    else if ((reason = check_fixed_root(root)) != NULL) {
+        /* Checked first */
+    }
+    else if (lstat(bundle_dir, &st) == 0 && lstat(digest_path, &st) < 0) {
+        /* Never replace a directory which isn't a bundle */
+        if (errno == ENOENT)
+            reason = xstrdup("it exists and is not a staticx bundle");
+        else
+            xasprintf(&reason, "failed to stat %s: %m", digest_path);
+    }
+    else if (access(root, W_OK) < 0) {
+        /**
+         * We can't lock, populate, or evict anything here, but neither can
+         * anyone else but its owner, e.g. for a bundle extracted at install
+         * time. Use it if it's complete.
+         */
+        if (bundle_is_valid(bundle_dir, digest, index)) {
+            debug_printf("Using read-only fixed bundle dir %s\n", bundle_dir);
+            goto out;
+        }
+        xasprintf(&reason, "%s is not writable, and the bundle isn't there", root);
+    }
+    else {
+        bool populated;
+        char *entry = get_entry(root, name, digest, index, prepare, &populated,
+                &reason);
+        if (entry)
+            debug_printf("Using fixed bundle dir %s\n", entry);
+        free(entry);
+    }
+
+    if (reason) {
+        fprintf(stderr, "staticx: Can't use bundle dir %s: %s; "
+                "extracting to a temporary dir\n", bundle_dir, reason);
+        free(reason);
+        free(digest_path);
+        free(path);
+        return false;
+    }
+
+out:
+    free(digest_path);
+    free(path);
+    return true;
+}
+
+char *
+cache_get_shared_bundle(const char *digest, const struct archive_index *index,
+        bundle_prepare_fn prepare)
+{
+    char *root = get_shared_root();
+    if (!root)
+        return NULL;
+
+    if (!check_cache_root(root)) {
+        free(root);
+        return NULL;
+    }
+
+    bool populated;
+    char *bundle_dir = get_entry(root, digest, digest, index, prepare, &populated, NULL);
+    debug_printf("Using shared bundle dir %s\n", bundle_dir);
+
+    m_shared_root = root;
+    return bundle_dir;
+}
+
+/**
+ * Remove every entry of a shared bundle root which isn't in use, including
+ * those left behind by launchers which crashed.
+ */
+static void
+remove_unused_entries(const char *root)
+{
+    DIR *d = opendir(root);
+    if (!d)
+        return;
+
+    struct dirent *de;
+    while ((de = readdir(d)) != NULL) {
+        /* Every entry, complete or not, has a lock file */
+        size_t len = strlen(de->d_name);
+        size_t suffix_len = strlen(LOCK_SUFFIX);
+        if (len <= suffix_len || strcmp(de->d_name + len - suffix_len, LOCK_SUFFIX) != 0)
+            continue;
+
+        char *name = strndup(de->d_name, len - suffix_len);
+        if (!name)
+            error(2, 0, "Failed to allocate string");
+        if (is_digest_name(name))
+            evict_entry(root, name);
+        free(name);
+    }
+    closedir(d);
+}
+
+void
+cache_release_lock(void)
+{
+    if (m_lock_fd >= 0) {
+        close(m_lock_fd);
+        m_lock_fd = -1;
+    }
+}
+
+void
+cache_release_bundle(void)
+{
+    cache_release_lock();
+
+    if (m_shared_root) {
+        remove_unused_entries(m_shared_root);
+        free(m_shared_root);
+        m_shared_root = NULL;
+    }
+}
+
+void
+cache_inherit_lock(void)
+{
+    /* A read-only fixed bundle dir isn't locked */
+    if (m_lock_fd < 0)
+        return;
+
+    int flags = fcntl(m_lock_fd, F_GETFD);
+    if (flags < 0 || fcntl(m_lock_fd, F_SETFD, flags & ~FD_CLOEXEC) < 0)
+        error(2, errno, "Failed to clear FD_CLOEXEC on cache lock");
+}
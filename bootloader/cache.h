@@ -0,0 +1,52 @@
+#ifndef BOOTLOADER_CACHE_H
+#define BOOTLOADER_CACHE_H
+
+/**
+ * Prepares a bundle: extracts the archive into extract_dir, and patches the
+ * program to run from bundle_dir (where extract_dir will ultimately live).
+ */
+typedef void (*bundle_prepare_fn)(const char *extract_dir, const char *bundle_dir);
+
+struct archive_index;
+
+/**
+ * Returns the path of a ready-to-run bundle dir from the persistent cache,
+ * populating it if necessary, or NULL if the cache is disabled. If index is
+ * given, it is used to check that an existing bundle is intact.
+ */
+char *cache_get_bundle(const char *digest, const struct archive_index *index,
+        bundle_prepare_fn prepare);
+
+/**
+ * Prepares the fixed bundle dir given at build time (which the program has
+ * already been patched to run from), unless it is already there. The dir is
+ * managed like an entry of the cache. Returns false, having said why, if the
+ * dir can't be used, locked (within a timeout), or created; only failing to
+ * extract the bundle itself is fatal.
+ */
+bool cache_use_fixed_bundle(const char *bundle_dir, const char *digest,
+        const struct archive_index *index, bundle_prepare_fn prepare);
+
+/**
+ * Returns the path of a bundle dir shared by all concurrent launches of the
+ * same archive, populating it if necessary, or NULL if sharing is disabled.
+ */
+char *cache_get_shared_bundle(const char *digest,
+        const struct archive_index *index, bundle_prepare_fn prepare);
+
+/* Stop using the bundle, without removing it */
+void cache_release_lock(void);
+
+/**
+ * Stop using the bundle. A shared bundle (and any other shared bundle) is
+ * removed if no one else is using it.
+ */
+void cache_release_bundle(void);
+
+/**
+ * Keep holding the lock on the bundle returned by cache_get_bundle() across
+ * execve(), so the bundle can't be evicted while the program is running.
+ */
+void cache_inherit_lock(void);
+
+#endif /* BOOTLOADER_CACHE_H */
@@ -3,8 +3,15 @@
 #include <stdint.h>
 
 #define ARCHIVE_SECTION         ".staticx.archive"
+#define DIGEST_SECTION          ".staticx.digest"
+#define BLOCKS_SECTION          ".staticx.blocks"
+#define INDEX_SECTION           ".staticx.index"
+#define BUNDLE_DIR_SECTION      ".staticx.bundledir"
 #define INTERP_FILENAME         ".staticx.interp"
 #define PROG_FILENAME           ".staticx.prog"
+#define DIGEST_FILENAME         ".staticx.digest"
+
+#define DIGEST_LEN              64      /* SHA-256, hex-encoded */
 
 static inline void *
 ptr_add(void *p, size_t off)
@@ -0,0 +1,151 @@
+#include <string.h>
+#include <lz4frame.h>
+#include <zstd.h>
+#include "decomp.h"
+
+/**
+ * Magic numbers of each format:
+ * https://tukaani.org/xz/xz-file-format.txt
+ * https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md
+ * https://github.com/lz4/lz4/blob/dev/doc/lz4_Frame_format.md
+ */
+static const struct {
+    enum compression comp;
+    const char *name;
+    const uint8_t *magic;
+    size_t magic_len;
+} formats[] = {
+    { COMPRESSION_XZ,   "xz",   (const uint8_t *)"\xFD" "7zXZ\x00", 6 },
+    { COMPRESSION_ZSTD, "zstd", (const uint8_t *)"\x28\xB5\x2F\xFD", 4 },
+    { COMPRESSION_LZ4,  "lz4",  (const uint8_t *)"\x04\x22\x4D\x18", 4 },
+};
+
+#define NFORMATS    (sizeof(formats) / sizeof(formats[0]))
+
+enum compression
+detect_compression(const void *data, size_t len)
+{
+    for (size_t i = 0; i < NFORMATS; i++) {
+        if (len >= formats[i].magic_len
+                && memcmp(data, formats[i].magic, formats[i].magic_len) == 0)
+            return formats[i].comp;
+    }
+    return COMPRESSION_NONE;
+}
+
+const char *
+compression_name(enum compression comp)
+{
+    for (size_t i = 0; i < NFORMATS; i++) {
+        if (formats[i].comp == comp)
+            return formats[i].name;
+    }
+    return "none";
+}
+
+const char *
+xzret_to_str(enum xz_ret r)
+{
+    switch (r) {
+        case XZ_OK:                 return "XZ_OK";
+        case XZ_STREAM_END:         return "XZ_STREAM_END";
+        case XZ_UNSUPPORTED_CHECK:  return "XZ_UNSUPPORTED_CHECK";
+        case XZ_MEM_ERROR:          return "XZ_MEM_ERROR";
+        case XZ_MEMLIMIT_ERROR:     return "XZ_MEMLIMIT_ERROR";
+        case XZ_FORMAT_ERROR:       return "XZ_FORMAT_ERROR";
+        case XZ_OPTIONS_ERROR:      return "XZ_OPTIONS_ERROR";
+        case XZ_DATA_ERROR:         return "XZ_DATA_ERROR";
+        case XZ_BUF_ERROR:          return "XZ_BUF_ERROR";
+        default:                    return "XZ_??????";
+    }
+}
+
+static const char *
+decompress_xz(const uint8_t *in, size_t in_size, uint8_t *out, size_t out_size)
+{
+    /* Single-call mode uses the output buffer as the dictionary */
+    struct xz_dec *dec = xz_dec_init(XZ_SINGLE, 0);
+    if (!dec)
+        return xzret_to_str(XZ_MEM_ERROR);
+
+    struct xz_buf xzb = {
+        .in = in,
+        .in_pos = 0,
+        .in_size = in_size,
+        .out = out,
+        .out_pos = 0,
+        .out_size = out_size,
+    };
+    enum xz_ret xr = xz_dec_run(dec, &xzb);
+    xz_dec_end(dec);
+
+    if (xr != XZ_STREAM_END)
+        return xzret_to_str(xr);
+    if (xzb.out_pos != out_size)
+        return xzret_to_str(XZ_DATA_ERROR);
+    return NULL;
+}
+
+static const char *
+decompress_zstd(const uint8_t *in, size_t in_size, uint8_t *out, size_t out_size)
+{
+    /* Decodes all of the (concatenated) frames */
+    size_t r = ZSTD_decompress(out, out_size, in, in_size);
+    if (ZSTD_isError(r))
+        return ZSTD_getErrorName(r);
+    if (r != out_size)
+        return "zstd: Unexpected decompressed size";
+    return NULL;
+}
+
+static const char *
+decompress_lz4(const uint8_t *in, size_t in_size, uint8_t *out, size_t out_size)
+{
+    const char *err = NULL;
+    LZ4F_dctx *dctx;
+
+    size_t r = LZ4F_createDecompressionContext(&dctx, LZ4F_VERSION);
+    if (LZ4F_isError(r))
+        return LZ4F_getErrorName(r);
+
+    size_t in_pos = 0, out_pos = 0;
+    do {
+        size_t src_size = in_size - in_pos;
+        size_t dst_size = out_size - out_pos;
+        r = LZ4F_decompress(dctx, out + out_pos, &dst_size,
+                in + in_pos, &src_size, NULL);
+        if (LZ4F_isError(r)) {
+            err = LZ4F_getErrorName(r);
+            goto out;
+        }
+        in_pos += src_size;
+        out_pos += dst_size;
+
+        /* Stop when no progress can be made */
+        if (!src_size && !dst_size)
+            break;
+    } while (in_pos < in_size || r != 0);
+
+    if (r != 0 || in_pos != in_size || out_pos != out_size)
+        err = "lz4: Unexpected decompressed size";
+
+out:
+    LZ4F_freeDecompressionContext(dctx);
+    return err;
+}
+
+const char *
+decompress_block(enum compression comp,
+        const uint8_t *in, size_t in_size, uint8_t *out, size_t out_size)
+{
+    switch (comp) {
+        case COMPRESSION_XZ:
+            return decompress_xz(in, in_size, out, out_size);
+        case COMPRESSION_ZSTD:
+            return decompress_zstd(in, in_size, out, out_size);
+        case COMPRESSION_LZ4:
+            return decompress_lz4(in, in_size, out, out_size);
+        default:
+            return "Not a compressed block";
+    }
+}
@@ -0,0 +1,33 @@
+#ifndef BOOTLOADER_DECOMP_H
+#define BOOTLOADER_DECOMP_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include "xz.h"
+
+/* Compression formats of the archive (see COMPRESSIONS in constants.py) */
+enum compression {
+    COMPRESSION_NONE,
+    COMPRESSION_XZ,
+    COMPRESSION_ZSTD,
+    COMPRESSION_LZ4,
+};
+
+/* Determine the compression format of data by its magic number */
+enum compression detect_compression(const void *data, size_t len);
+
+/* Returns the name of a compression format, as used by the CLI */
+const char *compression_name(enum compression comp);
+
+const char *xzret_to_str(enum xz_ret r);
+
+/**
+ * Decompress a complete block (one or more streams or frames) in a single
+ * call. The block must decompress to exactly out_size bytes.
+ *
+ * Returns NULL on success, or a description of the error.
+ */
+const char *decompress_block(enum compression comp,
+        const uint8_t *in, size_t in_size, uint8_t *out, size_t out_size);
+
+#endif /* BOOTLOADER_DECOMP_H */
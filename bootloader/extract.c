@@ -1,40 +1,103 @@
+#include <ctype.h>
 #include <errno.h>
 #include <libtar.h>
 #include <fcntl.h>
+#include <sys/param.h>     /* for MAXPATHLEN */
 #include <string.h>
 #include <stdlib.h>
+#include <unistd.h>
+#include <lz4frame.h>
+#include <zstd.h>
 #include "common.h"
 #include "debug.h"
+#include "decomp.h"
 #include "elfutil.h"
 #include "error.h"
 #include "extract.h"
 #include "mmap.h"
+#include "pxz.h"
+#include "trace.h"
+#include "util.h"
 #include "xz.h"
 
 #define XZ_DICT_MAX     8<<20       /* 8 MiB */
 
+/* Drop consumed archive pages from our RSS in chunks of this size */
+#define RELEASE_CHUNK   (4<<20)     /* 4 MiB */
+
 static int common_close(void *context);
 static ssize_t xz_read(void *context, void *buf, size_t const len);
+static ssize_t zstd_read(void *context, void *buf, size_t const len);
+static ssize_t lz4_read(void *context, void *buf, size_t const len);
+static ssize_t pxz_tar_read(void *context, void *buf, size_t const len);
 static ssize_t mem_read(void *context, void *buf, size_t len);
+static int mem_copy(void *context, int fd, size_t len);
+
+struct archive
+{
+    const void *data;
+    size_t size;
+
+    /* The file containing the archive, and its offset therein */
+    int fd;
+    off_t offset;
+
+    /* Independently-compressed blocks; NULL if no block table */
+    struct pxz_block *blocks;
+    size_t nblocks;
+};
 
 /* Extraction context */
 struct exctx {
     tartype_t tartype;
 
-    /* This is used by both the xztype and memtype tar handlers */
+    /* The input (and, for xz, output) buffer of all of the tar handlers */
     struct xz_buf buf;
 
+    enum compression comp;
+
     /* Used only for xz; NULL otherwise */
     struct xz_dec *xzdec;
+
+    /* Used only for zstd; NULL otherwise */
+    ZSTD_DCtx *zstd;
+
+    /* Used only for lz4; NULL otherwise */
+    LZ4F_dctx *lz4;
+
+    /* Set while a zstd or lz4 frame has been only partially decoded */
+    bool frame_pending;
+
+    /* Used only for parallel decoding; NULL otherwise */
+    struct pxz *pxz;
+    unsigned int nthreads;
+
+    /* Input consumed up to this position has been released */
+    size_t in_released;
+
+    /* Used only for uncompressed archives; see struct archive */
+    int fd;
+    off_t offset;
+
+    /* Used only when tracing: the wrapped readfunc, and its statistics */
+    readfunc_t traced_readfunc;
+    uint64_t read_start;
+    uint64_t read_us;
+    uint64_t read_bytes;
 };
 
+static ssize_t traced_read(void *context, void *buf, size_t len);
+
 static struct exctx *
-exctx_new(const void *data, size_t datalen, bool xz)
+exctx_new(const struct archive *ar, enum compression comp)
 {
+    const void *data = ar->data;
+    size_t datalen = ar->size;
+
     struct exctx *ctx;
 
     /* Allocate context structure */
-    ctx = malloc(sizeof(*ctx));
+    ctx = calloc(1, sizeof(*ctx));
     if (!ctx) {
         error(2, 0, "Failed to allocate exctx");
         return NULL;
@@ -45,9 +108,22 @@ exctx_new(const void *data, size_t datalen, bool xz)
         tartype_t *typ = &ctx->tartype;
 
         typ->closefunc = common_close;
-        typ->readfunc = xz ? xz_read : mem_read;
+        switch (comp) {
+            case COMPRESSION_XZ:    typ->readfunc = xz_read; break;
+            case COMPRESSION_ZSTD:  typ->readfunc = zstd_read; break;
+            case COMPRESSION_LZ4:   typ->readfunc = lz4_read; break;
+            default:
+                typ->readfunc = mem_read;
+                typ->copyfunc = mem_copy;
+                break;
+        }
     }
 
+    ctx->comp = comp;
+
+    ctx->fd = ar->fd;
+    ctx->offset = ar->offset;
+
     /* Initialize buffer descriptor */
     {
         struct xz_buf *b = &ctx->buf;
@@ -61,44 +137,124 @@ exctx_new(const void *data, size_t datalen, bool xz)
         b->out_size = 0;
     }
 
-    /* Initialize XZ decoder */
-    if (xz) {
-        ctx->xzdec = xz_dec_init(XZ_DYNALLOC, XZ_DICT_MAX);
-        if (!ctx->xzdec) {
-            error(2, 0, "Failed to initialize xz decoder");
-            return NULL;
+    ctx->nthreads = 1;
+
+    /* Decode blocks in parallel if possible */
+    if (comp != COMPRESSION_NONE && ar->nblocks > 1) {
+        unsigned int nthreads = pxz_get_nthreads();
+        if (nthreads > ar->nblocks)
+            nthreads = ar->nblocks;
+
+        if (nthreads > 1) {
+            ctx->pxz = pxz_new(comp, ar->blocks, ar->nblocks, nthreads);
+            ctx->nthreads = nthreads;
+            ctx->tartype.readfunc = pxz_tar_read;
         }
     }
 
+    /* Initialize the streaming decoder */
+    if (!ctx->pxz) {
+        switch (comp) {
+            case COMPRESSION_XZ:
+                ctx->xzdec = xz_dec_init(XZ_DYNALLOC, XZ_DICT_MAX);
+                if (!ctx->xzdec)
+                    error(2, 0, "Failed to initialize xz decoder");
+                break;
+
+            case COMPRESSION_ZSTD:
+                ctx->zstd = ZSTD_createDCtx();
+                if (!ctx->zstd)
+                    error(2, 0, "Failed to initialize zstd decoder");
+                break;
+
+            case COMPRESSION_LZ4: {
+                size_t r = LZ4F_createDecompressionContext(&ctx->lz4, LZ4F_VERSION);
+                if (LZ4F_isError(r))
+                    error(2, 0, "Failed to initialize lz4 decoder: %s",
+                            LZ4F_getErrorName(r));
+                break;
+            }
+
+            default:
+                break;
+        }
+    }
+
+    /* Measure reading (i.e. decompression) */
+    if (trace_enabled) {
+        ctx->traced_readfunc = ctx->tartype.readfunc;
+        ctx->tartype.readfunc = traced_read;
+    }
+
     return ctx;
 }
 
+static ssize_t traced_read(void *context, void *buf, size_t len)
+{
+    struct exctx *ctx = context;
+
+    uint64_t start = trace_now();
+    if (!ctx->read_bytes)
+        ctx->read_start = start;
+
+    ssize_t n = ctx->traced_readfunc(context, buf, len);
+
+    ctx->read_us += trace_now() - start;
+    if (n > 0)
+        ctx->read_bytes += n;
+    return n;
+}
+
 static int common_close(void *context)
 {
     struct exctx *ctx = context;
 
+    /* Report the total time spent reading (i.e. decompressing) */
+    trace_event_dur("decode", ctx->read_start, ctx->read_us,
+            "\"compressed\":%s,\"compression\":\"%s\",\"threads\":%u,"
+            "\"bytes_in\":%zu,\"bytes_out\":%llu",
+            (ctx->comp != COMPRESSION_NONE) ? "true" : "false",
+            compression_name(ctx->comp),
+            ctx->nthreads,
+            ctx->buf.in_size,
+            (unsigned long long)ctx->read_bytes);
+
     if (ctx->xzdec) {
         xz_dec_end(ctx->xzdec);
     }
 
+    if (ctx->zstd) {
+        ZSTD_freeDCtx(ctx->zstd);
+    }
+
+    if (ctx->lz4) {
+        LZ4F_freeDecompressionContext(ctx->lz4);
+    }
+
+    if (ctx->pxz) {
+        pxz_free(ctx->pxz);
+    }
+
     free(ctx);
     return 0;
 }
 
-static const char * xzret_to_str(enum xz_ret r)
+/**
+ * Release pages of the (mmapped) archive which have already been consumed.
+ *
+ * Each page of the archive is only read once. Without this, every page we
+ * touched would remain in our RSS until the archive is unmapped, making peak
+ * memory usage proportional to the size of the archive.
+ */
+static void release_input(struct exctx *ctx)
 {
-    switch (r) {
-        case XZ_OK:                 return "XZ_OK";
-        case XZ_STREAM_END:         return "XZ_STREAM_END";
-        case XZ_UNSUPPORTED_CHECK:  return "XZ_UNSUPPORTED_CHECK";
-        case XZ_MEM_ERROR:          return "XZ_MEM_ERROR";
-        case XZ_MEMLIMIT_ERROR:     return "XZ_MEMLIMIT_ERROR";
-        case XZ_FORMAT_ERROR:       return "XZ_FORMAT_ERROR";
-        case XZ_OPTIONS_ERROR:      return "XZ_OPTIONS_ERROR";
-        case XZ_DATA_ERROR:         return "XZ_DATA_ERROR";
-        case XZ_BUF_ERROR:          return "XZ_BUF_ERROR";
-        default:                    return "XZ_??????";
-    }
+    struct xz_buf *b = &ctx->buf;
+
+    if (b->in_pos - ctx->in_released < RELEASE_CHUNK)
+        return;
+
+    mmap_release(b->in + ctx->in_released, b->in_pos - ctx->in_released);
+    ctx->in_released = b->in_pos;
 }
 
 static ssize_t xz_read(void *context, void * const buf, size_t const len)
@@ -116,13 +272,27 @@ static ssize_t xz_read(void *context, void * const buf, size_t const len)
 
         /* Run! */
         enum xz_ret xr = xz_dec_run(ctx->xzdec, b);
+        release_input(ctx);
         switch (xr) {
             case XZ_OK:
                 continue;
 
             case XZ_STREAM_END:
-                /* Return 0 to indicate EOF */
-                return 0;
+                /**
+                 * The archive may consist of multiple concatenated streams,
+                 * each optionally followed by (4-byte multiples of) Stream
+                 * Padding.
+                 */
+                while (b->in_pos < b->in_size && b->in[b->in_pos] == 0)
+                    b->in_pos++;
+
+                if (b->in_pos < b->in_size) {
+                    xz_dec_reset(ctx->xzdec);
+                    continue;
+                }
+
+                /* Return what we have; 0 indicates EOF */
+                return b->out_pos;
 
             default:
                 error(2, 0, "xz_dec_run returned %s (%d)\n", xzret_to_str(xr), xr);
@@ -133,15 +303,91 @@ static ssize_t xz_read(void *context, void * const buf, size_t const len)
     return len;
 }
 
-static bool is_xz_file(const char *buf, size_t len)
+/**
+ * Check the progress of a zstd or lz4 decoder, which decode any number of
+ * concatenated frames. Returns false if no further progress can be made.
+ */
+static bool frame_progress(struct exctx *ctx, size_t in, size_t out)
 {
-    /* https://tukaani.org/xz/xz-file-format.txt */
-    static const uint8_t HEADER_MAGIC[6] = { 0xFD, '7', 'z', 'X', 'Z', 0x00 };
+    release_input(ctx);
 
-    if (len < sizeof(HEADER_MAGIC))
-        return false;
+    if (in || out)
+        return true;
 
-    return memcmp(buf, HEADER_MAGIC, sizeof(HEADER_MAGIC)) == 0;
+    /* Out of input: the archive must end at a frame boundary */
+    if (ctx->frame_pending)
+        error(2, 0, "Truncated %s archive", compression_name(ctx->comp));
+    return false;
+}
+
+static ssize_t zstd_read(void *context, void * const buf, size_t const len)
+{
+    struct exctx *ctx = context;
+    struct xz_buf *b = &ctx->buf;
+
+    ZSTD_outBuffer out = { .dst = buf, .size = len, .pos = 0 };
+
+    /* Always attempt to fill the given output buffer */
+    while (out.pos != out.size) {
+        ZSTD_inBuffer in = { .src = b->in, .size = b->in_size, .pos = b->in_pos };
+        size_t out_pos = out.pos;
+
+        /* Returns 0 at the end of each frame */
+        size_t r = ZSTD_decompressStream(ctx->zstd, &out, &in);
+        if (ZSTD_isError(r))
+            error(2, 0, "ZSTD_decompressStream returned %s", ZSTD_getErrorName(r));
+        ctx->frame_pending = (r != 0);
+
+        size_t consumed = in.pos - b->in_pos;
+        b->in_pos = in.pos;
+        if (!frame_progress(ctx, consumed, out.pos - out_pos))
+            break;
+    }
+
+    /* Return what we have; 0 indicates EOF */
+    return out.pos;
+}
+
+static ssize_t lz4_read(void *context, void * const buf, size_t const len)
+{
+    struct exctx *ctx = context;
+    struct xz_buf *b = &ctx->buf;
+
+    size_t out_pos = 0;
+
+    /* Always attempt to fill the given output buffer */
+    while (out_pos != len) {
+        size_t src_size = b->in_size - b->in_pos;
+        size_t dst_size = len - out_pos;
+
+        /* Returns 0 at the end of each frame */
+        size_t r = LZ4F_decompress(ctx->lz4, (uint8_t *)buf + out_pos, &dst_size,
+                b->in + b->in_pos, &src_size, NULL);
+        if (LZ4F_isError(r))
+            error(2, 0, "LZ4F_decompress returned %s", LZ4F_getErrorName(r));
+        ctx->frame_pending = (r != 0);
+
+        b->in_pos += src_size;
+        out_pos += dst_size;
+        if (!frame_progress(ctx, src_size, dst_size))
+            break;
+    }
+
+    /* Return what we have; 0 indicates EOF */
+    return out_pos;
+}
+
+static ssize_t pxz_tar_read(void *context, void * const buf, size_t const len)
+{
+    struct exctx *ctx = context;
+    const char *err;
+
+    ssize_t n = pxz_read(ctx->pxz, buf, len, &err);
+    if (n < 0)
+        error(2, 0, "Failed to decompress %s block: %s",
+                compression_name(ctx->comp), err);
+
+    return n;
 }
 
 /*******************************************************************************/
@@ -159,40 +405,132 @@ static ssize_t mem_read(void *context, void * const buf, size_t len)
 
     memcpy(buf, source, len);
     b->in_pos += len;
+    release_input(ctx);
 
     return len;
 }
 
-/*******************************************************************************/
-
-struct archive
+static int mem_copy(void *context, int fd, size_t len)
 {
-    const void *data;
-    size_t size;
-};
+    struct exctx *ctx = context;
+    struct xz_buf *b = &ctx->buf;
+
+    /* The data is followed by padding to a whole number of blocks */
+    size_t padded = (len + T_BLOCKSIZE - 1) & ~(size_t)(T_BLOCKSIZE - 1);
+    if (padded > b->in_size - b->in_pos) {
+        errno = EINVAL;
+        return -1;
+    }
+
+    /**
+     * Have the kernel copy the data straight from the file, which avoids
+     * faulting it into our address space. Member data is page-aligned in
+     * uncompressed archives, which allows the filesystem to share extents.
+     */
+    size_t done = copy_range(fd, ctx->fd, ctx->offset + b->in_pos, len);
+
+    /* Write whatever the kernel couldn't copy from the mapping */
+    if (done < len) {
+        debug_printf("Kernel copied %zu of %zu bytes; writing the rest\n",
+                done, len);
+        if (write_all(fd, b->in + b->in_pos + done, len - done) < 0)
+            return -1;
+    }
+
+    b->in_pos += padded;
+    release_input(ctx);
 
-static TAR *tar_smart_bufopen(const struct archive ar, int options)
+    return 0;
+}
+
+/*******************************************************************************/
+
+static TAR *tar_smart_bufopen(const struct archive *ar, int options)
 {
-    /* Determine if the archive is compressed */
-    bool xz = is_xz_file(ar.data, ar.size);
+    /* Determine if (and how) the archive is compressed */
+    enum compression comp = detect_compression(ar->data, ar->size);
 
-    debug_printf("Archive %s XZ-compressed\n",
-            xz ? "is" : "is not");
+    debug_printf("Archive compression: %s\n", compression_name(comp));
 
     /* Create extration context */
-    struct exctx *ctx = exctx_new(ar.data, ar.size, xz);
+    struct exctx *ctx = exctx_new(ar, comp);
 
     /* Open the tar file */
     return tar_new(ctx, &ctx->tartype, options);
 }
 
+static uint32_t read_le32(const uint8_t *p)
+{
+    return (uint32_t)p[0]
+        | ((uint32_t)p[1] << 8)
+        | ((uint32_t)p[2] << 16)
+        | ((uint32_t)p[3] << 24);
+}
+
+static uint64_t read_le64(const uint8_t *p)
+{
+    return read_le32(p) | ((uint64_t)read_le32(p + 4) << 32);
+}
+
+#define BLOCK_TABLE_MAGIC       "SXBT"
+#define BLOCK_TABLE_VERSION     1
+#define BLOCK_TABLE_HDR_SIZE    16
+#define BLOCK_TABLE_ENT_SIZE    24
+
+/**
+ * Parse the block table, which describes the independently-compressed
+ * blocks of the archive. See BlockWriter.get_block_table() in archive.py.
+ */
+static void
+find_block_table(Elf_Ehdr *ehdr, struct archive *ar)
+{
+    const Elf_Shdr *shdr = elf_get_section_by_name(ehdr, BLOCKS_SECTION);
+    if (!shdr) {
+        debug_printf("No "BLOCKS_SECTION" section\n");
+        return;
+    }
+
+    const uint8_t *table = cptr_add(ehdr, shdr->sh_offset);
+    size_t size = shdr->sh_size;
+
+    if (size < BLOCK_TABLE_HDR_SIZE
+            || memcmp(table, BLOCK_TABLE_MAGIC, 4) != 0
+            || read_le32(table + 4) != BLOCK_TABLE_VERSION)
+        error(2, 0, "Invalid "BLOCKS_SECTION" section");
+
+    uint64_t count = read_le64(table + 8);
+    if (count > (size - BLOCK_TABLE_HDR_SIZE) / BLOCK_TABLE_ENT_SIZE)
+        error(2, 0, "Truncated "BLOCKS_SECTION" section");
+
+    ar->blocks = calloc(count, sizeof(*ar->blocks));
+    if (!ar->blocks && count)
+        error(2, 0, "Failed to allocate block table");
+
+    for (size_t i = 0; i < count; i++) {
+        const uint8_t *ent = table + BLOCK_TABLE_HDR_SIZE + i * BLOCK_TABLE_ENT_SIZE;
+        uint64_t offset = read_le64(ent);
+        uint64_t csize = read_le64(ent + 8);
+        uint64_t usize = read_le64(ent + 16);
+
+        if (offset > ar->size || csize > ar->size - offset || usize > SIZE_MAX)
+            error(2, 0, "Invalid block %zu in "BLOCKS_SECTION" section", i);
+
+        ar->blocks[i].in = cptr_add(ar->data, offset);
+        ar->blocks[i].in_size = csize;
+        ar->blocks[i].out_size = usize;
+    }
+    ar->nblocks = count;
+
+    debug_printf("Found block table with %zu blocks\n", ar->nblocks);
+}
+
 static struct archive
-find_archive(void *map)
+find_archive(const struct map *map)
 {
-    struct archive ar;
+    struct archive ar = { 0 };
 
     /* Find the .staticx.archive section */
-    Elf_Ehdr *ehdr = map;
+    Elf_Ehdr *ehdr = map->map;
     if (!elf_is_valid(ehdr))
         error(2, 0, "Invalid ELF header");
 
@@ -205,28 +543,272 @@ find_archive(void *map)
 
     ar.size = shdr->sh_size;
     ar.data = cptr_add(ehdr, shdr->sh_offset);
+    ar.fd = map->fd;
+    ar.offset = shdr->sh_offset;
+
+    find_block_table(ehdr, &ar);
 
     return ar;
 }
 
+
+char *
+get_archive_digest(void)
+{
+    char *digest = NULL;
+
+    /* mmap this ELF file */
+    struct map *map = mmap_file("/proc/self/exe", true);
+
+    /* Find the digest section; older archives don't have one */
+    Elf_Ehdr *ehdr = map->map;
+    if (!elf_is_valid(ehdr))
+        error(2, 0, "Invalid ELF header");
+
+    const Elf_Shdr *shdr = elf_get_section_by_name(ehdr, DIGEST_SECTION);
+    if (!shdr || shdr->sh_size != DIGEST_LEN) {
+        debug_printf("No valid "DIGEST_SECTION" section\n");
+        goto out;
+    }
+
+    const char *data = cptr_add(ehdr, shdr->sh_offset);
+    for (size_t i = 0; i < DIGEST_LEN; i++) {
+        if (!isxdigit((unsigned char)data[i])) {
+            debug_printf("Invalid "DIGEST_SECTION" section\n");
+            goto out;
+        }
+    }
+
+    digest = strndup(data, DIGEST_LEN);
+    if (!digest)
+        error(2, 0, "Failed to allocate digest string");
+    debug_printf("Archive digest: %s\n", digest);
+
+out:
+    unmap_file(map);
+    map = NULL;
+
+    return digest;
+}
+
+char *
+get_fixed_bundle_dir(void)
+{
+    char *bundle_dir = NULL;
+
+    /* mmap this ELF file */
+    struct map *map = mmap_file("/proc/self/exe", true);
+
+    Elf_Ehdr *ehdr = map->map;
+    if (!elf_is_valid(ehdr))
+        error(2, 0, "Invalid ELF header");
+
+    const Elf_Shdr *shdr = elf_get_section_by_name(ehdr, BUNDLE_DIR_SECTION);
+    if (shdr) {
+        bundle_dir = strndup(cptr_add(ehdr, shdr->sh_offset), shdr->sh_size);
+        if (!bundle_dir)
+            error(2, 0, "Failed to allocate bundle dir string");
+        if (bundle_dir[0] != '/')
+            error(2, 0, "Invalid "BUNDLE_DIR_SECTION" section");
+        debug_printf("Fixed bundle dir: %s\n", bundle_dir);
+    }
+
+    unmap_file(map);
+    map = NULL;
+
+    return bundle_dir;
+}
+
+#define INDEX_MAGIC         "SXIX"
+#define INDEX_VERSION       1
+#define INDEX_HDR_SIZE      12
+#define INDEX_ENT_SIZE      68
+
+static char *
+index_strndup(const uint8_t *s, size_t len)
+{
+    char *result = strndup((const char *)s, len);
+    if (!result)
+        error(2, 0, "Failed to allocate index string");
+    return result;
+}
+
+static struct archive_index *
+parse_index(const uint8_t *data, size_t size)
+{
+    if (size < INDEX_HDR_SIZE
+            || memcmp(data, INDEX_MAGIC, 4) != 0
+            || read_le32(data + 4) != INDEX_VERSION) {
+        debug_printf("Invalid "INDEX_SECTION" section\n");
+        return NULL;
+    }
+
+    uint32_t count = read_le32(data + 8);
+    if (count > (size - INDEX_HDR_SIZE) / INDEX_ENT_SIZE) {
+        debug_printf("Truncated "INDEX_SECTION" section\n");
+        return NULL;
+    }
+
+    struct archive_index *index = calloc(1, sizeof(*index));
+    if (index)
+        index->entries = calloc(count, sizeof(*index->entries));
+    if (!index || (!index->entries && count))
+        error(2, 0, "Failed to allocate archive index");
+
+    const uint8_t *p = data + INDEX_HDR_SIZE;
+    const uint8_t *end = data + size;
+    for (uint32_t i = 0; i < count; i++) {
+        if (end - p < INDEX_ENT_SIZE)
+            goto bad;
+
+        struct index_entry *e = &index->entries[i];
+        size_t name_len = p[2] | (p[3] << 8);
+        size_t link_len = p[4] | (p[5] << 8);
+        e->type = p[0];
+        e->mode = read_le32(p + 8);
+        e->size = read_le64(p + 12);
+        e->offset = read_le64(p + 20);
+        e->coffset = read_le64(p + 28);
+        memcpy(e->sha256, p + 36, sizeof(e->sha256));
+        p += INDEX_ENT_SIZE;
+
+        if ((size_t)(end - p) < name_len + link_len)
+            goto bad;
+        e->name = index_strndup(p, name_len);
+        e->linkname = index_strndup(p + name_len, link_len);
+        p += name_len + link_len;
+
+        /* Count only fully-parsed entries, for free_archive_index() */
+        index->count++;
+    }
+
+    debug_printf("Found archive index with %zu entries\n", index->count);
+    return index;
+
+bad:
+    debug_printf("Truncated "INDEX_SECTION" section\n");
+    free_archive_index(index);
+    return NULL;
+}
+
+struct archive_index *
+get_archive_index(void)
+{
+    struct archive_index *index = NULL;
+
+    /* mmap this ELF file */
+    struct map *map = mmap_file("/proc/self/exe", true);
+
+    /* Find the index section; older archives don't have one */
+    Elf_Ehdr *ehdr = map->map;
+    if (!elf_is_valid(ehdr))
+        error(2, 0, "Invalid ELF header");
+
+    const Elf_Shdr *shdr = elf_get_section_by_name(ehdr, INDEX_SECTION);
+    if (shdr)
+        index = parse_index(cptr_add(ehdr, shdr->sh_offset), shdr->sh_size);
+    else
+        debug_printf("No "INDEX_SECTION" section\n");
+
+    unmap_file(map);
+    map = NULL;
+
+    return index;
+}
+
+void
+free_archive_index(struct archive_index *index)
+{
+    if (!index)
+        return;
+
+    for (size_t i = 0; i < index->count; i++) {
+        free(index->entries[i].name);
+        free(index->entries[i].linkname);
+    }
+    free(index->entries);
+    free(index);
+}
+
+/**
+ * Extract a hardlink member. Archive members with identical contents are
+ * stored once, followed by hardlinks to the first one (see
+ * SxArchive.add_file()). libtar links to the target as named in the archive,
+ * i.e. relative to the current directory, so it must be joined with prefix.
+ */
+static int
+extract_hardlink(TAR *t, const char *prefix, const char *path)
+{
+    char target[MAXPATHLEN];
+    snprintf(target, sizeof(target), "%s/%s", prefix, th_get_linkname(t));
+
+    if (unlink(path) < 0 && errno != ENOENT)
+        return -1;
+    return link(target, path);
+}
+
+/**
+ * Like tar_extract_all(), but traces the extraction of each member, and
+ * returns the total size of the regular files extracted in *bytes.
+ */
+static int
+extract_all(TAR *t, const char *prefix, uint64_t *bytes)
+{
+    char buf[MAXPATHLEN];
+    int i;
+
+    while ((i = th_read(t)) == 0) {
+        const char *filename = th_get_pathname(t);
+        if (t->options & TAR_VERBOSE)
+            th_print_long_ls(t, stderr);
+
+        snprintf(buf, sizeof(buf), "%s/%s", prefix, filename);
+
+        uint64_t start = trace_now();
+        if (TH_ISLNK(t)) {
+            if (extract_hardlink(t, prefix, buf) != 0)
+                return -1;
+            continue;
+        }
+        if (tar_extract_file(t, buf) != 0)
+            return -1;
+
+        if (TH_ISREG(t)) {
+            uint64_t size = th_get_size(t);
+            *bytes += size;
+            trace_event("member", start, "\"name\":%s,\"bytes\":%llu",
+                    trace_str(filename), (unsigned long long)size);
+        }
+    }
+
+    return (i == 1 ? 0 : -1);
+}
+
 void
 extract_archive(const char *dest_path)
 {
+    uint64_t start = trace_now();
+
     /* mmap this ELF file */
     struct map *map = mmap_file("/proc/self/exe", true);
+    trace_event("mmap", start, "\"bytes\":%zu", map->size);
 
     /* Find the archive */
-    struct archive ar = find_archive(map->map);
+    uint64_t find_start = trace_now();
+    struct archive ar = find_archive(map);
+    trace_event("find_sections", find_start, "\"archive_bytes\":%zu,\"blocks\":%zu",
+            ar.size, ar.nblocks);
 
     /* Open the tar file */
     errno = 0;
-    TAR *t = tar_smart_bufopen(ar, TAR_DEBUG_OPTIONS);
+    TAR *t = tar_smart_bufopen(&ar, TAR_DEBUG_OPTIONS);
     if (t == NULL)
         error(2, errno, "tar_open() failed");
 
     /* Extract it */
     debug_printf("Extracting tar archive to %s\n", dest_path);
-    if (tar_extract_all(t, dest_path) != 0)
+    uint64_t bytes = 0;
+    if (extract_all(t, dest_path, &bytes) != 0)
         error(2, errno, "tar_extract_all() failed");
 
     /* Close it */
@@ -235,6 +817,9 @@ extract_archive(const char *dest_path)
     t = NULL;
     debug_printf("Successfully extracted archive to %s\n", dest_path);
 
+    free(ar.blocks);
     unmap_file(map);
     map = NULL;
+
+    trace_event("extract", start, "\"bytes_written\":%llu", (unsigned long long)bytes);
 }
@@ -1,6 +1,34 @@
 #ifndef BOOTLOADER_EXTRACT_H
 #define BOOTLOADER_EXTRACT_H
 
+#include <stdint.h>
+#include <sys/types.h>
+
+/* An entry of the archive member index (see pack_index() in archive.py) */
+struct index_entry {
+    char *name;
+    char *linkname;
+    char type;              /* tar type flag */
+    mode_t mode;
+    uint64_t size;
+    uint64_t offset;        /* offset of data in the uncompressed tar stream */
+    uint64_t coffset;       /* offset of the compressed block containing it */
+    uint8_t sha256[32];
+};
+
+struct archive_index {
+    struct index_entry *entries;
+    size_t count;
+};
+
 void extract_archive(const char *dest_path);
+char *get_archive_digest(void);
+
+/* Returns the fixed bundle dir set at build time, or NULL if there isn't one */
+char *get_fixed_bundle_dir(void);
+
+/* Returns the archive member index, or NULL if there isn't one */
+struct archive_index *get_archive_index(void);
+void free_archive_index(struct archive_index *index);
 
 #endif /* BOOTLOADER_EXTRACT_H */
@@ -10,6 +10,9 @@
 #include <unistd.h>
 #include <fcntl.h>
 #include <elf.h>
+#include <poll.h>
+#include <sys/resource.h>
+#include <sys/syscall.h>
 #include <sys/wait.h>
 #include "xz.h"
 #include "error.h"
@@ -19,6 +22,9 @@
 #include "debug.h"
 #include "extract.h"
 #include "elfutil.h"
+#include "cache.h"
+#include "membundle.h"
+#include "trace.h"
 
 /**
  * Environment variables which affect the bootloader's execution
@@ -26,6 +32,12 @@
 
 /* Keep temporary files */
 #define STATICX_KEEP_TEMPS      "STATICX_KEEP_TEMPS"
+/* Extract the bundle to memory rather than $TMPDIR */
+#define STATICX_MEMORY_BUNDLE   "STATICX_MEMORY_BUNDLE"
+/* Replace the bootloader with the program, rather than running it as a child */
+#define STATICX_EXEC            "STATICX_EXEC"
+/* Remove the bundle dir in a detached process, if set to "background" */
+#define STATICX_CLEANUP         "STATICX_CLEANUP"
 #define TMPDIR                  "TMPDIR"
 
 
@@ -33,14 +45,20 @@
 /* The "bundle" directory, where the archive is extracted */
 static const char *m_bundle_dir;
 
-static char *
-path_join(const char *p1, const char *p2)
-{
-    char *result;
-    if (asprintf(&result, "%s/%s", p1, p2) < 0)
-        error(2, 0, "Failed to allocate path string");
-    return result;
-}
+/* Whether the bundle dir lives in the persistent cache (or is fixed) */
+static bool m_bundle_cached;
+
+/* Whether the bundle dir was fixed at build time, with the program patched */
+static bool m_bundle_fixed;
+
+/* Whether the bundle dir is shared with concurrent runs (and cached) */
+static bool m_bundle_shared;
+
+/* Whether the bundle dir is a private tmpfs mount */
+static bool m_bundle_in_memory;
+
+/* Whether we extracted the archive (rather than reusing a cached bundle) */
+static bool m_bundle_prepared;
 
 #ifdef DEBUG
 static const char *
@@ -195,10 +213,10 @@ patch_prog_paths(const char *prog_path, const char *new_interp, const char *new_
 }
 
 static void
-patch_app(const char *prog_path)
+patch_app(const char *prog_path, const char *bundle_dir)
 {
-    char *interp_path = path_join(m_bundle_dir, INTERP_FILENAME);
-    const char *new_rpath = m_bundle_dir;
+    char *interp_path = path_join(bundle_dir, INTERP_FILENAME);
+    const char *new_rpath = bundle_dir;
 
     patch_prog_paths(prog_path, interp_path, new_rpath);
 
@@ -324,6 +342,15 @@ run_app(int argc, char **argv, char *prog_path)
         debug_printf("  [%d] = \"%s\"\n", i, a);
     }
 
+    /**
+     * When tracing, learn when the child has exec'd (or failed to) from the
+     * closing of this pipe.
+     */
+    int exec_pipe[2] = { -1, -1 };
+    if (trace_enabled && pipe2(exec_pipe, O_CLOEXEC) < 0)
+        exec_pipe[0] = exec_pipe[1] = -1;
+    uint64_t spawn_start = trace_now();
+
     /* Create new process */
     child_pid = fork();
     if (child_pid < 0)
@@ -347,16 +374,33 @@ run_app(int argc, char **argv, char *prog_path)
     setup_sig_handler(SIGTERM);
     /* SIGKILL can't be caught */
 
+    if (exec_pipe[0] >= 0) {
+        close(exec_pipe[1]);
+        char c;
+        while (read(exec_pipe[0], &c, 1) < 0 && errno == EINTR)
+            ;
+        close(exec_pipe[0]);
+        trace_event("spawn", spawn_start, NULL);
+    }
+    uint64_t child_start = trace_now();
 
     /* Wait for child to exit */
     int wstatus;
-    while (waitpid(child_pid, &wstatus, 0) < 0) {
+    struct rusage ru;
+    while (wait4(child_pid, &wstatus, 0, &ru) < 0) {
         if (errno == EINTR)
             continue;
         error(2, errno, "Failed to wait for child process %d", child_pid);
     }
     child_pid = 0;
 
+    trace_event("child", child_start,
+            "\"wstatus\":%d,\"utime_us\":%llu,\"stime_us\":%llu,\"maxrss_kb\":%ld",
+            wstatus,
+            (unsigned long long)ru.ru_utime.tv_sec * 1000000 + ru.ru_utime.tv_usec,
+            (unsigned long long)ru.ru_stime.tv_sec * 1000000 + ru.ru_stime.tv_usec,
+            ru.ru_maxrss);
+
     /* Restore signal handlers */
     restore_sig_handler(SIGINT);
     restore_sig_handler(SIGTERM);
@@ -366,17 +410,42 @@ run_app(int argc, char **argv, char *prog_path)
     return wstatus;
 }
 
+/**
+ * Returns true if the bundle dir is to be removed when the program exits
+ */
+static bool
+bundle_needs_cleanup(void)
+{
+    if (getenv(STATICX_KEEP_TEMPS))
+        return false;
+    return m_bundle_shared || !m_bundle_cached;
+}
+
 /**
  * Clean up the temporary bundle directory
  */
 static void
 cleanup_bundle_dir(void)
 {
+    if (m_bundle_shared && !getenv(STATICX_KEEP_TEMPS)) {
+        debug_printf("Releasing shared bundle dir %s\n", m_bundle_dir);
+        cache_release_bundle();
+        return;
+    }
+
+    if (m_bundle_cached) {
+        debug_printf("Not removing cached bundle dir %s\n", m_bundle_dir);
+        return;
+    }
+
     if (getenv(STATICX_KEEP_TEMPS)) {
         debug_printf("%s set; not removing %s\n", STATICX_KEEP_TEMPS, m_bundle_dir);
         return;
     }
 
+    if (m_bundle_in_memory)
+        membundle_unmount(m_bundle_dir);
+
     debug_printf("Removing temporary bundle dir %s\n", m_bundle_dir);
     if (remove_tree(m_bundle_dir) < 0) {
         fprintf(stderr, "staticx: Failed to cleanup %s: %m\n", m_bundle_dir);
@@ -386,6 +455,214 @@ cleanup_bundle_dir(void)
     m_bundle_dir = NULL;
 }
 
+/**
+ * Trace the bootloader's overall run time and peak memory use. wstatus is
+ * that of the child, or -1 when exec'ing.
+ */
+static void
+trace_exit(int wstatus)
+{
+    if (!trace_enabled)
+        return;
+
+    struct rusage ru;
+    getrusage(RUSAGE_SELF, &ru);
+    trace_event("exit", 0, "\"wstatus\":%d,\"maxrss_kb\":%ld", wstatus, ru.ru_maxrss);
+}
+
+#ifndef SYS_pidfd_open
+#define SYS_pidfd_open      434     /* The same on all architectures */
+#endif
+#ifndef SYS_close_range
+#define SYS_close_range     436
+#endif
+
+/* Close all file descriptors from 3 up, except keep_fd (if not -1) */
+static void
+close_other_fds(int keep_fd)
+{
+    if (keep_fd < 3) {
+        if (syscall(SYS_close_range, 3, ~0U, 0) == 0)
+            return;
+    }
+    else if (syscall(SYS_close_range, 3, keep_fd - 1, 0) == 0
+            && syscall(SYS_close_range, keep_fd + 1, ~0U, 0) == 0)
+        return;
+
+    long max_fd = sysconf(_SC_OPEN_MAX);
+    for (int fd = 3; fd < max_fd; fd++) {
+        if (fd != keep_fd)
+            close(fd);
+    }
+}
+
+/**
+ * Detach the current process from the terminal, process group, and all file
+ * descriptors (except keep_fd) it inherited from the program.
+ */
+static void
+detach(int keep_fd)
+{
+    /* Detach from the terminal and process group, so we don't receive their
+     * signals (e.g. Ctrl-C) */
+    setsid();
+
+    /* Don't hold open any pipes, or anything else, of the program's */
+    int nullfd = open("/dev/null", O_RDWR);
+    if (nullfd >= 0) {
+        dup2(nullfd, STDIN_FILENO);
+        dup2(nullfd, STDOUT_FILENO);
+        dup2(nullfd, STDERR_FILENO);
+    }
+    close_other_fds(keep_fd);
+}
+
+/**
+ * Wait for the process referred to by pidfd to exit, then clean up the
+ * bundle dir. Never returns.
+ */
+static void __attribute__((noreturn))
+reaper(int pidfd)
+{
+    detach(pidfd);
+
+    /* A pidfd becomes readable when the process exits */
+    struct pollfd pfd = {
+        .fd = pidfd,
+        .events = POLLIN,
+    };
+    while (poll(&pfd, 1, -1) < 0 && errno == EINTR)
+        ;
+
+    cleanup_bundle_dir();
+    _exit(0);
+}
+
+/**
+ * Start a detached process which cleans up the bundle dir after this
+ * process (i.e. the program, once we exec it) exits.
+ *
+ * Returns false if this isn't possible.
+ */
+static bool
+spawn_reaper(void)
+{
+    /* Refer to ourselves by pidfd, which can't be confused by PID reuse */
+    int pidfd = syscall(SYS_pidfd_open, getpid(), 0);
+    if (pidfd < 0) {
+        debug_printf("pidfd_open() failed: %m\n");
+        return false;
+    }
+
+    pid_t pid = fork();
+    if (pid < 0)
+        error(2, errno, "Failed to fork reaper process");
+
+    if (pid == 0) {
+        /* Fork again, so the reaper isn't a child of the program */
+        pid_t reaper_pid = fork();
+        if (reaper_pid == 0)
+            reaper(pidfd);
+        _exit(reaper_pid < 0 ? 1 : 0);
+    }
+
+    close(pidfd);
+
+    int wstatus;
+    while (waitpid(pid, &wstatus, 0) < 0) {
+        if (errno == EINTR)
+            continue;
+        error(2, errno, "Failed to wait for process %d", pid);
+    }
+
+    if (!WIFEXITED(wstatus) || WEXITSTATUS(wstatus) != 0) {
+        debug_printf("Failed to fork reaper process\n");
+        return false;
+    }
+
+    debug_printf("Started reaper process\n");
+    return true;
+}
+
+/**
+ * Clean up the bundle dir in a detached process, so we can exit without
+ * waiting for it. Returns false if this isn't possible.
+ */
+static bool
+cleanup_bundle_dir_background(void)
+{
+    /* Let the cleanup process tell whether we were the last user of a
+     * shared bundle */
+    cache_release_lock();
+
+    pid_t pid = fork();
+    if (pid < 0) {
+        debug_printf("Failed to fork cleanup process: %m\n");
+        return false;
+    }
+
+    if (pid == 0) {
+        /* Fork again, so the cleanup process isn't our child */
+        pid_t cleanup_pid = fork();
+        if (cleanup_pid == 0) {
+            detach(-1);
+            cleanup_bundle_dir();
+            _exit(0);
+        }
+        _exit(cleanup_pid < 0 ? 1 : 0);
+    }
+
+    int wstatus;
+    while (waitpid(pid, &wstatus, 0) < 0) {
+        if (errno == EINTR)
+            continue;
+        error(2, errno, "Failed to wait for process %d", pid);
+    }
+
+    if (!WIFEXITED(wstatus) || WEXITSTATUS(wstatus) != 0) {
+        debug_printf("Failed to fork cleanup process\n");
+        return false;
+    }
+
+    debug_printf("Removing %s in the background\n", m_bundle_dir);
+    return true;
+}
+
+/**
+ * Run the user application in place of the bootloader, so that it has our
+ * PID, and receives signals and determines the exit status directly.
+ *
+ * Returns only if this isn't possible, in which case run_app() is used.
+ */
+static void
+exec_app(int argc, char **argv, char *prog_path)
+{
+    uint64_t start = trace_now();
+
+    if (bundle_needs_cleanup()) {
+        if (!spawn_reaper()) {
+            debug_printf("Unable to clean up after exec; running as child\n");
+            return;
+        }
+    }
+    if (m_bundle_cached)
+        cache_inherit_lock();
+
+    char **new_argv = make_argv(argc, argv, prog_path);
+
+    debug_printf("Ready to exec with new argv:\n");
+    for (int i=0; new_argv[i]; i++)
+        debug_printf("  [%d] = \"%s\"\n", i, new_argv[i]);
+
+    trace_event("exec", start, NULL);
+    trace_exit(-1);
+
+    execv(new_argv[0], new_argv);
+
+    /* The reaper will clean up after we exit */
+    error(3, errno, "Failed to execv() %s", new_argv[0]);
+}
+
 /**
  * Returns the path to the actual user program to execute.
  * We resolve this manually rather than executing the symlink
@@ -395,10 +672,10 @@ cleanup_bundle_dir(void)
  * See #133.
  */
 static char *
-get_real_prog_path(void)
+get_real_prog_path(const char *bundle_dir)
 {
     // PROG_FILENAME is a symlink to the user's program
-    char *linkpath = path_join(m_bundle_dir, PROG_FILENAME);
+    char *linkpath = path_join(bundle_dir, PROG_FILENAME);
 
     char *result = realpath(linkpath, NULL);
     if (!result)
@@ -408,6 +685,27 @@ get_real_prog_path(void)
     return result;
 }
 
+/**
+ * Extract the archive embedded in this program into extract_dir, and patch
+ * the user application ELF to run from bundle_dir.
+ */
+static void
+prepare_bundle(const char *extract_dir, const char *bundle_dir)
+{
+    m_bundle_prepared = true;
+    extract_archive(extract_dir);
+
+    /* The program was patched at build time for a fixed bundle dir */
+    if (m_bundle_fixed)
+        return;
+
+    uint64_t start = trace_now();
+    char *prog_path = get_real_prog_path(extract_dir);
+    patch_app(prog_path, bundle_dir);
+    free(prog_path);
+    trace_event("patch", start, NULL);
+}
+
 static void identify(void)
 {
     debug_printf("bootloader version %s\n", STATICX_VERSION);
@@ -422,25 +720,75 @@ static void identify(void)
 int
 main(int argc, char **argv)
 {
+    trace_init();
+
+    uint64_t start = trace_now();
     identify();
     xz_crc32_init();
+    trace_event("identify", start, NULL);
+
+    /**
+     * Use the fixed bundle dir, if the program was built for one. Otherwise,
+     * use a bundle dir from the persistent cache, or a shared one, if enabled.
+     */
+    char *fixed_dir = get_fixed_bundle_dir();
+    char *digest = (fixed_dir || !getenv(STATICX_MEMORY_BUNDLE)) ?
+        get_archive_digest() : NULL;
+    if (fixed_dir && !digest)
+        error(2, 0, "Missing "DIGEST_SECTION" section");
+    if (digest) {
+        start = trace_now();
+        struct archive_index *index = get_archive_index();
+        if (fixed_dir &&
+                cache_use_fixed_bundle(fixed_dir, digest, index, prepare_bundle)) {
+            /* Otherwise, the program is patched for a tmpdir as usual */
+            m_bundle_fixed = true;
+            m_bundle_dir = fixed_dir;
+        }
+        else if (fixed_dir) {
+            free(fixed_dir);
+        }
+        else {
+            m_bundle_dir = cache_get_bundle(digest, index, prepare_bundle);
+            if (!m_bundle_dir) {
+                m_bundle_dir = cache_get_shared_bundle(digest, index, prepare_bundle);
+                m_bundle_shared = (m_bundle_dir != NULL);
+            }
+        }
+        m_bundle_cached = (m_bundle_dir != NULL);
+        free_archive_index(index);
+        free(digest);
+        if (m_bundle_cached)
+            trace_event("cache", start, "\"hit\":%s,\"shared\":%s",
+                    m_bundle_prepared ? "false" : "true",
+                    m_bundle_shared ? "true" : "false");
+    }
 
-    /* Create temporary directory where archive will be extracted */
-    m_bundle_dir = create_tmpdir();
-    debug_printf("Temporary bundle dir: %s\n", m_bundle_dir);
+    if (!m_bundle_dir) {
+        /* Create temporary directory where archive will be extracted */
+        m_bundle_dir = create_tmpdir();
+        debug_printf("Temporary bundle dir: %s\n", m_bundle_dir);
 
-    /* Extract the archive embedded in this program */
-    extract_archive(m_bundle_dir);
+        if (getenv(STATICX_MEMORY_BUNDLE)) {
+            m_bundle_in_memory = membundle_mount(m_bundle_dir);
+            if (!m_bundle_in_memory)
+                fprintf(stderr, "staticx: In-memory bundle unavailable; "
+                        "extracting to %s\n", m_bundle_dir);
+        }
 
-    /* Get path to user application inside temp dir */
-    char *prog_path = get_real_prog_path();
+        prepare_bundle(m_bundle_dir, m_bundle_dir);
+    }
 
-    /* Patch the user application ELF to run in the temp dir */
-    patch_app(prog_path);
+    /* Get path to user application inside bundle dir */
+    char *prog_path = get_real_prog_path(m_bundle_dir);
 
     /* Add STATICX_* variables to the environment for the child */
     setup_environment();
 
+    /* Replace ourselves with the user application, if requested */
+    if (getenv(STATICX_EXEC))
+        exec_app(argc, argv, prog_path);
+
     /* Run the user application */
     int wstatus = run_app(argc, argv, prog_path);
 
@@ -448,7 +796,15 @@ main(int argc, char **argv)
     prog_path = NULL;
 
     /* Cleanup */
-    cleanup_bundle_dir();
+    start = trace_now();
+    const char *cleanup_mode = getenv(STATICX_CLEANUP);
+    bool background = cleanup_mode && strcmp(cleanup_mode, "background") == 0
+        && bundle_needs_cleanup() && cleanup_bundle_dir_background();
+    if (!background)
+        cleanup_bundle_dir();
+    trace_event("cleanup", start, "\"background\":%s", background ? "true" : "false");
+
+    trace_exit(wstatus);
 
     /* Did child exit normally? */
     if (WIFEXITED(wstatus)) {
@@ -0,0 +1,177 @@
+#define _GNU_SOURCE
+#include <stdio.h>
+#include <stdbool.h>
+#include <string.h>
+#include <errno.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <sched.h>
+#include <sys/mount.h>
+#include <sys/wait.h>
+#include "debug.h"
+#include "error.h"
+#include "membundle.h"
+#include "util.h"
+
+/**
+ * In-memory bundle directory
+ *
+ * The bundle dir is created in $TMPDIR as usual, but a tmpfs is mounted on
+ * it in a private mount namespace. The archive is then extracted to memory,
+ * and only the (empty) mount point directory ever touches the filesystem.
+ * As the bundle dir is still an ordinary absolute path, patching the
+ * program's INTERP and RPATH to refer to it works just as before.
+ *
+ * The mount is visible only to the bootloader and the user program (and its
+ * descendants). When they have all exited, the namespace, and with it the
+ * tmpfs and its contents, is destroyed by the kernel. This happens even if
+ * the bootloader is killed before it can clean up.
+ *
+ * Creating a mount namespace requires CAP_SYS_ADMIN. Unprivileged users
+ * first create a user namespace, in which they have it. Only our own uid and
+ * gid are mapped (to themselves), and setgroups(2) is denied. So the program
+ * sees its own uid and gid, but every other id (e.g. the owner of a file, or
+ * a supplementary group from getgroups(2)) appears as the overflow uid/gid
+ * (usually nobody/nogroup), and it can't change its supplementary groups.
+ * Nor will it be able to gain privileges (e.g. by executing setuid programs).
+ */
+
+static int
+write_file(const char *path, const char *data)
+{
+    int fd = open(path, O_WRONLY | O_CLOEXEC);
+    if (fd < 0)
+        return -1;
+
+    int rc = write_all(fd, data, strlen(data));
+    int saved_errno = errno;
+    close(fd);
+    errno = saved_errno;
+    return rc;
+}
+
+static bool
+enter_user_namespace(void)
+{
+    uid_t uid = geteuid();
+    gid_t gid = getegid();
+    char map[64];
+
+    if (unshare(CLONE_NEWUSER | CLONE_NEWNS) < 0) {
+        debug_printf("Failed to create user+mount namespace: %m\n");
+        return false;
+    }
+
+    /**
+     * Map our ids to themselves. An unprivileged process must deny
+     * setgroups(2) before it can write gid_map.
+     */
+    if (write_file("/proc/self/setgroups", "deny") < 0 && errno != ENOENT) {
+        debug_printf("Failed to deny setgroups in user namespace: %m\n");
+        return false;
+    }
+
+    snprintf(map, sizeof(map), "%u %u 1", (unsigned)uid, (unsigned)uid);
+    if (write_file("/proc/self/uid_map", map) < 0) {
+        debug_printf("Failed to write uid_map: %m\n");
+        return false;
+    }
+
+    snprintf(map, sizeof(map), "%u %u 1", (unsigned)gid, (unsigned)gid);
+    if (write_file("/proc/self/gid_map", map) < 0) {
+        debug_printf("Failed to write gid_map: %m\n");
+        return false;
+    }
+
+    return true;
+}
+
+/**
+ * Enter new namespaces and mount a private tmpfs on dir. Once the namespaces
+ * are entered there is no leaving them, so this returns false having changed
+ * the process if a later step fails.
+ */
+static bool
+mount_private_tmpfs(const char *dir)
+{
+    /**
+     * Root doesn't need a user namespace, and creating one would drop its
+     * capabilities in the initial namespace (e.g. to bind low ports).
+     */
+    if (geteuid() == 0) {
+        if (unshare(CLONE_NEWNS) < 0) {
+            debug_printf("Failed to create mount namespace: %m\n");
+            return false;
+        }
+    }
+    else if (!enter_user_namespace()) {
+        return false;
+    }
+
+    /* Don't propagate our mount back to the parent namespace */
+    if (mount(NULL, "/", NULL, MS_REC | MS_PRIVATE, NULL) < 0) {
+        debug_printf("Failed to make mounts private: %m\n");
+        return false;
+    }
+
+    if (mount("staticx", dir, "tmpfs", MS_NOSUID | MS_NODEV, "mode=0700") < 0) {
+        debug_printf("Failed to mount tmpfs on %s: %m\n", dir);
+        return false;
+    }
+
+    return true;
+}
+
+/**
+ * Check whether mount_private_tmpfs() would succeed, by running it in a
+ * child process, whose namespaces (and mount) disappear when it exits.
+ */
+static bool
+probe_private_tmpfs(const char *dir)
+{
+    /* Don't let the child flush our buffered output too */
+    fflush(NULL);
+
+    pid_t pid = fork();
+    if (pid < 0) {
+        debug_printf("Failed to fork: %m\n");
+        return false;
+    }
+    if (pid == 0)
+        _exit(mount_private_tmpfs(dir) ? 0 : 1);
+
+    int wstatus;
+    while (waitpid(pid, &wstatus, 0) < 0) {
+        if (errno == EINTR)
+            continue;
+        error(2, errno, "Failed to wait for process %d", pid);
+    }
+
+    return WIFEXITED(wstatus) && WEXITSTATUS(wstatus) == 0;
+}
+
+bool
+membundle_mount(const char *dir)
+{
+    /**
+     * A failure after entering the namespaces would leave us in them, e.g.
+     * extracting to the tmpdir as a user without privileges, so the whole
+     * thing is tried in a child process first. Failing after that is fatal.
+     */
+    if (!probe_private_tmpfs(dir))
+        return false;
+
+    if (!mount_private_tmpfs(dir))
+        error(2, 0, "Failed to mount private tmpfs on %s", dir);
+
+    debug_printf("Mounted private tmpfs on %s\n", dir);
+    return true;
+}
+
+void
+membundle_unmount(const char *dir)
+{
+    debug_printf("Unmounting private tmpfs from %s\n", dir);
+    if (umount2(dir, MNT_DETACH) < 0)
+        fprintf(stderr, "staticx: Failed to unmount %s: %m\n", dir);
+}
@@ -0,0 +1,16 @@
+#ifndef BOOTLOADER_MEMBUNDLE_H
+#define BOOTLOADER_MEMBUNDLE_H
+
+#include <stdbool.h>
+
+/**
+ * Mount a private tmpfs on dir, in a new mount namespace (and user
+ * namespace, if unprivileged). Returns false if this isn't possible, in
+ * which case nothing has been changed.
+ */
+bool membundle_mount(const char *dir);
+
+/* Unmount the tmpfs from dir, discarding its contents */
+void membundle_unmount(const char *dir);
+
+#endif /* BOOTLOADER_MEMBUNDLE_H */
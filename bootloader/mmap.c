@@ -1,4 +1,5 @@
 #include <stdbool.h>
+#include <stdint.h>
 #include <stdlib.h>
 #include <fcntl.h>
 #include <unistd.h>
@@ -48,3 +49,18 @@ unmap_file(struct map *map)
 
     free(map);
 }
+
+void
+mmap_release(const void *addr, size_t len)
+{
+    const uintptr_t pagesize = sysconf(_SC_PAGESIZE);
+    uintptr_t start = (uintptr_t)addr;
+    uintptr_t end = start + len;
+
+    /* Only whole pages within the range can be released */
+    start = (start + pagesize - 1) & ~(pagesize - 1);
+    end &= ~(pagesize - 1);
+
+    if (end > start)
+        madvise((void *)start, end - start, MADV_DONTNEED);
+}
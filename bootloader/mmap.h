@@ -2,6 +2,7 @@
 #define MMAP_H
 
 #include <stdbool.h>
+#include <stddef.h>
 
 struct map
 {
@@ -16,4 +17,11 @@ mmap_file(const char *path, bool readonly);
 void
 unmap_file(struct map *map);
 
+/**
+ * Drop the pages of a read-only file mapping in the given range from our RSS.
+ * They will be re-read from the file if accessed again.
+ */
+void
+mmap_release(const void *addr, size_t len);
+
 #endif /* MMAP_H */
@@ -0,0 +1,266 @@
+#define _GNU_SOURCE
+#include <errno.h>
+#include <pthread.h>
+#include <sched.h>
+#include <stdio.h>
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include "debug.h"
+#include "error.h"
+#include "mmap.h"
+#include "pxz.h"
+
+/**
+ * Parallel decoder for archives made of independently-compressed streams
+ * ("blocks"). Despite its name, this handles any supported compression format.
+ *
+ * Worker threads claim blocks in order and decode each one in single-call
+ * mode into its own output buffer. The reader consumes the decoded blocks in
+ * order, freeing each one once consumed. At most `window` blocks are decoded
+ * but not yet consumed at any time, which bounds memory use.
+ */
+
+/* Overrides the number of decoder threads */
+#define STATICX_THREADS     "STATICX_THREADS"
+
+/**
+ * Default cap on the number of decoder threads. Each thread holds a decoded
+ * block in memory, and extraction is soon limited by the (serial) writer.
+ */
+#define DEFAULT_MAX_THREADS 8
+
+enum block_state {
+    BLOCK_PENDING,
+    BLOCK_DECODING,
+    BLOCK_DONE,
+};
+
+struct block {
+    const uint8_t *in;
+    size_t in_size;
+    size_t out_size;
+
+    enum block_state state;
+    uint8_t *out;
+    const char *error;
+};
+
+struct pxz {
+    enum compression comp;
+
+    pthread_mutex_t lock;
+    pthread_cond_t cond;
+
+    struct block *blocks;
+    size_t nblocks;
+
+    /* Next block to be claimed by a worker */
+    size_t next_decode;
+
+    /* Block currently being consumed by the reader, and position within it */
+    size_t consume;
+    size_t consume_pos;
+
+    /* Max number of decoded-but-unconsumed blocks */
+    size_t window;
+
+    /* Set to stop the workers early */
+    bool stop;
+
+    pthread_t *threads;
+    unsigned int nthreads;
+};
+
+static void
+decode_block(struct pxz *p, struct block *b)
+{
+    b->out = malloc(b->out_size);
+    if (!b->out && b->out_size) {
+        b->error = "Failed to allocate block";
+        return;
+    }
+
+    b->error = decompress_block(p->comp, b->in, b->in_size, b->out, b->out_size);
+
+    /* Each block is only read once */
+    mmap_release(b->in, b->in_size);
+}
+
+static void *
+worker(void *arg)
+{
+    struct pxz *p = arg;
+
+    pthread_mutex_lock(&p->lock);
+    for (;;) {
+        /* Wait for a block to be available within the window */
+        while (!p->stop && p->next_decode < p->nblocks
+                && p->next_decode >= p->consume + p->window)
+            pthread_cond_wait(&p->cond, &p->lock);
+
+        if (p->stop || p->next_decode >= p->nblocks)
+            break;
+
+        struct block *b = &p->blocks[p->next_decode++];
+        b->state = BLOCK_DECODING;
+        pthread_mutex_unlock(&p->lock);
+
+        decode_block(p, b);
+
+        pthread_mutex_lock(&p->lock);
+        b->state = BLOCK_DONE;
+        pthread_cond_broadcast(&p->cond);
+    }
+    pthread_mutex_unlock(&p->lock);
+
+    return NULL;
+}
+
+static unsigned int
+getenv_uint(const char *name)
+{
+    const char *val = getenv(name);
+    if (!val || !*val)
+        return 0;
+
+    char *end;
+    unsigned long result = strtoul(val, &end, 10);
+    if (*end || result > UINT32_MAX) {
+        fprintf(stderr, "staticx: Ignoring invalid %s=%s\n", name, val);
+        return 0;
+    }
+    return result;
+}
+
+unsigned int
+pxz_get_nthreads(void)
+{
+    unsigned int nthreads = getenv_uint(STATICX_THREADS);
+    if (nthreads)
+        return nthreads;
+
+    /* Respect CPU affinity (e.g. taskset, container cpusets) */
+    cpu_set_t set;
+    if (sched_getaffinity(0, sizeof(set), &set) == 0)
+        nthreads = CPU_COUNT(&set);
+    if (nthreads < 1) {
+        long n = sysconf(_SC_NPROCESSORS_ONLN);
+        nthreads = (n > 0) ? n : 1;
+    }
+
+    if (nthreads > DEFAULT_MAX_THREADS)
+        nthreads = DEFAULT_MAX_THREADS;
+
+    return nthreads;
+}
+
+struct pxz *
+pxz_new(enum compression comp, const struct pxz_block *blocks, size_t nblocks,
+        unsigned int nthreads)
+{
+    struct pxz *p = calloc(1, sizeof(*p));
+    if (!p)
+        error(2, 0, "Failed to allocate parallel decoder");
+    p->comp = comp;
+
+    p->blocks = calloc(nblocks, sizeof(*p->blocks));
+    if (!p->blocks)
+        error(2, 0, "Failed to allocate parallel decoder blocks");
+    p->nblocks = nblocks;
+
+    for (size_t i = 0; i < nblocks; i++) {
+        struct block *b = &p->blocks[i];
+        b->in = blocks[i].in;
+        b->in_size = blocks[i].in_size;
+        b->out_size = blocks[i].out_size;
+        b->state = BLOCK_PENDING;
+    }
+
+    /* Keep every worker busy while the reader consumes a block */
+    p->window = nthreads + 1;
+
+    pthread_mutex_init(&p->lock, NULL);
+    pthread_cond_init(&p->cond, NULL);
+
+    p->threads = calloc(nthreads, sizeof(*p->threads));
+    if (!p->threads)
+        error(2, 0, "Failed to allocate parallel decoder threads");
+
+    for (unsigned int i = 0; i < nthreads; i++) {
+        int rc = pthread_create(&p->threads[i], NULL, worker, p);
+        if (rc != 0)
+            error(2, rc, "Failed to create decoder thread");
+        p->nthreads++;
+    }
+
+    debug_printf("Decoding %zu %s blocks with %u threads\n",
+            nblocks, compression_name(comp), nthreads);
+    return p;
+}
+
+ssize_t
+pxz_read(struct pxz *p, void *buf, size_t len, const char **err)
+{
+    size_t copied = 0;
+
+    while (copied < len && p->consume < p->nblocks) {
+        struct block *b = &p->blocks[p->consume];
+
+        /* Wait for the block to be decoded */
+        pthread_mutex_lock(&p->lock);
+        while (b->state != BLOCK_DONE)
+            pthread_cond_wait(&p->cond, &p->lock);
+        pthread_mutex_unlock(&p->lock);
+
+        if (b->error) {
+            *err = b->error;
+            return -1;
+        }
+
+        size_t n = b->out_size - p->consume_pos;
+        if (n > len - copied)
+            n = len - copied;
+
+        memcpy((uint8_t *)buf + copied, b->out + p->consume_pos, n);
+        copied += n;
+        p->consume_pos += n;
+
+        if (p->consume_pos == b->out_size) {
+            /* Done with this block; let the workers move on */
+            free(b->out);
+            b->out = NULL;
+
+            pthread_mutex_lock(&p->lock);
+            p->consume++;
+            p->consume_pos = 0;
+            pthread_cond_broadcast(&p->cond);
+            pthread_mutex_unlock(&p->lock);
+        }
+    }
+
+    return copied;
+}
+
+void
+pxz_free(struct pxz *p)
+{
+    pthread_mutex_lock(&p->lock);
+    p->stop = true;
+    pthread_cond_broadcast(&p->cond);
+    pthread_mutex_unlock(&p->lock);
+
+    for (unsigned int i = 0; i < p->nthreads; i++)
+        pthread_join(p->threads[i], NULL);
+
+    for (size_t i = 0; i < p->nblocks; i++)
+        free(p->blocks[i].out);
+
+    pthread_cond_destroy(&p->cond);
+    pthread_mutex_destroy(&p->lock);
+    free(p->threads);
+    free(p->blocks);
+    free(p);
+}
@@ -0,0 +1,39 @@
+#ifndef BOOTLOADER_PXZ_H
+#define BOOTLOADER_PXZ_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <sys/types.h>
+#include "decomp.h"
+
+/* An independently-compressed stream (or frame) */
+struct pxz_block {
+    const uint8_t *in;
+    size_t in_size;
+    size_t out_size;
+};
+
+struct pxz;
+
+/**
+ * Returns the number of decoder threads to use: $STATICX_THREADS if set,
+ * otherwise the number of available CPUs (up to a limit).
+ */
+unsigned int pxz_get_nthreads(void);
+
+/* Start decoding the given blocks with nthreads worker threads */
+struct pxz *pxz_new(enum compression comp,
+        const struct pxz_block *blocks, size_t nblocks, unsigned int nthreads);
+
+/**
+ * Read up to len bytes of decompressed data, in order.
+ *
+ * Returns the number of bytes read (0 at EOF), or -1 on error, in which case
+ * *err is set to a description of the error.
+ */
+ssize_t pxz_read(struct pxz *p, void *buf, size_t len, const char **err);
+
+/* Stop all threads and free the decoder */
+void pxz_free(struct pxz *p);
+
+#endif /* BOOTLOADER_PXZ_H */
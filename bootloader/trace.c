@@ -0,0 +1,194 @@
+#define _GNU_SOURCE
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdarg.h>
+#include <string.h>
+#include <errno.h>
+#include <time.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include "trace.h"
+#include "util.h"
+
+/* Trace to the given path (appended to), or file descriptor ("fd:N") */
+#define STATICX_TRACE       "STATICX_TRACE"
+
+bool trace_enabled;
+static int m_trace_fd = -1;
+static uint64_t m_start;
+
+static uint64_t
+monotonic_us(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000 + ts.tv_nsec / 1000;
+}
+
+void
+trace_init(void)
+{
+    const char *dest = getenv(STATICX_TRACE);
+    if (!dest || !*dest)
+        return;
+
+    m_start = monotonic_us();
+
+    if (strncmp(dest, "fd:", 3) == 0) {
+        char *end;
+        long fd = strtol(dest + 3, &end, 10);
+        if (*end || fd < 0 || fd > INT32_MAX) {
+            fprintf(stderr, "staticx: Ignoring invalid %s=%s\n", STATICX_TRACE, dest);
+            return;
+        }
+        m_trace_fd = fd;
+    }
+    else {
+        m_trace_fd = open(dest, O_WRONLY | O_CREAT | O_APPEND | O_CLOEXEC, 0600);
+        if (m_trace_fd < 0) {
+            fprintf(stderr, "staticx: Failed to open %s: %m\n", dest);
+            return;
+        }
+    }
+    trace_enabled = true;
+
+    /* Anchor the monotonic times to the wall clock */
+    struct timespec now;
+    clock_gettime(CLOCK_REALTIME, &now);
+    trace_event("start", 0, "\"time\":%lld.%06ld",
+            (long long)now.tv_sec, now.tv_nsec / 1000);
+}
+
+uint64_t
+trace_now(void)
+{
+    return monotonic_us() - m_start;
+}
+
+static void
+vtrace_event(const char *phase, uint64_t start, uint64_t dur,
+        const char *fmt, va_list ap)
+{
+    char line[1024];
+    int n = snprintf(line, sizeof(line),
+            "{\"pid\":%d,\"phase\":\"%s\",\"t_us\":%llu,\"dur_us\":%llu",
+            (int)getpid(), phase,
+            (unsigned long long)start, (unsigned long long)dur);
+
+    if (fmt && n < sizeof(line)) {
+        line[n++] = ',';
+        n += vsnprintf(line + n, sizeof(line) - n, fmt, ap);
+    }
+
+    /* Drop overlong events, rather than emit broken JSON */
+    if (n + 2 > sizeof(line))
+        return;
+    line[n++] = '}';
+    line[n++] = '\n';
+
+    /* A single write, so concurrent writers don't interleave lines */
+    int saved_errno = errno;
+    write_all(m_trace_fd, line, n);
+    errno = saved_errno;
+}
+
+void
+trace_event(const char *phase, uint64_t start, const char *fmt, ...)
+{
+    if (!trace_enabled)
+        return;
+
+    va_list ap;
+    va_start(ap, fmt);
+    vtrace_event(phase, start, trace_now() - start, fmt, ap);
+    va_end(ap);
+}
+
+void
+trace_event_dur(const char *phase, uint64_t start, uint64_t dur,
+        const char *fmt, ...)
+{
+    if (!trace_enabled)
+        return;
+
+    va_list ap;
+    va_start(ap, fmt);
+    vtrace_event(phase, start, dur, fmt, ap);
+    va_end(ap);
+}
+
+/**
+ * Returns the length of the valid UTF-8 sequence at s, or 0 if it's invalid
+ * (including overlong encodings, surrogates, and code points past U+10FFFF).
+ */
+static size_t
+utf8_seq_len(const unsigned char *s)
+{
+    unsigned char lo = 0x80, hi = 0xBF;
+    size_t len;
+
+    if (s[0] < 0x80)
+        return 1;
+    else if (s[0] >= 0xC2 && s[0] <= 0xDF)
+        len = 2;
+    else if (s[0] >= 0xE0 && s[0] <= 0xEF) {
+        len = 3;
+        if (s[0] == 0xE0)
+            lo = 0xA0;
+        else if (s[0] == 0xED)
+            hi = 0x9F;
+    }
+    else if (s[0] >= 0xF0 && s[0] <= 0xF4) {
+        len = 4;
+        if (s[0] == 0xF0)
+            lo = 0x90;
+        else if (s[0] == 0xF4)
+            hi = 0x8F;
+    }
+    else
+        return 0;
+
+    if (s[1] < lo || s[1] > hi)
+        return 0;
+    for (size_t i = 2; i < len; i++) {
+        if (s[i] < 0x80 || s[i] > 0xBF)
+            return 0;
+    }
+    return len;
+}
+
+const char *
+trace_str(const char *s)
+{
+    static char buf[512];   /* NOTE: not thread-safe */
+    size_t n = 0;
+
+    buf[n++] = '"';
+    for (; *s && n < sizeof(buf) - 8; s++) {
+        unsigned char c = *s;
+        if (c == '"' || c == '\\') {
+            buf[n++] = '\\';
+            buf[n++] = c;
+        }
+        else if (c < 0x20) {
+            n += snprintf(buf + n, sizeof(buf) - n, "\\u%04x", c);
+        }
+        else if (c < 0x80) {
+            buf[n++] = c;
+        }
+        else {
+            size_t len = utf8_seq_len((const unsigned char *)s);
+            if (len) {
+                memcpy(buf + n, s, len);
+                n += len;
+                s += len - 1;
+            }
+            else {
+                n += snprintf(buf + n, sizeof(buf) - n, "\\u%04x", c);
+            }
+        }
+    }
+    buf[n++] = '"';
+    buf[n] = '\0';
+    return buf;
+}
@@ -0,0 +1,43 @@
+#ifndef BOOTLOADER_TRACE_H
+#define BOOTLOADER_TRACE_H
+
+#include <stdbool.h>
+#include <stdint.h>
+
+/**
+ * Startup tracing
+ *
+ * If STATICX_TRACE is set, each phase of the bootloader's execution is
+ * reported as a line of JSON, e.g.:
+ *   {"pid":123,"phase":"extract","t_us":250,"dur_us":4200,"bytes":1234}
+ */
+
+/* Enable tracing if requested; call first */
+void trace_init(void);
+
+extern bool trace_enabled;
+
+/* Monotonic time in microseconds since trace_init() */
+uint64_t trace_now(void);
+
+/**
+ * Emit an event for a phase which began at start (from trace_now()) and
+ * ends now. fmt (may be NULL) gives additional JSON members, without
+ * leading or trailing commas.
+ */
+void trace_event(const char *phase, uint64_t start, const char *fmt, ...)
+    __attribute__((format(printf, 3, 4)));
+
+/* Like trace_event(), for a phase which doesn't end now */
+void trace_event_dur(const char *phase, uint64_t start, uint64_t dur,
+        const char *fmt, ...)
+    __attribute__((format(printf, 4, 5)));
+
+/**
+ * Returns s as a JSON string literal, in a static buffer. File names needn't
+ * be UTF-8, so bytes which aren't part of a valid UTF-8 sequence are escaped
+ * as the code point of the same value (i.e. as if Latin-1).
+ */
+const char *trace_str(const char *s);
+
+#endif /* BOOTLOADER_TRACE_H */
@@ -1,32 +1,198 @@
-#define _XOPEN_SOURCE 500
+#define _GNU_SOURCE
 #include <stdlib.h>
-#include <stdio.h>          /* for remove(3) */
+#include <stdio.h>
+#include <string.h>
 #include <unistd.h>
 #include <errno.h>
-#include <ftw.h>            /* file tree walk */
+#include <dirent.h>
+#include <fcntl.h>
+#include <sys/ioctl.h>
+#include <sys/sendfile.h>
 #include <sys/stat.h>
+#if defined(__has_include) && __has_include(<linux/fs.h>)
+#include <linux/fs.h>       /* for FICLONERANGE */
+#endif
+#include "error.h"
 #include "util.h"
 
 
+char *
+path_join(const char *p1, const char *p2)
+{
+    char *result;
+    if (asprintf(&result, "%s/%s", p1, p2) < 0)
+        error(2, 0, "Failed to allocate path string");
+    return result;
+}
+
+int
+mkdirs(const char *pathname, mode_t mode)
+{
+    char *path = strdup(pathname);
+    if (!path) {
+        errno = ENOMEM;
+        return -1;
+    }
+
+    /* Create each parent in turn, then the final component */
+    for (char *p = path + 1; ; p++) {
+        if (*p != '/' && *p != '\0')
+            continue;
+
+        char c = *p;
+        *p = '\0';
+        if (mkdir(path, mode) < 0 && errno != EEXIST) {
+            free(path);
+            return -1;
+        }
+        *p = c;
+
+        if (c == '\0')
+            break;
+    }
+
+    free(path);
+    return 0;
+}
+
+
+/**
+ * Remove everything in the directory open as dfd, which is closed.
+ *
+ * Entries are unlinked relative to the directory fd, using d_type to tell
+ * subdirectories apart, so nothing is stat'd and no paths are resolved.
+ * Keeps going after an error, so as much as possible is removed; returns -1
+ * with errno set to that of the first error.
+ */
 static int
-remove_tree_fn(const char *fpath, const struct stat *sb,
-        int typeflag, struct FTW *ftwbuf)
+remove_dir_contents(int dfd)
 {
-    return remove(fpath);
+    DIR *dir = fdopendir(dfd);
+    if (!dir) {
+        int saved = errno;
+        close(dfd);
+        errno = saved;
+        return -1;
+    }
+
+    int err = 0;
+    struct dirent *ent;
+    while ((errno = 0, ent = readdir(dir)) != NULL) {
+        const char *name = ent->d_name;
+        if (strcmp(name, ".") == 0 || strcmp(name, "..") == 0)
+            continue;
+
+        /* Most entries aren't directories; if unsure, try that first */
+        if (ent->d_type != DT_DIR) {
+            if (unlinkat(dfd, name, 0) == 0)
+                continue;
+            if (ent->d_type != DT_UNKNOWN || (errno != EISDIR && errno != EPERM)) {
+                if (!err)
+                    err = errno;
+                continue;
+            }
+        }
+
+        int subfd = openat(dfd, name, O_RDONLY|O_DIRECTORY|O_NOFOLLOW|O_CLOEXEC);
+        if (subfd < 0 || remove_dir_contents(subfd) < 0
+                || unlinkat(dfd, name, AT_REMOVEDIR) < 0) {
+            if (!err)
+                err = errno;
+        }
+    }
+    if (errno && !err)
+        err = errno;
+
+    closedir(dir);
+
+    errno = err;
+    return err ? -1 : 0;
 }
 
 int
 remove_tree(const char *pathname)
 {
-    int max_open_fd = 20;
+    int dfd = open(pathname, O_RDONLY|O_DIRECTORY|O_NOFOLLOW|O_CLOEXEC);
+    if (dfd < 0) {
+        /* Not a directory (or a symlink to one); just remove it */
+        if (errno == ENOTDIR || errno == ELOOP)
+            return unlink(pathname);
+        return -1;
+    }
+
+    if (remove_dir_contents(dfd) < 0)
+        return -1;
+
+    return rmdir(pathname);
+}
+
+int
+write_all(int fd, const void *buf, size_t len)
+{
+    while (len > 0) {
+        ssize_t n = write(fd, buf, len);
+        if (n < 0) {
+            if (errno == EINTR)
+                continue;
+            return -1;
+        }
+        if (n == 0) {
+            errno = EIO;
+            return -1;
+        }
+        buf = (const char *)buf + n;
+        len -= n;
+    }
+    return 0;
+}
 
+size_t
+copy_range(int out_fd, int in_fd, off_t in_off, size_t len)
+{
+    size_t done = 0;
+
+#ifdef FICLONERANGE
     /**
-     * Musl libc < 1.0.0 had a bug where FTW_MOUNT flag prevented walking any
-     * directories at all. We don't really need it, so just leave it off.
-     * See https://github.com/JonathonReinhart/staticx/issues/25
+     * Share the extents, if the filesystem supports reflinks. This only
+     * works for whole filesystem blocks, but the length can't be rounded
+     * up as the source doesn't end here. The remainder is copied below.
      */
-    int flags = FTW_DEPTH | /* FTW_MOUNT | */ FTW_PHYS;
+    const size_t blksize = 4096;
+    size_t clone_len = len & ~(blksize - 1);
+    if (clone_len && (in_off % blksize) == 0) {
+        struct file_clone_range fcr = {
+            .src_fd = in_fd,
+            .src_offset = in_off,
+            .src_length = clone_len,
+            .dest_offset = 0,
+        };
+        if (ioctl(out_fd, FICLONERANGE, &fcr) == 0
+                && lseek(out_fd, clone_len, SEEK_SET) == clone_len)
+            done = clone_len;
+    }
+#endif
+
+    /* Copy within the kernel; may also reflink or use server-side copy */
+    while (done < len) {
+        loff_t off = in_off + done;
+        ssize_t n = copy_file_range(in_fd, &off, out_fd, NULL, len - done, 0);
+        if (n < 0 && errno == EINTR)
+            continue;
+        if (n <= 0)
+            break;
+        done += n;
+    }
+
+    /* Older kernels don't support copy_file_range() across filesystems */
+    while (done < len) {
+        off_t off = in_off + done;
+        ssize_t n = sendfile(out_fd, in_fd, &off, len - done);
+        if (n < 0 && errno == EINTR)
+            continue;
+        if (n <= 0)
+            break;
+        done += n;
+    }
 
-    errno = 0;
-    return nftw(pathname, remove_tree_fn, max_open_fd, flags);
+    return done;
 }
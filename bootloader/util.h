@@ -1,6 +1,20 @@
 #ifndef UTIL_H
 #define UTIL_H
 
+#include <stddef.h>
+#include <sys/types.h>
+
+char *path_join(const char *p1, const char *p2);
+int mkdirs(const char *pathname, mode_t mode);
 int remove_tree(const char *pathname);
+int write_all(int fd, const void *buf, size_t len);
+
+/**
+ * Copy len bytes from in_fd at offset in_off to the current position of
+ * out_fd without passing the data through userspace, using whichever of
+ * FICLONERANGE, copy_file_range() or sendfile() works. Returns the number
+ * of bytes copied, which may be less than len if none of them are usable.
+ */
+size_t copy_range(int out_fd, int in_fd, off_t in_off, size_t len);
 
 #endif /* UTIL_H */
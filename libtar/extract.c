@@ -104,15 +104,34 @@ tar_extract_file(TAR *t, const char *realname)
 	return 0;
 }
 
-static size_t align_up(size_t val, size_t align)
+/* Size of the buffer used to copy file data; a multiple of T_BLOCKSIZE */
+#define EXTRACT_BUFSIZE		(64 * 1024)
+
+/* write() all of buf, retrying on short writes */
+static int
+write_all(int fd, const char *buf, size_t len)
 {
-	size_t r = val % align;
+	ssize_t n;
 
-	if (r) {
-		val += align - r;
+	while (len > 0)
+	{
+		n = write(fd, buf, len);
+		if (n < 0)
+		{
+			if (errno == EINTR)
+				continue;
+			return -1;
+		}
+		if (n == 0)
+		{
+			errno = EIO;
+			return -1;
+		}
+		buf += n;
+		len -= n;
 	}
 
-	return val;
+	return 0;
 }
 
 /* extract regular file */
@@ -123,7 +142,7 @@ tar_extract_regfile(TAR *t, const char *realname)
 	size_t size;
 	int fdout = -1;
 	const char *filename;
-	size_t to_read;
+	size_t to_read, to_write;
 	char *buf = NULL;
 	ssize_t n;
 	int retval = -1;
@@ -175,33 +194,54 @@ tar_extract_regfile(TAR *t, const char *realname)
 
 	/* extract the file */
 
-	/* Must always read a multiple of T_BLOCKSIZE bytes */
-	to_read = align_up(size, T_BLOCKSIZE);
+	/* staticx: Let the archive type copy the data directly, if it can */
+	if (t->type->copyfunc)
+	{
+		if (t->type->copyfunc(t->context, fdout, size) == -1) {
+# ifdef DEBUG
+			fprintf(stderr, "libtar copyfunc(%zu) failed: %s\n", size, strerror(errno));
+# endif
+			goto out;
+		}
+		size = 0;
+	}
 
-	buf = malloc(to_read);
+	/**
+	 * staticx: Stream the data through a fixed-size buffer, so memory use
+	 * doesn't depend on the size of the file.
+	 */
+	buf = malloc(EXTRACT_BUFSIZE);
 	if (!buf) {
 		errno = ENOMEM;
 		goto out;
 	}
 
-	/* Read blocks */
-	n = t->type->readfunc(t->context, buf, to_read);
-	if (n != to_read) {
+	while (size > 0)
+	{
+		/* Must always read a multiple of T_BLOCKSIZE bytes */
+		to_write = MIN(size, EXTRACT_BUFSIZE);
+		to_read = to_write + (T_BLOCKSIZE - 1);
+		to_read -= to_read % T_BLOCKSIZE;
+
+		/* Read blocks */
+		n = t->type->readfunc(t->context, buf, to_read);
+		if (n != to_read) {
 # ifdef DEBUG
-		fprintf(stderr, "libtar readfunc(%zu) returned %zd\n", to_read, n);
+			fprintf(stderr, "libtar readfunc(%zu) returned %zd\n", to_read, n);
 # endif
-		errno = EINVAL;
-		goto out;
-	}
+			errno = EINVAL;
+			goto out;
+		}
 
-	/* Write blocks to file */
-	n = write(fdout, buf, size);
-	if (n != size) {
+		/* Write blocks to file */
+		if (write_all(fdout, buf, to_write) == -1) {
 # ifdef DEBUG
-		fprintf(stderr, "libtar write(%zu) returned %zd\n", size, n);
+			fprintf(stderr, "libtar write(%zu) failed: %s\n", to_write, strerror(errno));
 # endif
-		errno = EINVAL;
-		goto out;
+			goto out;
+		}
+
+		size -= to_write;
 	}
 
 	/* Success */
@@ -63,11 +63,18 @@ struct tar_header
 
 typedef int (*closefunc_t)(void *context);
 typedef ssize_t (*readfunc_t)(void *context, void *buf, size_t len);
+/**
+ * staticx: Optional. Write the next len bytes of file data directly to fd,
+ * and consume them (and the padding to T_BLOCKSIZE) from the archive.
+ * Returns 0 on success or -1 on error.
+ */
+typedef int (*copyfunc_t)(void *context, int fd, size_t len);
 
 typedef struct
 {
 	closefunc_t closefunc;
 	readfunc_t readfunc;
+	copyfunc_t copyfunc;
 }
 tartype_t;
 
@@ -20,6 +20,8 @@
 /* #define XZ_DEC_ARM */
 /* #define XZ_DEC_ARMTHUMB */
 /* #define XZ_DEC_SPARC */
+/* #define XZ_DEC_ARM64 */
+/* #define XZ_DEC_RISCV */
 
 /*
  * MSVC doesn't support modern C but XZ Embedded is mostly C89
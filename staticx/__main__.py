@@ -2,8 +2,13 @@ import argparse
 import sys
 import logging
 
-from .api import generate
+from .api import generate, generate_many
+from .constants import (COMPRESSIONS, COMPRESSION_PROFILES, DEFAULT_COMPRESSION,
+                        DEFAULT_COMPRESSION_PROFILE, DEFAULT_CACHE_MAX_SIZE)
 from .errors import Error
+from .libcache import env_cache_dir, parse_size
+from .manifest import load_manifest
+from .report import write_report
 from .version import __version__
 
 def parse_args():
@@ -12,9 +17,9 @@ def parse_args():
     ap = argparse.ArgumentParser(prog='staticx')
 
     # Positional arguments
-    ap.add_argument('prog',
+    ap.add_argument('prog', nargs='?',
             help = 'Input program to bundle')
-    ap.add_argument('output',
+    ap.add_argument('output', nargs='?',
             help = 'Output path')
 
     # Operational options
@@ -22,8 +27,69 @@ def parse_args():
             help = 'Add additional libraries (absolute paths)')
     ap.add_argument('--strip', action='store_true',
             help = 'Strip binaries before adding to archive (reduces size)')
-    ap.add_argument('--no-compress', action='store_true',
-            help = "Don't compress the archive (increases size)")
+    # The last of --compression and --no-compress given wins
+    ap.add_argument('--compression', choices=COMPRESSIONS,
+            help = f"Archive compression format (default: {DEFAULT_COMPRESSION}). "
+                   "zstd and lz4 decompress much faster than xz, at the cost "
+                   "of a somewhat larger output")
+    ap.add_argument('--no-compress', dest='compression',
+            action='store_const', const='none',
+            help = "Don't compress the archive (increases size, but speeds up startup); "
+                   "same as --compression=none")
+    ap.add_argument('--compression-profile', metavar='PROFILE',
+            choices=(*COMPRESSION_PROFILES, 'auto'),
+            help = "Compression profile: size, balanced, or startup "
+                   f"(default: {DEFAULT_COMPRESSION_PROFILE}); auto chooses the "
+                   "profile (and the format, unless --compression is given) with "
+                   "the shortest estimated startup time")
+    ap.add_argument('--size-budget', metavar='SIZE', type=parse_size,
+            help = "With --compression-profile=auto, the maximum archive size "
+                   "(K, M, G or T suffix allowed)")
+    ap.add_argument('--target-threads', metavar='N', type=int,
+            help = "With --compression-profile=auto, the number of CPUs the "
+                   "program will run with (default: 2)")
+
+    ap.add_argument('--bundle-dir', metavar='DIR',
+            help = "Extract to DIR, rather than a new temporary directory, and "
+                   "patch the program for it now rather than at run-time. "
+                   "'%%h' is replaced with a hash of the bundle contents "
+                   "(e.g. /run/staticx/%%h). The parent of DIR must be owned "
+                   "by the user running the program or root, and not "
+                   "writable by others unless sticky; otherwise a temporary "
+                   "directory is used")
+
+    ap.add_argument('-j', '--jobs', type=int, metavar='N',
+            help = "Number of libraries to prepare (audit, patch and strip), "
+                   "and archive blocks to compress, in parallel "
+                   "(default: number of CPUs)")
+
+    cache = ap.add_mutually_exclusive_group()
+    cache.add_argument('--cache-dir', metavar='DIR', default=env_cache_dir(),
+            help = "Cache prepared libraries in DIR, for later builds "
+                   "(default: $STATICX_BUILD_CACHE_DIR, or no cache)")
+    cache.add_argument('--no-cache', dest='cache_dir', action='store_const', const=None,
+            help = "Don't cache prepared libraries, even if the environment "
+                   "enables the cache")
+    ap.add_argument('--cache-max-size', metavar='SIZE', type=parse_size,
+            default=DEFAULT_CACHE_MAX_SIZE,
+            help = "Evict least-recently-used libraries from the cache above "
+                   "SIZE bytes (K, M, G or T suffix allowed; default: 1G)")
+
+    ap.add_argument('--base', metavar='FILE',
+            help = "Reuse the unchanged compressed blocks of FILE, a previous "
+                   "output of staticx (e.g. OUTPUT itself), rather than "
+                   "compressing them again (not with an uncompressed archive)")
+
+    ap.add_argument('--batch', metavar='MANIFEST',
+            help = "Bundle each of the programs listed in MANIFEST (a TOML "
+                   "file), sharing the work common to them, instead of PROG. "
+                   "Other options (but not --base) apply to every program, "
+                   "unless the manifest overrides them")
+
+    ap.add_argument('--report', metavar='FILE',
+            help = "Write a JSON report of the build to FILE: the time taken "
+                   "by each phase, and the sizes of the output and of each "
+                   "archive member, raw and compressed")
 
     # Special / output-related options
     ap.add_argument('-V', '--version', action='version',
@@ -35,23 +101,86 @@ def parse_args():
 
     args = ap.parse_args()
 
+    if args.batch:
+        if args.prog or args.output:
+            ap.error("prog and output can't be given with --batch")
+        if args.base:
+            ap.error("--base can't be given with --batch; give a base for "
+                     "each [[program]] in the manifest")
+    elif not (args.prog and args.output):
+        ap.error("prog and output are required")
+
     if args.loglevel is None:
         args.loglevel = 'DEBUG' if args.debug else DEFAULT_LOGLEVEL
 
     return args
 
 
+def get_batch_defaults(args):
+    """Returns the options given on the command line, for each batch build"""
+    defaults = dict(
+        libs = args.libs,
+        strip = args.strip or None,
+        compression = args.compression,
+        debug = args.debug or None,
+        bundle_dir = args.bundle_dir,
+        compression_profile = args.compression_profile,
+        size_budget = args.size_budget,
+        target_threads = args.target_threads,
+    )
+    return {k: v for k, v in defaults.items() if v is not None}
+
+
+def run_batch(args):
+    builds = load_manifest(args.batch, defaults=get_batch_defaults(args))
+    results = generate_many(builds,
+            jobs = args.jobs,
+            cache_dir = args.cache_dir,
+            cache_max_size = args.cache_max_size,
+            )
+
+    if args.report:
+        write_report(dict(programs=[
+            r.report or dict(output=r.output, error=str(r.error)) for r in results
+        ]), args.report)
+
+    failed = 0
+    for r in results:
+        if r.error:
+            failed += 1
+            print(f"{r.output}: FAILED ({r.seconds:.1f} s): {r.error}")
+        else:
+            print(f"{r.output}: {r.size} bytes ({r.seconds:.1f} s)")
+    print(f"{len(results) - failed} of {len(results)} programs bundled")
+    if failed:
+        sys.exit(2)
+
+
 def main():
     args = parse_args()
     logging.basicConfig(level=args.loglevel)
 
     try:
-        generate(args.prog, args.output,
+        if args.batch:
+            run_batch(args)
+            return
+
+        report = generate(args.prog, args.output,
                 libs = args.libs,
                 strip = args.strip,
-                compress = not args.no_compress,
+                compression = args.compression,
                 debug = args.debug,
+                bundle_dir = args.bundle_dir,
+                jobs = args.jobs,
+                cache_dir = args.cache_dir,
+                cache_max_size = args.cache_max_size,
+                base = args.base,
+                compression_profile = args.compression_profile,
+                size_budget = args.size_budget,
+                target_threads = args.target_threads,
                 )
+        if args.report:
+            write_report(report, args.report)
     except Error as e:
         if args.debug:
             raise
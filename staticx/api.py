@@ -2,49 +2,249 @@
 # Copyright 2017 Jonathon Reinhart
 # https://github.com/JonathonReinhart/staticx
 #
+import hashlib
 import shutil
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from tempfile import NamedTemporaryFile, mkdtemp
 import os
 from os.path import basename, islink
 import logging
+import re
 import subprocess
 
 from .errors import *
 from .utils import *
 from .elf import *
-from .archive import SxArchive
+from .ldso import get_shobj_deps
+from .libcache import LibraryCache
+from .archive import (BlockSource, SxArchive, get_block_settings, parse_block_info,
+                      parse_block_table)
+from .autotune import choose_compression
 from .assets import copy_asset_to_tempfile
 from .constants import *
 from .hooks import run_hooks
+from .report import Timings, get_archive_report, get_members_report
 from .version import __version__
 
 
+def expand_bundle_dir(template, content_hash):
+    """Expand a --bundle-dir template
+
+    "%h" is replaced with content_hash, and "%%" with "%".
+    """
+    def repl(m):
+        c = m.group(1)
+        if c == 'h':
+            return content_hash
+        if c == '%':
+            return '%'
+        raise InvalidInputError(f"Invalid bundle dir template {template!r}: unknown %{c}")
+
+    path = re.sub(r'%(.?)', repl, template).rstrip('/')
+
+    if not path.startswith('/'):
+        raise InvalidInputError(f"Bundle dir must be an absolute path: {path!r}")
+    # These have special meaning in RPATH
+    if ':' in path or '$' in path:
+        raise InvalidInputError(f"Bundle dir must not contain ':' or '$': {path!r}")
+    if len(path) + 1 + len(INTERP_FILENAME) >= MAX_INTERP_LEN:
+        raise InvalidInputError(f"Bundle dir is too long: {path!r}")
+
+    return path
+
+
+# Descriptions of the (release and debug) bootloaders, by debug flag: each is
+# only run for identification once
+_bootloader_ids = {}
+
+def _identify_bootloader(bootloader, debug):
+    """Returns a description of the bootloader, by running it for identification"""
+    desc = _bootloader_ids.get(debug)
+    if desc is None:
+        r = subprocess.run(
+                args = [bootloader],
+                env = dict(STATICX_BOOTLOADER_IDENTIFY='1'),
+                stderr = subprocess.PIPE,
+                text = True,
+                )
+        r.check_returncode()
+        lines = (line.split(':', 1)[1].strip() for line in r.stderr.splitlines())
+        desc = _bootloader_ids[debug] = " ".join(lines)
+    return desc
+
+
+class PreparedLibraries:
+    """Prepared libraries, shared by the generators of a batch
+
+    Preparing a library gives the same result for every program (with the
+    same options), so each library is prepared by the first generator to
+    need it, and the others wait for that. Modified copies are kept until
+    close().
+    """
+
+    def __init__(self):
+        self.tmpdir = mkdtemp(prefix='staticx-prepared-')
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def get(self, libpath, strip, prepare):
+        """Returns the result of prepare(libpath, tmpdir), once per library
+
+        tmpdir is a new directory for a modified copy of the library.
+        """
+        # Libraries are identified by path, for as long as they're unchanged
+        st = os.stat(libpath)
+        key = (libpath, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, strip)
+        with self._lock:
+            future = self._futures.get(key)
+            first = future is None
+            if first:
+                future = self._futures[key] = Future()
+
+        if first:
+            try:
+                future.set_result(prepare(libpath, mkdtemp(dir=self.tmpdir)))
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
+    def close(self):
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir)
+            self.tmpdir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 class StaticxGenerator:
     """StaticxGenerator is responsible for producing a staticx-ified executable.
     """
 
-    def __init__(self, prog, strip=False, compress=True, debug=False, cleanup=True):
+    def __init__(self, prog, strip=False, compress=True, debug=False, cleanup=True,
+                 bundle_dir=None, compression=None, jobs=None, cache=None,
+                 base=None, prog_name=None, compression_profile=None,
+                 size_budget=None, target_threads=None, prepared=None):
         """
         Parameters:
-        prog:   Dynamic executable to staticx
+        prog:   Dynamic executable to staticx: a path, or its contents as bytes
+                or a binary file object
         debug:  Run in debug mode (use debug bootloader)
+        bundle_dir: Fixed bundle directory template (see expand_bundle_dir())
+        compression: Archive compression format (one of COMPRESSIONS); if not
+                given, xz, or none if compress is False
+        jobs:   Number of libraries to prepare, and archive blocks to compress,
+                in parallel (default: the number of CPUs)
+        cache:  LibraryCache of prepared libraries, or None
+        base:   Previous output of staticx, whose unchanged compressed blocks
+                are reused rather than compressed again
+        prog_name: Name of the program in the archive (default: the base name
+                of prog; required if prog is bytes)
+        compression_profile: One of COMPRESSION_PROFILES, or 'auto' to choose
+                the profile (and the compression format, if not given) which
+                minimizes startup time; see autotune.choose_compression()
+        size_budget: Maximum archive size in bytes, for the 'auto' profile
+        target_threads: Number of CPUs the program will run with, for the
+                'auto' profile
+        prepared: PreparedLibraries shared with other generators, or None
         """
-        self.orig_prog = prog
+        # Only the 'auto' profile chooses the format
+        self.compression_choices = None
+        if compression is None and compress and compression_profile == 'auto':
+            self.compression_choices = [c for c in COMPRESSIONS if c != 'none']
+
+        if compression is None:
+            compression = DEFAULT_COMPRESSION if compress else 'none'
+        if compression not in COMPRESSIONS:
+            raise InvalidInputError(f"Invalid compression {compression!r} "
+                                    f"(choose from {', '.join(COMPRESSIONS)})")
+
+        if compression_profile is None:
+            compression_profile = DEFAULT_COMPRESSION_PROFILE
+        if compression_profile not in (*COMPRESSION_PROFILES, 'auto'):
+            raise InvalidInputError(f"Invalid compression profile {compression_profile!r} "
+                                    f"(choose from {', '.join(COMPRESSION_PROFILES)}, auto)")
+
+        if jobs is not None and jobs < 1:
+            raise InvalidInputError(f"Invalid number of jobs: {jobs}")
+        if target_threads is not None and target_threads < 1:
+            raise InvalidInputError(f"Invalid number of target threads: {target_threads}")
+
+        # Uncompressed archives have no blocks to reuse
+        if base and compression == 'none':
+            raise InvalidInputError("A base can only be used with a compressed archive")
+
         self.strip = strip
-        self.compress = compress
+        self.compression = compression
+        self.compression_profile = compression_profile
+        self.size_budget = size_budget
+        self.target_threads = target_threads
         self.debug = debug
         self.cleanup = cleanup
+        self.bundle_dir_template = bundle_dir
+        self.bundle_dir = None
+        self.cache = cache
+        self.prepared = prepared
+        self.base = base
 
         self._generate_called = False
         self._added_libs = {}
+        self._prog_needed = []
 
-        # Temporary output file (bootloader copy)
+        # The build report (see report), set by generate()
+        self.report = None
+        self.timings = Timings()
+        self._lib_reports = []
+
+        # Libraries are prepared on a pool of worker threads (most of the work
+        # is file I/O), but added to the archive in order.
+        self.jobs = jobs or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(self.jobs) if self.jobs > 1 else None
+
+        # Appends to the archive waiting for their library to be prepared:
+        # (future, append) where append is called with the future's result
+        self._pending = deque()
+
+        # Temporary bootloader copy
         self.tmpoutput = None
-        self.tmpprog = None
         self.tmpdir = mkdtemp(prefix='staticx-archive-')
 
-        f = NamedTemporaryFile(prefix='staticx-archive-', suffix='.tar')
-        self.sxar = SxArchive(fileobj=f, mode='w', compress=self.compress)
+        # The output file, written in place by generate(), and its archive
+        self._output = None
+        self._sxar = None
+
+        # The base file, open while its blocks may be reused
+        self._base_file = None
+
+        # The program is read from its original path (or a copy of its
+        # contents, if given as data), and modified in memory
+        try:
+            self.orig_prog = self._get_input_path(prog, prog_name)
+        except:
+            self._cleanup()
+            raise
+        self.prog_name = prog_name or basename(self.orig_prog)
+
+    @property
+    def sxar(self):
+        """The archive being built
+
+        Anything added to the archive comes after the libraries already added
+        by add_library(), so they are flushed first.
+
+        The archive is written directly to the output file, so it's only
+        available during generate().
+        """
+        if not self._sxar:
+            raise InternalError("The archive is only available during generate()")
+        self.flush()
+        return self._sxar
 
 
     def __enter__(self):
@@ -55,22 +255,60 @@ class StaticxGenerator:
             self._cleanup()
 
     def _cleanup(self):
+        if self._pool:
+            # Don't start preparing any more libraries
+            for future, _ in self._pending:
+                if future:
+                    future.cancel()
+            self._pool.shutdown()
+            self._pool = None
+        self._pending.clear()
+
         if self.tmpoutput:
             os.remove(self.tmpoutput)
             self.tmpoutput = None
 
-        if self.tmpprog:
-            os.remove(self.tmpprog)
-            self.tmpprog = None
-
         if self.tmpdir:
             shutil.rmtree(self.tmpdir)
             self.tmpdir = None
 
-        if self.sxar:
-            self.sxar.close()
-            self.sxar = None
+        if self._sxar:
+            self._sxar.close()
+            self._sxar = None
+
+        if self._output:
+            self._output.close()
+            os.remove(self._output.name)
+            self._output = None
+
+        if self._base_file:
+            self._base_file.close()
+            self._base_file = None
+
 
+    def _get_input_path(self, src, name):
+        """Returns the path of an input (the program or a library)
+
+        src may be a path, bytes, or a binary file object. Inputs given as
+        data are written to a temporary file named name (by default, the
+        base name of the file object's name): they are analyzed by path,
+        e.g. by hooks and to find their dependencies.
+        """
+        if isinstance(src, (str, os.PathLike)):
+            return os.fspath(src)
+
+        if name is None and isinstance(getattr(src, 'name', None), str):
+            name = basename(src.name)
+        if not name or '/' in name:
+            raise InvalidInputError("A file name is required for inputs given as data")
+
+        path = os.path.join(mkdtemp(dir=self.tmpdir), name)
+        with open(path, 'wb') as f:
+            if isinstance(src, (bytes, bytearray, memoryview)):
+                f.write(src)
+            else:
+                shutil.copyfileobj(src, f)
+        return path
 
     def _get_bootloader(self):
         # Get a temporary copy of the bootloader
@@ -87,16 +325,74 @@ class StaticxGenerator:
             raise FormatMismatchError(
                 f"Bootloader machine ({bldr_mach}) doesn't match program machine ({prog_mach})")
 
-        # Run the bootloader for identification
-        r = subprocess.run(
-                args = [bootloader],
-                env = dict(STATICX_BOOTLOADER_IDENTIFY='1'),
-                stderr = subprocess.PIPE,
-                text = True,
-                )
-        r.check_returncode()
-        lines = (line.split(':', 1)[1].strip() for line in r.stderr.splitlines())
-        logging.debug("Bootloader: " + " ".join(lines))
+        logging.debug("Bootloader: " + _identify_bootloader(bootloader, self.debug))
+
+    def _choose_compression(self):
+        """Choose the compression profile (and format), for the 'auto' profile
+
+        The choice is based on the program and its libraries, before the
+        archive is written.
+        """
+        if self.compression == 'none':
+            self.compression_profile = DEFAULT_COMPRESSION_PROFILE
+            return
+
+        paths = [self.orig_prog, *get_shobj_deps(self.orig_prog)]
+        paths += [p for p in self._added_libs.values() if p and p not in paths]
+        self.compression, self.compression_profile = choose_compression(
+                paths, self.compression_choices or [self.compression],
+                size_budget=self.size_budget,
+                target_threads=self.target_threads)
+
+    def _open_base(self):
+        """Returns a BlockSource of the base program's archive, or None
+
+        A base which can't be used (e.g. it doesn't exist yet, or was
+        compressed with different settings) is ignored, with a warning.
+        """
+        path = self.base
+        try:
+            with open_elf(path) as elf:
+                arange = elf.get_section_range(ARCHIVE_SECTION)
+                table = elf.get_section_data(BLOCKS_SECTION)
+                info = elf.get_section_data(BLOCK_INFO_SECTION)
+        except (OSError, InvalidInputError) as e:
+            logging.warning(f"Ignoring base {path}: {e}")
+            return None
+        if not arange or not table:
+            logging.warning(f"Ignoring base {path}: it has no compressed archive")
+            return None
+        if not info:
+            logging.warning(f"Ignoring base {path}: it has no block info "
+                            "(made by an older staticx?)")
+            return None
+
+        try:
+            info = parse_block_info(info)
+            blocks = parse_block_table(table)
+        except ArchiveError as e:
+            logging.warning(f"Ignoring base {path}: {e}")
+            return None
+
+        settings = get_block_settings(self.compression, self.compression_profile)
+        if info[0] != settings:
+            base = info[0]
+            logging.warning(f"Ignoring base {path}: it was compressed with "
+                            f"{base.get('compression')} ({base.get('profile')} profile, "
+                            f"level {base.get('level')}), not {self.compression} "
+                            f"({self.compression_profile} profile, level {settings['level']})")
+            return None
+
+        # The base may be the output path, which is only replaced at the end
+        self._base_file = open(path, 'rb')
+        try:
+            source = BlockSource(self._base_file, arange[0], blocks, info)
+        except ArchiveError as e:
+            logging.warning(f"Ignoring base {path}: {e}")
+            return None
+
+        logging.info(f"Reusing unchanged blocks of {path}")
+        return source
 
 
     def generate(self, output):
@@ -104,6 +400,9 @@ class StaticxGenerator:
 
         Parameters:
         output: Path where output file is written
+
+        Returns the build report (a dict; see report), which is also kept
+        in the report attribute.
         """
         # Only allow generate() to be called once per instance.
         # In the future we might relax this, but YAGNI for now.
@@ -111,53 +410,136 @@ class StaticxGenerator:
             raise InternalError("generate() already called")
         self._generate_called = True
 
-        # Work on a temp copy of the bootloader which becomes the output program
-        self._get_bootloader()
-
-        # First, learn things about the original program
-        orig_interp = get_prog_interp(self.orig_prog)
-        logging.info("Program interpreter: " + orig_interp)
-
-        # Now modify a copy of the user prog
-        self.tmpprog = copy_to_tempfile(self.orig_prog, prefix='staticx-prog-', delete=False).name
-        self._fixup_prog()
-
-        if self.strip:
-            # TODO: Now that we have ship separate debug/release bootloaders
-            # do we ever want and need to do this at staticx-time?
-            logging.info(f"Stripping bootloader {self.tmpoutput}")
-            strip_elf(self.tmpoutput)
-
-
-        # Build the archive to be appended
-        with self.sxar as ar:
-            run_hooks(self)
-
-            ar.add_program(self.tmpprog, basename(self.orig_prog))
-            ar.add_interp_symlink(orig_interp)
-
-            # Add all of the libraries
-            for libpath in get_shobj_deps(self.orig_prog):
-                self.add_library(libpath, exist_ok=True)
-
-        # errr...
-        arf = self.sxar.fileobj
-        arf.flush()
-
-        # Starting from the bootloader, append archive
-        elf_add_section(self.tmpoutput, ARCHIVE_SECTION, arf.name)
-
-        # Move the temporary output file to its final place
-        move_file(self.tmpoutput, output)
-        self.tmpoutput = None
-
-
-    def add_library(self, libpath, exist_ok=False):
+        if os.path.isdir(output):
+            raise DirectoryExistsError(output)
+        start = time.perf_counter()
+        measure = self.timings.measure
+
+        with measure('bootloader'):
+            # Work on a temp copy of the bootloader which becomes the output program
+            self._get_bootloader()
+
+            # First, learn things about the original program
+            orig_interp = get_prog_interp(self.orig_prog)
+            logging.info("Program interpreter: " + orig_interp)
+
+            if self.strip:
+                # TODO: Now that we have ship separate debug/release bootloaders
+                # do we ever want and need to do this at staticx-time?
+                logging.info(f"Stripping bootloader {self.tmpoutput}")
+                strip_elf(self.tmpoutput)
+
+        with measure('sections'):
+            # The output is written once, to a temporary file in the same
+            # directory, which then replaces the output path. The bootloader is
+            # copied, and the archive is streamed after it as it's built.
+            self._output = NamedTemporaryFile(prefix='.staticx-output-',
+                    dir=os.path.dirname(os.path.abspath(output)), delete=False)
+            appender = ELFSectionAppender(self._output, self.tmpoutput)
+
+        if self.compression_profile == 'auto':
+            with measure('autotune'):
+                self._choose_compression()
+
+        with measure('tar'):
+            # Aligned to a page (for uncompressed archives, see ARCHIVE_ALIGN)
+            arf = HashingWriter(appender.open_section(ARCHIVE_SECTION, align=ARCHIVE_ALIGN))
+            base = self._open_base() if self.base else None
+            self._sxar = SxArchive(fileobj=arf, mode='w', compression=self.compression,
+                                   base=base, jobs=self.jobs,
+                                   profile=self.compression_profile,
+                                   timings=self.timings)
+
+            # Build the archive to be appended
+            with self.sxar:
+                with measure('hooks'):
+                    run_hooks(self)
+
+                self.sxar.add_interp_symlink(orig_interp)
+
+                # Add all of the libraries
+                with measure('dependencies'):
+                    deps = get_shobj_deps(self.orig_prog)
+                for libpath in deps:
+                    self.add_library(libpath, exist_ok=True)
+
+                # The program is added last, as a fixed bundle dir may depend on
+                # everything else in the archive
+                with measure('program'):
+                    prog_data = self._fixup_prog()
+                self.sxar.add_program(self.orig_prog, self.prog_name, data=prog_data)
+            archive_size = arf.tell()
+            arf.fileobj.close()
+
+        # The digest identifies the archive contents, e.g. for the bootloader
+        # extraction cache
+        digest = arf.hash.hexdigest()
+        logging.info(f"Archive digest: {digest}")
+        if base is not None:
+            reused, total = self._sxar.block_stats
+            logging.info(f"Reused {reused} of {total} blocks from {self.base}")
+
+        with measure('sections'):
+            appender.add_section(DIGEST_SECTION, digest.encode())
+            if self._sxar.block_table:
+                appender.add_section(BLOCKS_SECTION, self._sxar.block_table)
+                appender.add_section(BLOCK_INFO_SECTION, self._sxar.block_info)
+            appender.add_section(INDEX_SECTION, self._sxar.index)
+            if self.bundle_dir:
+                appender.add_section(BUNDLE_DIR_SECTION, self.bundle_dir.encode())
+            appender.close()
+
+            # Move the finished output file to its final place
+            self._output.close()
+            make_executable(self._output.name)
+            os.replace(self._output.name, output)
+            self._output = None
+
+        self.report = self._get_report(output, archive_size, time.perf_counter() - start)
+        return self.report
+
+    def _get_report(self, output, archive_size, wall_time):
+        """Returns the build report (see report)"""
+        blocks = self._sxar.blocks
+        raw_size = sum(usize for _, _, usize in blocks) if blocks is not None else archive_size
+
+        libraries = []
+        for lib in self._lib_reports:
+            lib = dict(lib)
+            for k in ('wall', 'cpu'):
+                if k in lib:
+                    lib[k] = round(lib[k], 6)
+            libraries.append(lib)
+
+        return dict(
+            staticx_version = __version__,
+            prog_name = self.prog_name,
+            output = output,
+            compression = self.compression,
+            compression_profile = self.compression_profile,
+            output_size = os.path.getsize(output),
+            **get_archive_report(archive_size, raw_size),
+            wall_time = round(wall_time, 6),
+            phases = self.timings.get_report(),
+            libraries = libraries,
+            members = get_members_report(self._sxar.entries, blocks),
+        )
+
+
+    def add_library(self, libpath, exist_ok=False, name=None):
         """Add a library to the archive
 
         The library will be added with its base name.
         Symlinks will also be added and followed.
+
+        libpath may also be the library's contents, as bytes or a binary
+        file object, in which case name gives its file name.
+
+        The library is prepared (see _prepare_library()) in the background;
+        call flush() to wait for it to be added to the archive.
         """
+        libpath = self._get_input_path(libpath, name)
+
         # See if we've already handled this library
         libname = basename(libpath)
         if libname in self._added_libs:
@@ -173,43 +555,117 @@ class StaticxGenerator:
         # We're left with a real file at this point
         assert not islink(libpath)
 
-        # Lazily make a copy of the library before modifying it
-        def work_on_copy():
-            nonlocal libpath
+        arcname = basename(libpath)
+        if arcname in self._added_libs:
+            raise InternalError(
+                f"libname {libname} absent from _added_libs but library {arcname} present")
+        self._added_libs[arcname] = libpath
+
+        def append(path):
+            # Finally, add it to the archive.
+            logging.info(f"Adding {path} as {arcname}")
+            self._sxar.add_file(path, arcname=arcname)
+
+        lib_report = dict(name=arcname, path=libpath)
+        self._lib_reports.append(lib_report)
 
-            tmplib = os.path.join(self.tmpdir, basename(libpath))
-            logging.info(f"Copying {libpath} to {tmplib}")
-            shutil.copy(libpath, tmplib)
-            libpath = tmplib
+        def prepare():
+            with self.timings.measure('prepare') as times:
+                result = self._prepare_library(libpath)
+            lib_report.update(times)
+            return result
 
-            nonlocal work_on_copy
-            def work_on_copy(): pass
+        if self._pool:
+            future = self._pool.submit(prepare)
+        else:
+            future = Future()
+            future.set_result(prepare())
+        self._enqueue(future, append)
 
 
+    def _prepare_library(self, libpath):
+        """Audit, fix up and strip a library before adding it to the archive
+
+        This runs on the worker pool, and must not touch the archive.
+        Returns the path of the file to add: libpath, or a modified copy.
+        """
+        if self.prepared:
+            return self.prepared.get(libpath, self.strip, self._prepare_library_in)
+        return self._prepare_library_in(libpath, self.tmpdir)
+
+    def _prepare_library_in(self, libpath, tmpdir):
+        """Prepare a library, writing any modified copy to tmpdir"""
+        if not self.cache:
+            return self._do_prepare_library(libpath, tmpdir)
+
+        key = self.cache.get_key(libpath, strip=self.strip)
+        tmplib = os.path.join(tmpdir, basename(libpath))
+        result = self.cache.get(key, libpath, tmplib)
+        if result:
+            logging.info(f"Using cached prepared library for {libpath}")
+            return result
+
+        result = self._do_prepare_library(libpath, tmpdir)
+        self.cache.put(key, libpath, result)
+        return result
+
+    def _do_prepare_library(self, libpath, tmpdir):
+        editor = None
+
         # Audit library to check for problems
         try:
             self.check_library_rpath(libpath)
         except (UnsupportedRpathError, UnsupportedRunpathError):
             # Fix it by removing
-            work_on_copy()
             logging.info(f"Removing RPATH/RUNPATH from library {libpath}")
-            remove_rpath(libpath)
+            editor = editor or ELFEditor(libpath)
+            editor.remove_rpath()
 
         # Strip the library
         if self.strip:
-            work_on_copy()
             logging.info(f"Stripping library {libpath}")
-            strip_elf(libpath)
+            editor = editor or ELFEditor(libpath)
+            editor.strip()
 
+        if editor is None:
+            return libpath
 
-        # Finally, add it to the archive.
-        arcname = basename(libpath)
-        logging.info(f"Adding {libpath} as {arcname}")
-        self.sxar.add_file(libpath, arcname=arcname)
-        if arcname in self._added_libs:
-            raise InternalError(
-                f"libname {libname} absent from _added_libs but library {arcname} present")
-        self._added_libs[arcname] = libpath
+        # Write the modified library to a copy, in one pass
+        tmplib = os.path.join(tmpdir, basename(libpath))
+        logging.info(f"Writing modified {libpath} to {tmplib}")
+        editor.save(tmplib)
+        return tmplib
+
+
+    def _enqueue(self, future, append):
+        """Queue an append to the archive, to be done when future completes
+
+        Appends are done in the order they are queued, regardless of the
+        order in which their futures complete, so the archive is the same as
+        that of a serial build. Until generate() creates the archive, they
+        just accumulate.
+        """
+        self._pending.append((future, append))
+        if self._sxar:
+            self._append_ready()
+
+    def _append_ready(self, wait=False):
+        """Do the queued appends whose futures have completed, in order"""
+        while self._pending:
+            future, append = self._pending[0]
+            if future and not wait and not future.done():
+                break
+            self._pending.popleft()
+            result = None
+            if future:
+                # Waiting for the library to be prepared
+                with self.timings.measure('prepare'):
+                    result = future.result()
+            append(result)
+
+    def flush(self):
+        """Wait for all libraries to be prepared and added to the archive"""
+        self._append_ready(wait=True)
 
 
     def _handle_lib_symlinks(self, libpath):
@@ -230,10 +686,11 @@ class StaticxGenerator:
             if arcname == target:
                 continue
 
-            # Add a symlink.
+            # Add a symlink (in order with the libraries being prepared).
             # At this point the target probably doesn't exist, but that doesn't matter yet.
             logging.info(f"Adding Symlink {arcname} => {target}")
-            self.sxar.add_symlink(arcname, target)
+            self._enqueue(None, lambda _, arcname=arcname, target=target:
+                          self._sxar.add_symlink(arcname, target))
 
             if arcname in self._added_libs:
                 raise InternalError(
@@ -277,52 +734,263 @@ class StaticxGenerator:
 
 
 
-    def _fixup_prog(self):
-        """Fixup our temporary copy of the user's program"""
+    def add_prog_needed(self, libname):
+        """Make the program depend on a library (DT_NEEDED)
+
+        The program is modified later, by _fixup_prog(). The library must be
+        added to the archive separately.
+        """
+        self._prog_needed.append(libname)
 
-        # Strip user prog before modifying it
-        if self.strip:
-            logging.info(f"Stripping prog {self.tmpprog}")
-            strip_elf(self.tmpprog)
 
-        # Set long dummy INTERP and RPATH in the executable to allow plenty of space
-        # for bootloader to patch them at runtime, without the reording complexity
-        # that patchelf has to do.
-        new_interp = 'i' * MAX_INTERP_LEN
-        new_rpath = 'r' * MAX_RPATH_LEN
-        patch_elf(self.tmpprog, interpreter=new_interp, rpath=new_rpath,
-                  force_rpath=True, no_default_lib=True)
+    def _fixup_prog(self):
+        """Fixup the user's program, in memory
 
+        Returns the contents of the modified program.
+        """
+        editor = ELFEditor(self.orig_prog)
+
+        if self.bundle_dir_template:
+            # The bundle will always be extracted to the same place, so set
+            # the final INTERP and RPATH now; the bootloader won't patch them.
+            h = self.sxar.content_hash()
+            h.update(hashlib.sha256(editor.data).digest())
+            self.bundle_dir = expand_bundle_dir(self.bundle_dir_template, h.hexdigest())
+            logging.info(f"Bundle dir: {self.bundle_dir}")
+
+            new_interp = os.path.join(self.bundle_dir, INTERP_FILENAME)
+            new_rpath = self.bundle_dir
+
+            # If the bundle dir can't be used, the bootloader extracts to a
+            # tmpdir and patches them after all, so leave as much space as
+            # usual: after the NUL terminator of INTERP, and as trailing
+            # slashes (which the dynamic linker ignores) in RPATH.
+            new_interp += '\0' * (MAX_INTERP_LEN - len(new_interp))
+            new_rpath += '/' * (MAX_RPATH_LEN - len(new_rpath))
+        else:
+            # Set long dummy INTERP and RPATH in the executable to allow plenty of space
+            # for bootloader to patch them at runtime, without the reording complexity
+            # that moving them would require.
+            new_interp = 'i' * MAX_INTERP_LEN
+            new_rpath = 'r' * MAX_RPATH_LEN
 
-def generate(prog, output, libs=None, strip=False, compress=True, debug=False):
+        if self.strip:
+            logging.info(f"Stripping prog {self.orig_prog}")
+            editor.strip()
+        editor.set_interp(new_interp)
+        editor.set_rpath(new_rpath, force_rpath=True)
+        if self._prog_needed:
+            editor.add_needed(self._prog_needed)
+        editor.set_no_default_lib()
+        return bytes(editor.tobytes())
+
+
+def _describe_input(src):
+    """Describe an input (path or data) for logging"""
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return f"<{len(src)} bytes>"
+    return repr(getattr(src, 'name', src))
+
+
+def generate(prog, output, libs=None, strip=False, compress=True, debug=False,
+             bundle_dir=None, compression=None, jobs=None, cache_dir=None,
+             cache_max_size=DEFAULT_CACHE_MAX_SIZE, base=None, prog_name=None,
+             compression_profile=None, size_budget=None, target_threads=None):
     """Main API: Generate a staticx executable
 
     Parameters:
-    prog:   Dynamic executable to staticx
+    prog:   Dynamic executable to staticx (a path, bytes, or a binary file
+            object)
     output: Path to result
-    libs: Extra libraries to include
+    libs: Extra libraries to include (paths or binary file objects)
     strip: Strip binaries to reduce size
     debug: Run in debug mode (use debug bootloader)
+    bundle_dir: Extract to this fixed directory rather than a temporary one
+                ("%h" is replaced with a hash of the bundle contents)
+    compression: Archive compression format: xz (default), zstd, lz4, or none
+                (overrides compress)
+    jobs: Number of libraries to prepare, and archive blocks to compress, in
+                parallel (default: number of CPUs)
+    cache_dir: Directory in which to cache prepared libraries across runs
+                (default: no cache)
+    cache_max_size: Size in bytes to which the cache is limited
+    base: Previous output (e.g. output itself) whose unchanged compressed
+                blocks are reused, to speed up rebuilds
+    prog_name: Name of the program (default: the base name of prog)
+    compression_profile: size, balanced (default), startup, or auto, to
+                choose the one (and the compression format, if not given)
+                with the shortest estimated startup time
+    size_budget: Maximum archive size in bytes, for the auto profile
+    target_threads: Number of CPUs the program will run with, for the auto
+                profile (default: 2)
+
+    Returns the build report: a dict of the time taken by each phase of the
+    build, and the sizes of the output, the archive, and each of its members
+    (see report).
     """
 
     logging.info(f"Running StaticX version {__version__}")
     verify_tools()
     logging.debug("Arguments:")
-    logging.debug(f"  prog:      {prog!r}")
+    logging.debug(f"  prog:      {_describe_input(prog)}")
     logging.debug(f"  output:    {output!r}")
-    logging.debug(f"  libs:      {libs!r}")
+    logging.debug(f"  libs:      [{', '.join(_describe_input(lib) for lib in libs or [])}]")
     logging.debug(f"  strip:     {strip!r}")
     logging.debug(f"  compress:  {compress!r}")
+    logging.debug(f"  compression: {compression!r}")
+    logging.debug(f"  compression_profile: {compression_profile!r}")
+    logging.debug(f"  size_budget: {size_budget!r}")
+    logging.debug(f"  target_threads: {target_threads!r}")
     logging.debug(f"  debug:     {debug!r}")
-
-    gen = StaticxGenerator(
-            prog=prog,
-            strip=strip,
-            compress=compress,
-            debug=debug,
-            )
+    logging.debug(f"  bundle_dir: {bundle_dir!r}")
+    logging.debug(f"  jobs:      {jobs!r}")
+    logging.debug(f"  cache_dir: {cache_dir!r}")
+    logging.debug(f"  base:      {base!r}")
+
+    cache = None
+    if cache_dir:
+        cache = LibraryCache(cache_dir, max_size=cache_max_size)
+
+    report = _build(prog, output,
+           libs = libs,
+           strip = strip,
+           compress = compress,
+           debug = debug,
+           bundle_dir = bundle_dir,
+           compression = compression,
+           jobs = jobs,
+           cache = cache,
+           base = base,
+           prog_name = prog_name,
+           compression_profile = compression_profile,
+           size_budget = size_budget,
+           target_threads = target_threads,
+           )
+
+    if cache:
+        logging.info(f"Library cache: {cache.hits} hits, {cache.misses} misses")
+        cache.evict()
+
+    return report
+
+
+def _build(prog, output, libs=None, **kwargs):
+    """Generate a staticx executable, with StaticxGenerator arguments
+
+    Returns the build report.
+    """
+    gen = StaticxGenerator(prog=prog, **kwargs)
     with gen:
         for lib in (libs or []):
             gen.add_library(lib)
 
-        gen.generate(output=output)
+        return gen.generate(output=output)
+
+
+# Options of generate() which can be given for each program of a batch
+BATCH_OPTIONS = ('libs', 'strip', 'compress', 'debug', 'bundle_dir', 'compression',
+                 'base', 'prog_name', 'compression_profile', 'size_budget',
+                 'target_threads')
+
+BatchResult = namedtuple('BatchResult',
+        ['prog', 'output', 'size', 'seconds', 'error', 'report'])
+BatchResult.__doc__ = """The result of generating one program of a batch
+
+size:       Size of the output in bytes, or None if it failed
+seconds:    Time taken to generate it
+error:      The Error (or OSError) which it failed with, or None
+report:     The build report (see generate()), or None if it failed
+"""
+
+
+def generate_many(builds, jobs=None, cache_dir=None,
+                  cache_max_size=DEFAULT_CACHE_MAX_SIZE):
+    """Generate several staticx executables, sharing the work common to them
+
+    The tools are verified, and the bootloader identified, once; the
+    dependencies of all of the programs are resolved up front; and each
+    library is prepared once, for all of the programs which use it. The
+    programs are generated in parallel.
+
+    Parameters:
+    builds: Iterable of dicts, one for each program, with its prog and output
+            and optionally any of the other arguments of generate() in
+            BATCH_OPTIONS
+    jobs: Number of programs to generate in parallel, and of libraries to
+            prepare and archive blocks to compress between them (default:
+            number of CPUs)
+    cache_dir: Directory in which to cache prepared libraries across runs
+            (default: no cache)
+    cache_max_size: Size in bytes to which the cache is limited
+
+    A program which fails doesn't stop the others. Returns a list of
+    BatchResult, in the order of builds.
+    """
+    builds = [dict(b) for b in builds]
+    outputs = set()
+    for b in builds:
+        if 'prog' not in b or 'output' not in b:
+            raise InvalidInputError(f"Batch build without a prog and output: {b!r}")
+        unknown = set(b) - {'prog', 'output', *BATCH_OPTIONS}
+        if unknown:
+            raise InvalidInputError(f"Invalid batch build options: {', '.join(sorted(unknown))}")
+        output = os.path.abspath(b['output'])
+        if output in outputs:
+            raise InvalidInputError(f"Output {b['output']} is given more than once")
+        outputs.add(output)
+
+    if jobs is not None and jobs < 1:
+        raise InvalidInputError(f"Invalid number of jobs: {jobs}")
+    jobs = jobs or os.cpu_count() or 1
+
+    logging.info(f"Running StaticX version {__version__}")
+    verify_tools()
+
+    # Resolve the dependencies of all of the programs (which are memoized for
+    # the builds), to see how many libraries they share
+    libs = set()
+    for b in builds:
+        if not isinstance(b['prog'], (str, os.PathLike)):
+            continue
+        try:
+            libs.update(get_shobj_deps(os.fspath(b['prog'])))
+        except (Error, OSError):
+            # Left for its build to report
+            pass
+    logging.info(f"Generating {len(builds)} programs, using {len(libs)} unique libraries")
+
+    cache = None
+    if cache_dir:
+        cache = LibraryCache(cache_dir, max_size=cache_max_size)
+
+    # The jobs are divided between the programs generated in parallel
+    workers = max(1, min(jobs, len(builds)))
+    gen_jobs = max(1, jobs // workers)
+
+    with PreparedLibraries() as prepared:
+        with ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(_batch_build, b, gen_jobs, cache, prepared)
+                       for b in builds]
+            results = [f.result() for f in futures]
+
+    if cache:
+        logging.info(f"Library cache: {cache.hits} hits, {cache.misses} misses")
+        cache.evict()
+
+    return results
+
+
+def _batch_build(build, jobs, cache, prepared):
+    """Generate one program of a batch, returning its BatchResult"""
+    build = dict(build)
+    prog = build.pop('prog')
+    output = build.pop('output')
+
+    start = time.monotonic()
+    try:
+        report = _build(prog, output, jobs=jobs, cache=cache, prepared=prepared, **build)
+    except (Error, OSError) as e:
+        logging.error(f"Failed to generate {output}: {e}")
+        return BatchResult(prog, output, None, time.monotonic() - start, e, None)
+    return BatchResult(prog, output, report['output_size'], time.monotonic() - start,
+                       None, report)
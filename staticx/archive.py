@@ -1,69 +1,744 @@
+import bisect
+import importlib
+import io
+import json
+import os
 import tarfile
 import logging
 import lzma
+import hashlib
+import struct
+import threading
+from collections import Counter, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 from os.path import basename
 
+from . import xzstream
 from .bcjfilter import get_bcj_filter_arch
-from .utils import get_symlink_target, make_mode_executable
+from .elf import ABI_IDENT_SIZE, parse_abi_ident
+from .utils import get_symlink_target, make_mode_executable, sha256_fileobj
 from .constants import *
 from .errors import *
 
 
-def get_bcj_filter():
-    arch = get_bcj_filter_arch()
-    if not arch:
-        return None, ''
+def get_xz_filters(bcj_arch=None, preset=6, dict_size=XZ_DICT_MAX):
+    """Returns the xz filter chain (see xzstream.compress()) for data which is
+    mostly machine code for the BCJ filter bcj_arch (or not, if None)"""
+    filters = []
 
-    # Get the lzma module constant name and value
-    filt_name = 'FILTER_' + arch
-    filt = getattr(lzma, filt_name)
+    if bcj_arch:
+        filters.append(dict(arch=bcj_arch))
 
-    return filt, filt_name
+    # The last filter in the chain must be a compression filter.
+    filters.append(dict(id=lzma.FILTER_LZMA2, preset=preset,
+                        dict_size=min(dict_size, XZ_DICT_MAX)))
+    return filters
 
 
-def get_xz_filters():
-    filters = []
+# Settings of each compression profile: the block size, and the compression
+# level (or preset) of each format. Within a format, the level hardly affects
+# decompression speed, but smaller blocks can be decompressed by more threads
+# at once (and larger ones compress better).
+COMPRESSION_PROFILE_SETTINGS = {
+    'size':     (8 << 20, dict(xz=9 | lzma.PRESET_EXTREME, zstd=22, lz4=12)),
+    'balanced': (BLOCK_SIZE, dict(xz=6, zstd=19, lz4=12)),
+    'startup':  (1 << 20, dict(xz=6, zstd=9, lz4=9)),
+}
+
+# Regular files of at least 1/MEMBER_BLOCK_FRACTION of the block size start a
+# new block, so the blocks of each such file don't depend on what precedes it
+MEMBER_BLOCK_FRACTION = 16
+
+def get_block_settings(compression, profile, block_size=None):
+    """Returns the settings which determine the compressed blocks of an archive
+
+    Blocks are only reused from a base archive (see BlockSource) compressed
+    with the same settings.
+    """
+    profile_block_size, levels = COMPRESSION_PROFILE_SETTINGS[profile]
+    return dict(
+        format = BLOCK_INFO_FORMAT,
+        compression = compression,
+        profile = profile,
+        level = levels.get(compression),
+        block_size = block_size or profile_block_size,
+    )
+
+
+def _import_codec(module, extra):
+    """Import the (optional) module implementing a compression format"""
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise MissingModuleError(module, extra) from None
+
+
+class BlockWriter(io.BufferedIOBase):
+    """Writes data as a series of independently-decodable compressed streams
+
+    The data is split into blocks of block_size (uncompressed) bytes, each of
+    which is compressed as a complete stream (or frame) by compress_block().
+    The concatenation of these streams is itself a valid compressed file, but
+    the blocks can also be located (via the block table) and decompressed in
+    parallel.
+
+    Formats with BCJ filters choose one for each block, by the machine code
+    marked with mark_code() that makes up most of it.
+
+    Large members start a new block (see start_member()), so a change to the
+    size of one member doesn't move the block boundaries in those after it,
+    whose blocks can then be reused from a base.
+    """
+
+    # Key of the format's level in COMPRESSION_PROFILE_SETTINGS
+    name = None
+
+    # Whether the format has BCJ filters
+    bcj = False
+
+    def __init__(self, fileobj, block_size=None, base=None, jobs=1,
+                 profile=DEFAULT_COMPRESSION_PROFILE, timings=None):
+        """
+        Parameters:
+        fileobj:    File object to which compressed data is written (not closed
+                    by this class)
+        block_size: Uncompressed size of each block (default: that of profile)
+        base:       BlockSource of a previous archive, whose blocks are reused
+                    rather than compressing identical data again
+        jobs:       Number of blocks to compress in parallel
+        profile:    Compression profile (one of COMPRESSION_PROFILES)
+        timings:    report.Timings in which compression is measured, or None
+        """
+        self.settings = get_block_settings(self.name, profile, block_size)
+        self.fileobj = fileobj
+        self.block_size = self.settings['block_size']
+        self.level = self.settings['level']
+        self.timings = timings
 
-    # Get a BCJ filter for the current architecture
-    bcj_filter, bcj_filter_name = get_bcj_filter()
-    if bcj_filter:
-        logging.info(f"Using XZ BCJ filter {bcj_filter_name}")
-        filters.append(dict(id=bcj_filter))
+        if base is not None and base.settings != self.settings:
+            raise ValueError("The base archive was compressed with different settings")
+        self.base = base
+
+        # Number of blocks reused from base
+        self.reused = 0
+
+        # Number of blocks compressed with each BCJ filter
+        self.bcj_blocks = Counter()
+
+        # (SHA-256 digest of the data, BCJ filter arch) of each block
+        self.block_keys = []
+
+        # (start, end, BCJ filter arch) of the machine code not yet compressed
+        self._code = deque()
+        self._block_start = 0
+
+        # Blocks are compressed on a pool of threads (the compressors release
+        # the GIL), and written in order. At most 2*jobs blocks are held in
+        # memory: (compressed data or future, uncompressed size)
+        self._pool = ThreadPoolExecutor(jobs) if jobs > 1 else None
+        self._max_pending = 2 * jobs if self._pool else 0
+        self._pending = deque()
+
+        # List of (compressed offset, compressed size, uncompressed size), and
+        # the uncompressed offset of each block
+        self.blocks = []
+        self._ustarts = []
+
+        self._buf = bytearray()
+        self._upos = 0
+        self._cpos = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._upos
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        self._buf += data
+        self._upos += len(data)
+
+        while len(self._buf) >= self.block_size:
+            self._write_block(self._buf[:self.block_size])
+            del self._buf[:self.block_size]
+
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.end_block()
+                while self._pending:
+                    self._flush_block()
+            finally:
+                if self._pool:
+                    for cdata, _ in self._pending:
+                        if isinstance(cdata, Future):
+                            cdata.cancel()
+                    self._pending.clear()
+                    self._pool.shutdown()
+                    self._pool = None
+        super().close()
+
+    def compress_block(self, data, bcj_arch=None):
+        """Returns data compressed as a complete stream
+
+        bcj_arch is the BCJ filter to use, for formats which have them.
+        """
+        raise NotImplementedError()
+
+    def _measure(self):
+        if self.timings is None:
+            return nullcontext()
+        return self.timings.measure('compression')
+
+    def _compress_block(self, data, bcj_arch):
+        with self._measure():
+            return self.compress_block(data, bcj_arch)
+
+    def end_block(self):
+        """End the current block, so the data written next starts a new one"""
+        if self._buf:
+            self._write_block(self._buf)
+            self._buf = bytearray()
+
+    def start_member(self, size):
+        """Start a new block for a member of size bytes, if it's large
+
+        This must be called before the member (including its header) is
+        written.
+        """
+        if size >= self.block_size // MEMBER_BLOCK_FRACTION:
+            self.end_block()
+
+    def mark_code(self, upos, size, bcj_arch):
+        """Mark the size bytes at (uncompressed) position upos as machine code
+        for the BCJ filter bcj_arch (see bcjfilter)
+
+        Ranges must be marked in order, before their data is written.
+        """
+        if self.bcj and size:
+            self._code.append((upos, upos + size, bcj_arch))
+
+    def _get_block_bcj_arch(self, start, end):
+        """Returns the BCJ filter for the block [start, end): that of the
+        machine code which makes up most of it, unless other data does"""
+        while self._code and self._code[0][1] <= start:
+            self._code.popleft()
+
+        sizes = Counter()
+        for cstart, cend, arch in self._code:
+            if cstart >= end:
+                break
+            sizes[arch] += min(cend, end) - max(cstart, start)
+        if not sizes:
+            return None
+
+        arch, size = sizes.most_common(1)[0]
+        other = end - start - sum(sizes.values())
+        return arch if size > other else None
+
+    def _write_block(self, data):
+        data = bytes(data)
+        start = self._block_start
+        self._block_start += len(data)
+        bcj_arch = self._get_block_bcj_arch(start, self._block_start)
+        digest = hashlib.sha256(data).digest()
+        self.block_keys.append((digest, bcj_arch))
+
+        cdata = None
+        if self.base is not None:
+            cdata = self.base.get(digest, bcj_arch)
+        if cdata is None:
+            if bcj_arch and not self.bcj_blocks[bcj_arch]:
+                logging.info(f"Using XZ BCJ filter {bcj_arch}")
+            self.bcj_blocks[bcj_arch] += 1
+            if self._pool:
+                cdata = self._pool.submit(self._compress_block, data, bcj_arch)
+            else:
+                cdata = self._compress_block(data, bcj_arch)
+        else:
+            self.reused += 1
+
+        self._pending.append((cdata, len(data)))
+        while len(self._pending) > self._max_pending:
+            self._flush_block()
+
+    def _flush_block(self):
+        """Write the oldest pending block"""
+        cdata, usize = self._pending.popleft()
+        if isinstance(cdata, Future):
+            # Waiting for compression
+            with self._measure():
+                cdata = cdata.result()
+        self.fileobj.write(cdata)
+        self._ustarts.append(self._ustarts[-1] + self.blocks[-1][2] if self.blocks else 0)
+        self.blocks.append((self._cpos, len(cdata), usize))
+        self._cpos += len(cdata)
+
+    def get_block_table(self):
+        """Get the binary block table, for BLOCKS_SECTION
+
+        All values are little-endian:
+            char     magic[4]       BLOCK_TABLE_MAGIC
+            uint32_t version        BLOCK_TABLE_VERSION
+            uint64_t count
+        Followed by count entries of:
+            uint64_t offset         Offset of compressed block in archive
+            uint64_t size           Size of compressed block
+            uint64_t usize          Size of uncompressed block
+        """
+        table = struct.pack('<4sIQ', BLOCK_TABLE_MAGIC, BLOCK_TABLE_VERSION,
+                            len(self.blocks))
+        for block in self.blocks:
+            table += struct.pack('<QQQ', *block)
+        return table
+
+    def get_block_offset(self, upos):
+        """Get the compressed offset of the block containing uncompressed
+        position upos"""
+        i = max(bisect.bisect_right(self._ustarts, upos) - 1, 0)
+        return self.blocks[i][0]
+
+    def get_block_info(self):
+        """Get the block info, for BLOCK_INFO_SECTION (see pack_block_info())"""
+        return pack_block_info(self.settings, self.block_keys)
+
+
+class XZBlockWriter(BlockWriter):
+    name = 'xz'
+    bcj = True
+
+    def compress_block(self, data, bcj_arch=None):
+        # A larger dictionary than a block is no use
+        filters = get_xz_filters(bcj_arch, preset=self.level, dict_size=self.block_size)
+        return xzstream.compress(data, filters)
+
+
+class ZstdBlockWriter(BlockWriter):
+    name = 'zstd'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.zstandard = _import_codec('zstandard', 'zstd')
+        # A compressor can't be used by several threads at once
+        self._local = threading.local()
+
+    def compress_block(self, data, bcj_arch=None):
+        cctx = getattr(self._local, 'cctx', None)
+        if cctx is None:
+            cctx = self._local.cctx = self.zstandard.ZstdCompressor(
+                    level=self.level, write_checksum=True, write_content_size=True)
+        return cctx.compress(data)
+
+
+class LZ4BlockWriter(BlockWriter):
+    name = 'lz4'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lz4frame = _import_codec('lz4.frame', 'lz4')
+
+    def compress_block(self, data, bcj_arch=None):
+        return self.lz4frame.compress(
+            data,
+            compression_level = self.level,
+            content_checksum = True,
+            store_size = True,
+        )
+
+
+BLOCK_WRITERS = {
+    'xz':   XZBlockWriter,
+    'zstd': ZstdBlockWriter,
+    'lz4':  LZ4BlockWriter,
+}
+
+
+def detect_compression(data):
+    """Returns the compression format of data (by its magic number), or None"""
+    for name, magic in COMPRESSION_MAGICS.items():
+        if data.startswith(magic):
+            return name
+    return None
+
+
+def decompress(data):
+    """Decompress data, which may consist of several concatenated streams"""
+    compression = detect_compression(data)
+    if compression == 'xz':
+        return xzstream.decompress(data)
+    if compression == 'zstd':
+        zstandard = _import_codec('zstandard', 'zstd')
+        return zstandard.ZstdDecompressor().decompressobj(
+                read_across_frames=True).decompress(data)
+    if compression == 'lz4':
+        lz4frame = _import_codec('lz4.frame', 'lz4')
+        with lz4frame.open(io.BytesIO(data)) as f:
+            return f.read()
+    return data
+
+
+def open_decompressed(fileobj):
+    """Returns a file object reading the decompressed contents of fileobj"""
+    pos = fileobj.tell()
+    compression = detect_compression(fileobj.read(8))
+    fileobj.seek(pos)
+
+    if compression == 'xz':
+        return xzstream.open(fileobj)
+    if compression == 'zstd':
+        zstandard = _import_codec('zstandard', 'zstd')
+        return zstandard.ZstdDecompressor().stream_reader(
+                fileobj, read_across_frames=True, closefd=False)
+    if compression == 'lz4':
+        lz4frame = _import_codec('lz4.frame', 'lz4')
+        return lz4frame.open(fileobj, mode='r')
+    return None
+
+
+def parse_block_table(data):
+    """Parse a block table (see BlockWriter.get_block_table())
+
+    Returns a list of (offset, size, usize) tuples.
+    """
+    magic, version, count = struct.unpack_from('<4sIQ', data)
+    if magic != BLOCK_TABLE_MAGIC or version != BLOCK_TABLE_VERSION:
+        raise ArchiveError("Invalid block table")
+    return [struct.unpack_from('<QQQ', data, 16 + 24*i) for i in range(count)]
+
+
+def pack_block_info(settings, keys):
+    """Pack the block info, for BLOCK_INFO_SECTION
+
+    This is JSON, giving the settings the blocks were compressed with (see
+    get_block_settings()), and the hex SHA-256 digest of the data and BCJ
+    filter arch of each block.
+    """
+    info = dict(
+        settings = settings,
+        blocks = [[digest.hex(), bcj_arch] for digest, bcj_arch in keys],
+    )
+    return json.dumps(info, sort_keys=True, separators=(',', ':')).encode()
+
+
+def parse_block_info(data):
+    """Parse the block info (see pack_block_info())
+
+    Returns the settings, and a list of (digest, BCJ filter arch) tuples.
+    """
+    try:
+        info = json.loads(data)
+        keys = [(bytes.fromhex(digest), bcj_arch) for digest, bcj_arch in info['blocks']]
+        settings = info['settings']
+    except (ValueError, TypeError, KeyError) as e:
+        raise ArchiveError(f"Invalid block info: {e}") from None
+    if not isinstance(settings, dict):
+        raise ArchiveError("Invalid block info: bad settings")
+    return settings, keys
+
+
+class BlockSource:
+    """The compressed blocks of an existing archive, by content
+
+    This lets a BlockWriter reuse the blocks of a previous build whose data is
+    unchanged, so only what differs is compressed again. Blocks are found by
+    the digests in the block info, and only read from fileobj (which must stay
+    open) and decompressed to verify them when they're reused.
+    """
+
+    def __init__(self, fileobj, offset, blocks, info):
+        """
+        Parameters:
+        fileobj:    File object containing the archive
+        offset:     Offset of the archive in fileobj
+        blocks:     Block table of the archive (see parse_block_table())
+        info:       Block info of the archive (see parse_block_info())
+        """
+        self.fileobj = fileobj
+        self.settings, keys = info
+        self.compression = self.settings.get('compression')
+        if len(keys) != len(blocks):
+            raise ArchiveError("Block info doesn't match the block table")
+
+        # (SHA-256 digest of uncompressed data, BCJ filter arch)
+        #   => (file offset, size, uncompressed size)
+        self._blocks = {}
+        for key, (coffset, csize, usize) in zip(keys, blocks):
+            self._blocks.setdefault(key, (offset + coffset, csize, usize))
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def get(self, digest, bcj_arch=None):
+        """Returns the compressed block with the given data digest and BCJ
+        filter arch, or None"""
+        loc = self._blocks.get((digest, bcj_arch))
+        if loc is None:
+            return None
+        pos, csize, usize = loc
+        self.fileobj.seek(pos)
+        cdata = self.fileobj.read(csize)
+        try:
+            data = decompress(cdata)
+        except Exception as e:
+            logging.warning(f"Not reusing corrupt block of base at {pos}: {e}")
+            data = None
+        if data is None or len(data) != usize or hashlib.sha256(data).digest() != digest:
+            # Only compress it again
+            del self._blocks[(digest, bcj_arch)]
+            if data is not None:
+                logging.warning(f"Not reusing block of base at {pos}: it doesn't match the block info")
+            return None
+        return cdata
+
+
+IndexEntry = namedtuple('IndexEntry',
+        ['name', 'type', 'mode', 'size', 'offset', 'coffset', 'sha256', 'linkname'])
+IndexEntry.__doc__ = """An entry of the archive member index
+
+name:       Member name
+type:       Tar type flag (e.g. tarfile.REGTYPE)
+mode:       Permission bits
+size:       Size of the member data
+offset:     Offset of the member data in the (uncompressed) tar stream
+coffset:    Offset of the compressed block containing the start of the data
+            (the same as offset, for an uncompressed archive)
+sha256:     SHA-256 digest of the member data (bytes)
+linkname:   Link target, for symlinks and hardlinks
+"""
+
+_INDEX_HEADER = struct.Struct('<4sII')
+_INDEX_ENTRY = struct.Struct('<BBHHHIQQQ32s')
+
+def pack_index(entries):
+    """Pack the member index, for INDEX_SECTION
+
+    All values are little-endian:
+        char     magic[4]       INDEX_MAGIC
+        uint32_t version        INDEX_VERSION
+        uint32_t count
+    Followed by count entries of:
+        uint8_t  type           Tar type flag
+        uint8_t  reserved
+        uint16_t name_len
+        uint16_t link_len
+        uint16_t reserved
+        uint32_t mode
+        uint64_t size
+        uint64_t offset
+        uint64_t coffset
+        uint8_t  sha256[32]
+        char     name[name_len]
+        char     linkname[link_len]
+    """
+    data = _INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(entries))
+    for e in entries:
+        # Names needn't be UTF-8; encode them like the tar headers
+        name = os.fsencode(e.name)
+        linkname = os.fsencode(e.linkname)
+        data += _INDEX_ENTRY.pack(ord(e.type), 0, len(name), len(linkname), 0,
+                                  e.mode, e.size, e.offset, e.coffset, e.sha256)
+        data += name + linkname
+    return data
+
+def parse_index(data):
+    """Parse the member index (see pack_index()); returns a list of IndexEntry"""
+    try:
+        magic, version, count = _INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ArchiveError("Invalid archive index")
+
+        entries = []
+        pos = _INDEX_HEADER.size
+        for _ in range(count):
+            (typ, _, name_len, link_len, _, mode, size, offset, coffset,
+                sha256) = _INDEX_ENTRY.unpack_from(data, pos)
+            pos += _INDEX_ENTRY.size
+            name = os.fsdecode(data[pos:pos+name_len])
+            pos += name_len
+            linkname = os.fsdecode(data[pos:pos+link_len])
+            pos += link_len
+            entries.append(IndexEntry(name, bytes([typ]), mode, size, offset,
+                                      coffset, sha256, linkname))
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ArchiveError(f"Invalid archive index: {e}")
+    return entries
+
+
+class _HashingReader:
+    """File object wrapper which hashes the data read from it"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+
+def _get_fileobj_bcj_arch(fileobj):
+    """Returns the BCJ filter arch for the contents of fileobj, by the ELF
+    machine of its header, without moving its position"""
+    pos = fileobj.tell()
+    header = fileobj.read(ABI_IDENT_SIZE)
+    fileobj.seek(pos)
+    return get_bcj_filter_arch(parse_abi_ident(header))
+
+
+class SxTarFile(tarfile.TarFile):
+    """TarFile which indexes its members, and can align their data
+
+    If `align` is set, the data of each (non-empty) regular file is aligned to
+    a multiple of `align` bytes from the start of the archive, by inserting
+    empty directory entries (one block each) as necessary. This lets the
+    bootloader extract uncompressed members without copying them through
+    userspace.
+
+    An IndexEntry (with coffset unset) is recorded in `index` for each member.
+
+    Member modification times are cleared, as they aren't restored on
+    extraction. This makes the archive depend only on its contents, so the
+    blocks of a previous build can be reused (see BlockSource).
+
+    If `mark_code` is set, it is called with the (offset, size, BCJ filter
+    arch) of the data of each regular file which is an ELF file with a BCJ
+    filter (see BlockWriter.mark_code()).
+
+    If `start_member` is set, it is called with the size of each regular file,
+    before its header is written (see BlockWriter.start_member()).
+    """
+    align = None
+    mark_code = None
+    start_member = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.index = []
+
+    def addfile(self, tarinfo, fileobj=None):
+        tarinfo.mtime = 0
+
+        if self.start_member and tarinfo.isreg():
+            self.start_member(tarinfo.size)
+
+        if self.align and tarinfo.isreg() and tarinfo.size:
+            self._pad_for(tarinfo)
+
+        hdrlen = len(tarinfo.tobuf(self.format, self.encoding, self.errors))
+        offset = self.offset + hdrlen
+
+        if self.mark_code and fileobj and tarinfo.isreg():
+            bcj_arch = _get_fileobj_bcj_arch(fileobj)
+            if bcj_arch:
+                self.mark_code(offset, tarinfo.size, bcj_arch)
+
+        reader = _HashingReader(fileobj) if fileobj else None
+        super().addfile(tarinfo, reader)
+        sha256 = reader.hash.digest() if reader else bytes(32)
+
+        self.index.append(IndexEntry(
+            name = tarinfo.name,
+            type = tarinfo.type,
+            mode = tarinfo.mode,
+            size = tarinfo.size if tarinfo.isreg() else 0,
+            offset = offset,
+            coffset = None,
+            sha256 = sha256,
+            linkname = tarinfo.linkname,
+        ))
+
+    def _pad_for(self, tarinfo):
+        hdrlen = len(tarinfo.tobuf(self.format, self.encoding, self.errors))
+        pad = -(self.offset + hdrlen) % self.align
+        assert pad % tarfile.BLOCKSIZE == 0
+
+        padinfo = tarfile.TarInfo(PAD_DIRNAME)
+        padinfo.type = tarfile.DIRTYPE
+        padinfo.mode = 0o700
+        for _ in range(pad // tarfile.BLOCKSIZE):
+            # Not indexed
+            super().addfile(padinfo)
 
-    # The last filter in the chain must be a compression filter.
-    filters.append(dict(id=lzma.FILTER_LZMA2))
-    return filters
 
 class SxArchive:
-    def __init__(self, fileobj, mode, compress):
+    def __init__(self, fileobj, mode, compression=None, base=None, jobs=1,
+                 profile=DEFAULT_COMPRESSION_PROFILE, timings=None):
         """Create a staticx archive
 
         Parameters:
         fileobj:    File object for the archive (not closed by this class)
         mode:       Mode: 'r' (for reading) or 'w' (for writing)
-        compress:   Boolean: use xz compression or not
+        compression: Compression format (one of COMPRESSIONS) for writing;
+                    detected when reading
+        base:       BlockSource of a previous archive whose unchanged blocks
+                    are reused, for writing
+        jobs:       Number of blocks to compress in parallel, for writing
+        profile:    Compression profile (one of COMPRESSION_PROFILES), for
+                    writing
+        timings:    report.Timings in which compression is measured, for
+                    writing
         """
         # Keep original fileobj arg for consumer convenience only, never closed
         self.fileobj = fileobj
-        self.xzf = None
+        self.mode = mode
+        self.cfile = None
+
+        # Binary block table and block info of a compressed archive (available
+        # after closing)
+        self.block_table = None
+        self.block_info = None
+
+        # Binary member index, and the IndexEntry of each member (available
+        # after closing, in mode 'w')
+        self.index = None
+        self.entries = None
+
+        # (compressed offset, compressed size, uncompressed size) of each block
+        # of a compressed archive (available after closing)
+        self.blocks = None
+
+        # (blocks reused from base, total blocks), available after closing
+        self.block_stats = None
 
-        if compress:
-            self.xzf = lzma.open(
-                filename = fileobj,
-                mode = mode,
-                format = lzma.FORMAT_XZ,
+        # Number of blocks compressed with each BCJ filter (or None), available
+        # after closing
+        self.bcj_blocks = None
 
-                # Use CRC32 instead of CRC64 (FORMAT_XZ default)
-                # Otherwise, enable XZ_USE_CRC64 in libxz/xz_config.h
-                check = lzma.CHECK_CRC32,
+        # Regular files added by add_file(), by size: {digest: name}
+        self._blobs = {}
 
-                filters = get_xz_filters(),
-            )
+        if mode == 'w':
+            if compression not in COMPRESSIONS:
+                raise ValueError(f"Invalid compression: {compression!r}")
+            writer = BLOCK_WRITERS.get(compression)
+            if writer:
+                self.cfile = writer(fileobj, base=base, jobs=jobs, profile=profile,
+                                    timings=timings)
+        else:
+            self.cfile = open_decompressed(fileobj)
 
-            fileobj = self.xzf
+        if self.cfile:
+            fileobj = self.cfile
+
+        # Not all decompressors can seek, so read the archive as a stream
+        tarmode = 'r|' if mode == 'r' else mode
 
         # Our embedded libtar only supports older GNU format (not new PAX format)
-        self.tar = tarfile.open(fileobj=fileobj, mode=mode, format=tarfile.GNU_FORMAT)
+        self.tar = SxTarFile.open(fileobj=fileobj, mode=tarmode, format=tarfile.GNU_FORMAT)
+
+        # Align member data of uncompressed archives, so they can be
+        # extracted directly from the file (see ARCHIVE_ALIGN)
+        self.align = None if self.cfile else ARCHIVE_ALIGN
+        self.tar.align = self.align
+
+        if isinstance(self.cfile, BlockWriter):
+            self.tar.mark_code = self.cfile.mark_code
+            self.tar.start_member = self.cfile.start_member
 
     def __enter__(self):
         return self
@@ -74,14 +749,50 @@ class SxArchive:
     def close(self):
         # Don't touch self.fileobj here
 
+        index = None
         if self.tar:
+            # The end of the tar stream is padded to a size which depends on
+            # everything before it, so don't let that change the last block
+            if isinstance(self.cfile, BlockWriter):
+                self.cfile.end_block()
             self.tar.close()
+            if self.mode == 'w':
+                index = self.tar.index
             self.tar = None
 
-        if self.xzf:
-            self.xzf.close()
-            self.xzf = None
-
+        bw = None
+        if self.cfile:
+            self.cfile.close()
+            if isinstance(self.cfile, BlockWriter):
+                self.block_table = self.cfile.get_block_table()
+                self.block_info = self.cfile.get_block_info()
+                self.block_stats = (self.cfile.reused, len(self.cfile.blocks))
+                self.bcj_blocks = dict(self.cfile.bcj_blocks)
+                self.blocks = self.cfile.blocks
+                bw = self.cfile
+            self.cfile = None
+
+        # Compressed offsets are known once all blocks are written
+        if index is not None:
+            if bw:
+                index = [e._replace(coffset=bw.get_block_offset(e.offset)) for e in index]
+            else:
+                index = [e._replace(coffset=e.offset) for e in index]
+            self.entries = index
+            self.index = pack_index(index)
+
+
+    def content_hash(self):
+        """Returns a SHA-256 hash object covering the members added so far
+
+        Unlike a digest of the archive itself, this doesn't depend on
+        compression or alignment.
+        """
+        h = hashlib.sha256()
+        for e in self.tar.index:
+            h.update(os.fsencode(e.name) + b'\0' + e.type + e.mode.to_bytes(4, 'little')
+                     + e.sha256 + os.fsencode(e.linkname) + b'\0')
+        return h
 
     def add_symlink(self, name, target):
         """Add a symlink to the archive"""
@@ -100,7 +811,7 @@ class SxArchive:
         tarinfo.mode = make_mode_executable(tarinfo.mode)
         self.tar.addfile(tarinfo, fileobj)
 
-    def add_program(self, path, name):
+    def add_program(self, path, name, data=None):
         """Add user program to the archive
 
         This adds the user program to the archive using its original filename.
@@ -110,21 +821,60 @@ class SxArchive:
         Parameters:
         path:   The path to the program to add
         name:   The original filename of the program
+        data:   The contents to add instead of those of path (e.g. the
+                program after patching it in memory)
 
         Should only be called once. TODO: Enforce this.
         """
-        def make_exec(tarinfo):
-            tarinfo.mode = make_mode_executable(tarinfo.mode)
-            return tarinfo
-
         logging.info(f"Adding {path} as {name}")
-        self.tar.add(path, arcname=name, filter=make_exec)
+
+        # The program is what changes most often between builds, so its
+        # blocks don't include the libraries, however small it is
+        if isinstance(self.cfile, BlockWriter):
+            self.cfile.end_block()
+
+        with open(path, 'rb') as f:
+            # Following any symlink
+            tarinfo = self.tar.gettarinfo(arcname=name, fileobj=f)
+            tarinfo.mode = make_mode_executable(tarinfo.mode)
+            if data is None:
+                self.tar.addfile(tarinfo, f)
+            else:
+                tarinfo.size = len(data)
+                self.tar.addfile(tarinfo, io.BytesIO(data))
 
         # Store a link to the program so the bootloader knows what to execute
         self.add_symlink(PROG_FILENAME, name)
 
     def add_file(self, path, arcname=None):
-        self.tar.add(path, arcname=arcname)
+        """Add a regular file to the archive
+
+        If a file with identical contents has already been added, the file is
+        stored as a hardlink to it rather than storing its contents again.
+        """
+        arcname = arcname or basename(path)
+
+        # Only a file with the same size as one already added needs to be
+        # read an extra time, to compare digests. The digests of the files
+        # added are computed as they're added, for the index.
+        size = os.path.getsize(path)
+        blobs = self._blobs.setdefault(size, {})
+        target = None
+        if blobs:
+            with open(path, 'rb') as f:
+                target = blobs.get(bytes.fromhex(sha256_fileobj(f)))
+
+        if target is None:
+            self.tar.add(path, arcname=arcname)
+            blobs.setdefault(self.tar.index[-1].sha256, arcname)
+            return
+
+        logging.info(f"{arcname} is identical to {target}; adding a hardlink")
+        t = self.tar.gettarinfo(path, arcname=arcname)
+        t.type = tarfile.LNKTYPE
+        t.linkname = target
+        t.size = 0
+        self.tar.addfile(t)
 
     def add_interp_symlink(self, interp):
         """Add symlink for ld.so interpreter"""
@@ -0,0 +1,149 @@
+"""Choose the compression settings which minimize startup time
+
+The archive is read and decompressed every time the program starts (unless
+its bundle is cached), so the compression format and profile trade the size
+of the output against startup time. The autotuner compresses a sample of the
+members with each candidate, measures how fast the sample decompresses, and
+estimates the time to read and decompress the whole archive from that.
+
+Decompression is measured with the Python codecs. Those of zstd and lz4 wrap
+the same libraries as the bootloader; the bootloader's xz decoder (XZ
+Embedded) is a little slower than liblzma, which only makes xz look better.
+"""
+import io
+import logging
+import math
+import os
+import time
+from collections import namedtuple
+
+from .archive import BLOCK_WRITERS, COMPRESSION_PROFILE_SETTINGS, decompress
+from .constants import *
+from .errors import *
+
+# Assumed speed of reading the output from a cold page cache, in bytes/s
+READ_BANDWIDTH = 200 << 20
+
+# Number of decoder threads the bootloader uses by default, at most
+# (see DEFAULT_MAX_THREADS in bootloader/pxz.c)
+MAX_DECODE_THREADS = 8
+
+# Number of CPUs assumed of the machine the program will run on. The build
+# machine is often bigger, so assume a small one.
+DEFAULT_TARGET_THREADS = 2
+
+SAMPLE_SIZE = 2 << 20
+SAMPLE_CHUNK = 256 << 10
+
+
+Estimate = namedtuple('Estimate', ['compression', 'profile', 'size', 'time'])
+Estimate.__doc__ = """The estimated results of a compression setting
+
+size:       Compressed size of the archive, in bytes
+time:       Time to read and decompress the archive, in seconds
+"""
+
+
+def get_sample(paths, size=SAMPLE_SIZE, chunk=SAMPLE_CHUNK):
+    """Returns up to size bytes sampled from files, largest first
+
+    A chunk is taken from the middle of each file, past any headers.
+    """
+    sizes = {}
+    for path in paths:
+        try:
+            sizes[path] = os.path.getsize(path)
+        except OSError:
+            pass
+
+    sample = bytearray()
+    for path in sorted(sizes, key=sizes.get, reverse=True):
+        if len(sample) >= size:
+            break
+        n = min(chunk, sizes[path], size - len(sample))
+        with open(path, 'rb') as f:
+            f.seek((sizes[path] - n) // 2)
+            sample += f.read(n)
+    return bytes(sample)
+
+
+def _measure(compression, profile, sample):
+    """Returns (compressed size, decompression time) of the sample"""
+    f = io.BytesIO()
+    with BLOCK_WRITERS[compression](f, profile=profile) as w:
+        w.write(sample)
+    cdata = f.getvalue()
+
+    # The fastest of a few runs is the least disturbed
+    best = math.inf
+    for _ in range(3):
+        start = time.perf_counter()
+        decompress(cdata)
+        best = min(best, time.perf_counter() - start)
+    return len(cdata), best
+
+
+def estimate(compression, profile, sample, total_size, threads):
+    """Estimate the results of compressing total_size bytes like the sample"""
+    csize, dtime = _measure(compression, profile, sample)
+    ratio = csize / len(sample)
+    speed = len(sample) / max(dtime, 1e-6)
+
+    # Blocks are decompressed in parallel, if there are several
+    block_size, _ = COMPRESSION_PROFILE_SETTINGS[profile]
+    threads = max(1, min(threads, math.ceil(total_size / block_size)))
+
+    size = total_size * ratio
+    return Estimate(compression, profile, int(size),
+                    size / READ_BANDWIDTH + total_size / (speed * threads))
+
+
+def choose_compression(paths, compressions, size_budget=None, target_threads=None):
+    """Choose the compression format and profile for an archive
+
+    Parameters:
+    paths:          Files representative of the archive contents (e.g. the
+                    program and its libraries)
+    compressions:   Candidate compression formats; those whose Python module
+                    isn't installed are skipped
+    size_budget:    Maximum (estimated) archive size, in bytes, or None
+    target_threads: Number of CPUs of the machine the program will run on
+                    (default: DEFAULT_TARGET_THREADS), of which the
+                    bootloader uses at most MAX_DECODE_THREADS
+
+    Returns a (compression, profile) tuple: the setting with the shortest
+    estimated startup time within the size budget, or if none is, the
+    smallest.
+    """
+    sample = get_sample(paths)
+    total_size = sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+    threads = min(target_threads or DEFAULT_TARGET_THREADS, MAX_DECODE_THREADS)
+    if not sample:
+        return compressions[0], DEFAULT_COMPRESSION_PROFILE
+
+    logging.info(f"Choosing compression for about {total_size} bytes, "
+                 f"from a {len(sample)} byte sample, assuming {threads} decoder threads "
+                 f"on the target (see --target-threads)")
+    estimates = []
+    for compression in compressions:
+        for profile in COMPRESSION_PROFILES:
+            try:
+                e = estimate(compression, profile, sample, total_size, threads)
+            except MissingModuleError as e:
+                logging.info(f"Not considering {compression} compression: {e}")
+                break
+            logging.info(f"  {compression} ({profile}): {e.size} bytes, "
+                         f"{e.time * 1000:.0f} ms to read and decompress")
+            estimates.append(e)
+
+    within = [e for e in estimates if size_budget is None or e.size <= size_budget]
+    if within:
+        best = min(within, key=lambda e: e.time)
+    else:
+        best = min(estimates, key=lambda e: e.size)
+        logging.warning(f"No compression setting fits the size budget of "
+                        f"{size_budget} bytes; using the smallest")
+
+    logging.info(f"Chose {best.compression} compression with the {best.profile} "
+                 f"profile (about {best.size} bytes, {best.time * 1000:.0f} ms)")
+    return best.compression, best.profile
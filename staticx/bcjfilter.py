@@ -1,38 +1,221 @@
-import platform
+"""BCJ (Branch/Call/Jump) filters
+
+A BCJ filter converts the relative addresses of branch instructions in machine
+code to absolute ones, which repeat more and so compress better. Each filter
+is for the instruction set of one architecture, and only makes other data
+compress (slightly) worse, so the filter is chosen by the ELF machine of the
+code being compressed.
+
+The lzma module provides all of the filters except those for ARM64 and
+RISC-V, which are implemented here, like those of liblzma (5.4 and 5.6). They
+are only used where the lzma module lacks them (see xzstream).
+"""
+import array
+import re
+import struct
+import sys
 
 # NOTE: This is also used by libxz/SConscript
 
-def get_bcj_filter_arch():
+# The architecture part of each filter name, which can be prepended with
+# FILTER_ for a Python lzma module constant, or XZ_DEC_ for an XZ Embedded
+# decoder macro; and its filter ID in .xz files
+BCJ_FILTER_IDS = {
+    'X86':      0x04,
+    'POWERPC':  0x05,
+    'IA64':     0x06,
+    'ARM':      0x07,
+    'ARMTHUMB': 0x08,
+    'SPARC':    0x09,
+    'ARM64':    0x0A,
+    'RISCV':    0x0B,
+}
+
+# The filter for the code of each ELF machine, and the byte order it requires
+# (True for little-endian, or None for either)
+_MACHINE_FILTERS = {
+    'EM_386':           ('X86', None),
+    'EM_X86_64':        ('X86', None),
+    'EM_IA_64':         ('IA64', None),
+    'EM_ARM':           ('ARM', True),      # TODO: 'ARMTHUMB'
+    'EM_AARCH64':       ('ARM64', None),    # Instructions are little-endian
+    'EM_PPC':           ('POWERPC', False),
+    'EM_PPC64':         ('POWERPC', False),
+    'EM_SPARC':         ('SPARC', None),
+    'EM_SPARC32PLUS':   ('SPARC', None),
+    'EM_SPARCV9':       ('SPARC', None),
+    'EM_RISCV':         ('RISCV', True),
+}
+
+
+def get_bcj_filter_arch(ident):
     """
-    Get an appropriate BCJ filter for the current architecture.
+    Get the appropriate BCJ filter for an ELF file.
+
+    ident is the (class, little_endian, machine) of the file, as returned by
+    elf.get_abi_ident(), or None if it isn't an ELF file.
 
-    Returns just the architecture part of the BCJ filter name.
-    This can be prepended with FILTER_ for a Python lzma module constant,
-    or XZ_DEC_ for an XZ Embedded decoder macro.
+    Returns just the architecture part of the BCJ filter name (a key of
+    BCJ_FILTER_IDS), or None if there is no filter for the file.
     """
-    # It's possible that the code being compressed might not match that of the
-    # current Python interpreter. In that case the problem becomes much more
-    # complicated, as we have to inspect the files to make a determination.
-    # This approach should be "good enough"; the worst case scenario is only a
-    # slightly worse compression ratio.
+    if ident is None:
+        return None
+    _, little_endian, machine = ident
+    arch, endianness = _MACHINE_FILTERS.get(machine, (None, None))
+    if endianness is not None and endianness != little_endian:
+        return None
+    return arch
 
-    machine = platform.machine()
 
-    if machine in ('i386', 'i686', 'x86_64'):
-        return 'X86'
+_MASK32 = 0xFFFFFFFF
 
-    if machine == 'ia64':
-        return 'IA64'
+_U32 = struct.Struct('<I')
+_U32_BE = struct.Struct('>I')
+
+# Possible last (most significant) bytes of BL and ADRP instructions
+_ARM64_RE = re.compile(rb'[\x90\x94-\x97\xb0\xd0\xf0]')
+
+def arm64_convert(buf, pos=0, encoding=True):
+    """Apply (or undo) the ARM64 filter to buf (a bytearray), in place
+
+    pos is the position of buf in the uncompressed stream.
+
+    Candidate instructions are found by searching the last byte of each
+    4-byte word, and only those are converted, as 32-bit words.
+    """
+    n = len(buf) & ~3
+    words = array.array('I', buf[:n])
+    if sys.byteorder == 'big':
+        words.byteswap()
+
+    changed = False
+    for m in _ARM64_RE.finditer(buf[3:n:4]):
+        k = m.start()
+        instr = words[k]
+        pc = (pos + (k << 2)) & _MASK32
+        if (instr >> 26) == 0x25:
+            # BL: 26-bit immediate, in instructions
+            pc >>= 2
+            if not encoding:
+                pc = -pc
+            words[k] = 0x94000000 | ((instr + pc) & 0x03FFFFFF)
+        else:
+            # ADRP: 21-bit immediate, in pages. Only those within +/-512 MiB
+            # are converted, to avoid converting data.
+            src = ((instr >> 29) & 3) | ((instr >> 3) & 0x001FFFFC)
+            if (src + 0x00020000) & 0x001C0000:
+                continue
+            pc >>= 12
+            if not encoding:
+                pc = -pc
+            dest = (src + pc) & _MASK32
+            words[k] = ((instr & 0x9000001F) | ((dest & 3) << 29)
+                        | ((dest & 0x0003FFFC) << 3)
+                        | ((-(dest & 0x00020000)) & 0x00E00000))
+        changed = True
+
+    if changed:
+        if sys.byteorder == 'big':
+            words.byteswap()
+        buf[:n] = words.tobytes()
+
+
+# Possible first bytes of JAL and AUIPC instructions
+_RISCV_RE = re.compile(rb'[\xef\x17\x97]')
+
+def _riscv_not_auipc_pair(auipc, inst2):
+    return ((auipc << 8) ^ (inst2 - 3)) & 0xF8003
+
+def _riscv_not_special_auipc(auipc, inst2_rs1):
+    return (((auipc - 0x3117) << 18) & _MASK32) >= (inst2_rs1 & 0x1D)
+
+def riscv_convert(buf, pos=0, encoding=True):
+    """Apply (or undo) the RISC-V filter to buf (a bytearray), in place
+
+    pos is the position of buf in the uncompressed stream.
+
+    Instructions are examined at every 2-byte boundary, skipping over those
+    converted (or rejected), so the candidates found (by searching the first
+    byte of each 2-byte unit) are taken in order.
+    """
+    last = len(buf) - 8
+    next_i = 0
+    for m in _RISCV_RE.finditer(buf[:last + 1:2]):
+        i = m.start() << 1
+        if i < next_i:
+            continue
 
-    if machine.startswith('arm'):   # arm, armv8b, etc.
-        return 'ARM'
+        pc = (pos + i) & _MASK32
+        if buf[i] == 0xEF:
+            # JAL, unless rd is other than x0 or x1
+            b1 = buf[i+1]
+            if b1 & 0x0D:
+                continue
+            b2 = buf[i+2]
+            b3 = buf[i+3]
+            if encoding:
+                addr = (((b1 & 0xF0) << 8) | ((b2 & 0x0F) << 16)
+                        | ((b2 & 0x10) << 7) | ((b2 & 0xE0) >> 4)
+                        | ((b3 & 0x7F) << 4) | ((b3 & 0x80) << 13))
+                addr = (addr + pc) & _MASK32
+                buf[i+1] = (b1 & 0x0F) | ((addr >> 13) & 0xF0)
+                buf[i+2] = (addr >> 9) & 0xFF
+                buf[i+3] = (addr >> 1) & 0xFF
+            else:
+                addr = ((b1 & 0xF0) << 13) | (b2 << 9) | (b3 << 1)
+                addr = (addr - pc) & _MASK32
+                buf[i+1] = (b1 & 0x0F) | ((addr >> 8) & 0xF0)
+                buf[i+2] = (((addr >> 16) & 0x0F) | ((addr >> 7) & 0x10)
+                            | ((addr << 4) & 0xE0))
+                buf[i+3] = ((addr >> 4) & 0x7F) | ((addr >> 13) & 0x80)
+            next_i = i + 4
+            continue
 
-    # TODO: 'ARMTHUMB'
+        # AUIPC
+        inst, = _U32.unpack_from(buf, i)
+        if inst & 0xE80:
+            # rd isn't x0 or x2: convert it with the instruction following
+            # it, if that uses the result (e.g. JALR or a load).
+            inst2, = _U32.unpack_from(buf, i + 4)
+            if _riscv_not_auipc_pair(inst, inst2):
+                next_i = i + 6
+                continue
+            if encoding:
+                addr = inst & 0xFFFFF000
+                addr += (inst2 >> 20) - ((inst2 >> 19) & 0x1000)
+                addr = (addr + pc) & _MASK32
+                inst = 0x17 | (2 << 7) | ((inst2 << 12) & _MASK32)
+                _U32.pack_into(buf, i, inst)
+                _U32_BE.pack_into(buf, i + 4, addr)
+                next_i = i + 8
+                continue
+            addr = ((inst & 0xFFFFF000) + (inst2 >> 20)) & _MASK32
+            inst = 0x17 | (2 << 7) | ((inst2 << 12) & _MASK32)
+            inst2 = addr
+        else:
+            # rd is x0 or x2: this may look like a converted pair, and is
+            # converted so that it can be told apart.
+            inst2_rs1 = inst >> 27
+            if _riscv_not_special_auipc(inst, inst2_rs1):
+                next_i = i + 4
+                continue
+            if encoding:
+                addr, = _U32.unpack_from(buf, i + 4)
+                inst2 = (inst >> 12) | ((addr << 20) & _MASK32)
+                inst = 0x17 | (inst2_rs1 << 7) | (addr & 0xFFFFF000)
+            else:
+                addr, = _U32_BE.unpack_from(buf, i + 4)
+                addr = (addr - pc) & _MASK32
+                inst2 = (inst >> 12) | ((addr << 20) & _MASK32)
+                inst = 0x17 | (inst2_rs1 << 7) | ((addr + 0x800) & 0xFFFFF000)
 
-    if machine.startswith('ppc'):
-        return 'POWERPC'
+        _U32.pack_into(buf, i, inst)
+        _U32.pack_into(buf, i + 4, inst2)
+        next_i = i + 8
 
-    if machine.startswith('sparc'):
-        return 'SPARC'
 
-    return None
+# Filters which aren't in the lzma module
+BCJ_CONVERTERS = {
+    'ARM64':    arm64_convert,
+    'RISCV':    riscv_convert,
+}
@@ -1,6 +1,46 @@
 ARCHIVE_SECTION = ".staticx.archive"
+DIGEST_SECTION  = ".staticx.digest"
+BLOCKS_SECTION  = ".staticx.blocks"
+INDEX_SECTION   = ".staticx.index"
+BUNDLE_DIR_SECTION = ".staticx.bundledir"
+BLOCK_INFO_SECTION = ".staticx.blockinfo"  # Not used by the bootloader
 INTERP_FILENAME = ".staticx.interp"
 PROG_FILENAME   = ".staticx.prog"
+PAD_DIRNAME     = ".staticx.pad"
 
 MAX_INTERP_LEN = 256
 MAX_RPATH_LEN = 256
+
+# Archive compression formats, and the magic numbers by which they are detected
+COMPRESSION_MAGICS = {
+    'xz':   b'\xFD7zXZ\x00',
+    'zstd': b'\x28\xB5\x2F\xFD',
+    'lz4':  b'\x04\x22\x4D\x18',
+}
+COMPRESSIONS = (*COMPRESSION_MAGICS, 'none')
+DEFAULT_COMPRESSION = 'xz'
+
+# Uncompressed size of each independently-compressed block of the archive
+BLOCK_SIZE = 4 << 20        # 4 MiB
+
+# Compression profiles, trading size for startup time (see COMPRESSION_PROFILE_SETTINGS)
+COMPRESSION_PROFILES = ('size', 'balanced', 'startup')
+DEFAULT_COMPRESSION_PROFILE = 'balanced'
+
+# Max LZMA2 dictionary size supported by the bootloader (see bootloader/extract.c)
+XZ_DICT_MAX = 8 << 20       # 8 MiB
+
+BLOCK_TABLE_MAGIC = b'SXBT'
+BLOCK_TABLE_VERSION = 1
+
+# Bump when the way the archive is split into blocks changes
+BLOCK_INFO_FORMAT = 1
+
+INDEX_MAGIC = b'SXIX'
+INDEX_VERSION = 1
+
+# Alignment of member data (and the archive section) in uncompressed archives
+ARCHIVE_ALIGN = 4096
+
+# Default size limit of the cache of prepared libraries
+DEFAULT_CACHE_MAX_SIZE = 1 << 30    # 1 GiB
@@ -1,3 +1,4 @@
+import io
 import subprocess
 import sys
 import re
@@ -6,10 +7,12 @@ import logging
 import errno
 import os
 import shutil
+import struct
 
 import elftools
 from elftools.elf.elffile import ELFFile
 from elftools.elf.dynamic import DynamicSegment
+from elftools.elf.enums import ENUM_D_TAG, ENUM_E_MACHINE
 from elftools.common.exceptions import ELFError
 
 from .errors import *
@@ -84,17 +87,8 @@ class ExternTool:
 
 
 tool_ldd        = ExternTool(os.getenv("STATICX_LDD", "ldd"), 'libc-bin')
-tool_objcopy    = ExternTool('objcopy', 'binutils')
-tool_patchelf   = ExternTool('patchelf', 'patchelf',
-                    stderr_ignore = [
-                        'working around a Linux kernel bug by creating a hole',
-                    ],
-                    # They literally have "e2 80 98" in their source file
-                    encoding='utf-8',
-                    )
-tool_strip      = ExternTool('strip', 'binutils')
-
-all_tools = (tool_ldd, tool_objcopy, tool_strip, tool_patchelf)
+
+all_tools = (tool_ldd,)
 
 def extern_tools_verify():
     logging.debug("External tools:")
@@ -150,8 +144,10 @@ def _parse_ldd_output(output):
         yield libpath
 
 
-def get_shobj_deps(path, libpath=None):
-    """Discover the dependencies of a shared object (*.so file)
+def get_shobj_deps_ldd(path, libpath=None):
+    """Discover the dependencies of a shared object (*.so file) using ldd
+
+    See also ldso.get_shobj_deps().
     """
 
     # First verify we're dealing with a dynamic ELF file
@@ -195,54 +191,644 @@ def get_shobj_deps(path, libpath=None):
 
 
 
-def elf_add_section(elfpath, secname, secfilename):
-    tool_objcopy.run_check(
-        '--add-section', f'{secname}={secfilename}',
-        elfpath)
-
-
-def elf_dump_section(elfpath, secname, outpath):
-    # https://stackoverflow.com/a/3925113/119527
-    tool_objcopy.run_check(
-        '-O', 'binary',
-        '--only-section', secname,
-        '--set-section-flags', f"{secname}=alloc",
-        elfpath, outpath)
+################################################################################
+# In-process ELF editing
+
+PT_NULL         = 0
+PT_LOAD         = 1
+PT_DYNAMIC      = 2
+PT_INTERP       = 3
+PT_PHDR         = 6
+PF_W            = 0x2
+PF_R            = 0x4
+
+SHT_PROGBITS    = 1
+SHT_SYMTAB      = 2
+SHT_STRTAB      = 3
+SHT_RELA        = 4
+SHT_DYNAMIC     = 6
+SHT_NOBITS      = 8
+SHT_REL         = 9
+SHF_ALLOC       = 0x2
+SHF_INFO_LINK   = 0x40
+
+DT_NULL         = 0
+DT_NEEDED       = 1
+DT_STRTAB       = 5
+DT_STRSZ        = 10
+DT_RPATH        = 15
+DT_RUNPATH      = 29
+DT_FLAGS_1      = 0x6ffffffb
+DF_1_NODEFLIB   = 0x800
+
+# Non-allocated sections removed by strip (besides symbol tables)
+_STRIP_PREFIXES = ('.debug', '.zdebug', '.gnu.debuglto_', '.gnu.lto_', '.stab', '.line')
+
+# Largest page size of any supported architecture
+_MAX_PAGE_SIZE = 0x10000
+
+
+class _Record:
+    """A fixed-layout ELF structure, unpacked to a dict"""
+    def __init__(self, fmt, fields):
+        self.struct = struct.Struct(fmt)
+        self.fields = fields
+        self.size = self.struct.size
+
+    def unpack(self, data, offset):
+        return dict(zip(self.fields, self.struct.unpack_from(data, offset)))
+
+    def pack(self, rec):
+        return self.struct.pack(*(rec[f] for f in self.fields))
+
+_EHDR_FIELDS = ('e_ident', 'e_type', 'e_machine', 'e_version', 'e_entry', 'e_phoff',
+                'e_shoff', 'e_flags', 'e_ehsize', 'e_phentsize', 'e_phnum',
+                'e_shentsize', 'e_shnum', 'e_shstrndx')
+_PHDR_FIELDS = {
+    32: ('p_type', 'p_offset', 'p_vaddr', 'p_paddr', 'p_filesz', 'p_memsz', 'p_flags', 'p_align'),
+    64: ('p_type', 'p_flags', 'p_offset', 'p_vaddr', 'p_paddr', 'p_filesz', 'p_memsz', 'p_align'),
+}
+_SHDR_FIELDS = ('sh_name', 'sh_type', 'sh_flags', 'sh_addr', 'sh_offset', 'sh_size',
+                'sh_link', 'sh_info', 'sh_addralign', 'sh_entsize')
+_FORMATS = {
+    # Ehdr, Phdr, Shdr, Dyn
+    32: ('16sHHIIIIIHHHHHH', 'IIIIIIII', 'IIIIIIIIII', 'iI'),
+    64: ('16sHHIQQQIHHHHHH', 'IIQQQQQQ', 'IIQQQQIIQQ', 'qQ'),
+}
+
+
+def _align(n, align):
+    return -(-n // align) * align if align > 1 else n
+
+
+class _ELFImage:
+    """The contents of an ELF file, with its headers unpacked to dicts"""
 
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = bytearray(f.read())
+        self._parse()
+
+    def _parse(self):
+        data = self.data
+        if data[:4] != b'\x7fELF' or data[4] not in (1, 2) or data[5] not in (1, 2):
+            raise InvalidInputError(f"{self.path}: Invalid ELF image")
+        self.elfclass = 32 * data[4]
+        order = '<' if data[5] == 1 else '>'
+
+        ehdr_fmt, phdr_fmt, shdr_fmt, dyn_fmt = _FORMATS[self.elfclass]
+        self._Ehdr = _Record(order + ehdr_fmt, _EHDR_FIELDS)
+        self._Phdr = _Record(order + phdr_fmt, _PHDR_FIELDS[self.elfclass])
+        self._Shdr = _Record(order + shdr_fmt, _SHDR_FIELDS)
+        self._Dyn = struct.Struct(order + dyn_fmt)
 
+        try:
+            self.ehdr = self._Ehdr.unpack(data, 0)
+            ehdr = self.ehdr
+            if ehdr['e_phnum'] and ehdr['e_phentsize'] != self._Phdr.size:
+                raise InvalidInputError(f"{self.path}: Unexpected program header size")
+            if ehdr['e_shnum'] and ehdr['e_shentsize'] != self._Shdr.size:
+                raise InvalidInputError(f"{self.path}: Unexpected section header size")
+            if ehdr['e_shoff'] and not ehdr['e_shnum']:
+                raise InvalidInputError(f"{self.path}: Extended section numbering is not supported")
+
+            self.phdrs = [self._Phdr.unpack(data, ehdr['e_phoff'] + i * self._Phdr.size)
+                          for i in range(ehdr['e_phnum'])]
+            self.shdrs = [self._Shdr.unpack(data, ehdr['e_shoff'] + i * self._Shdr.size)
+                          for i in range(ehdr['e_shnum'])]
+        except struct.error:
+            raise InvalidInputError(f"{self.path}: Truncated ELF image")
+
+    def _get_phdr(self, p_type):
+        return next((ph for ph in self.phdrs if ph['p_type'] == p_type), None)
+
+    def _vaddr_to_offset(self, vaddr):
+        for ph in self.phdrs:
+            if ph['p_type'] == PT_LOAD and ph['p_vaddr'] <= vaddr < ph['p_vaddr'] + ph['p_filesz']:
+                return vaddr - ph['p_vaddr'] + ph['p_offset']
+        raise InvalidInputError(f"{self.path}: Address {vaddr:#x} is not in the file")
+
+    def _get_section_name(self, sh):
+        strtab = self.shdrs[self.ehdr['e_shstrndx']]['sh_offset']
+        start = strtab + sh['sh_name']
+        return self.data[start:self.data.index(b'\0', start)].decode('utf-8', 'replace')
+
+
+class ELFEditor(_ELFImage):
+    """Edits an ELF file in a single read-modify-write pass
+
+    This does the work of patchelf and strip, in-process. Changes are
+    requested by the methods below, and made by save().
+
+    Anything which doesn't fit in place (a longer INTERP, or new dynamic
+    strings or entries) is placed in a new PT_LOAD segment at the end of the
+    file, along with a copy of the program header table, as patchelf does.
+    The section headers are updated to match, as the bootloader relies on them.
+    """
 
-def patch_elf(path, interpreter=None, rpath=None, force_rpath=False, no_default_lib=False, add_needed=None):
-    args = []
+    def __init__(self, path):
+        super().__init__(path)
+
+        self._interp = None
+        self._rpath = None
+        self._force_rpath = False
+        self._remove_rpath = False
+        self._needed = []
+        self._no_default_lib = False
+        self._strip = False
+
+    def _read_dynamic(self):
+        """Returns the dynamic entries (up to DT_NULL) as [tag, value] lists"""
+        ph = self._get_phdr(PT_DYNAMIC)
+        if ph is None:
+            raise StaticELFError(path=self.path)
+        end = ph['p_offset'] + ph['p_filesz']
+        entries = []
+        for off in range(ph['p_offset'], end - self._Dyn.size + 1, self._Dyn.size):
+            tag, val = self._Dyn.unpack_from(self.data, off)
+            if tag == DT_NULL:
+                break
+            entries.append([tag, val])
+        return entries
+
+
+    def set_interp(self, interp):
+        """Set the program interpreter (PT_INTERP)"""
+        self._interp = interp
+
+    def set_rpath(self, rpath, force_rpath=False):
+        """Set DT_RUNPATH, or DT_RPATH if force_rpath, replacing either"""
+        self._rpath = rpath
+        self._force_rpath = force_rpath
+
+    def remove_rpath(self):
+        """Remove DT_RPATH and DT_RUNPATH"""
+        self._remove_rpath = True
+
+    def add_needed(self, names):
+        """Add DT_NEEDED entries, before the existing ones"""
+        self._needed += [n for n in coerce_sequence(names) if n not in self._needed]
+
+    def set_no_default_lib(self):
+        """Set DF_1_NODEFLIB, so the default library directories aren't searched"""
+        self._no_default_lib = True
+
+    def strip(self):
+        """Remove symbol tables and debugging sections, like strip"""
+        self._strip = True
+
+
+    def _get_stripped_sections(self):
+        """Returns the indices of the sections to remove for strip()"""
+        shdrs = self.shdrs
+        if not self._strip or not shdrs:
+            return set()
+
+        # Only remove sections after the last allocated one, so the section
+        # indices used by the dynamic symbols remain valid.
+        first = 1 + max((i for i, sh in enumerate(shdrs) if sh['sh_flags'] & SHF_ALLOC), default=0)
+        shstrndx = self.ehdr['e_shstrndx']
+
+        removed = set()
+        for i in range(first, len(shdrs)):
+            sh = shdrs[i]
+            if sh['sh_type'] == SHT_SYMTAB:
+                removed.add(i)
+                if sh['sh_link'] >= first and sh['sh_link'] != shstrndx:
+                    removed.add(sh['sh_link'])
+            elif self._get_section_name(sh).startswith(_STRIP_PREFIXES):
+                removed.add(i)
+
+        # Relocations for removed sections
+        for i in range(first, len(shdrs)):
+            sh = shdrs[i]
+            if sh['sh_type'] in (SHT_REL, SHT_RELA) and sh['sh_info'] in removed:
+                removed.add(i)
+
+        removed.discard(shstrndx)
+        return removed
+
+
+    def _edit_dynamic(self, new_strings):
+        """Apply the requested changes to the dynamic entries
+
+        Returns the new entries, or None if unchanged. New strings are added
+        to new_strings, at offsets following the existing string table.
+        """
+        if not (self._rpath is not None or self._remove_rpath or self._needed
+                or self._no_default_lib):
+            return None
+
+        entries = self._read_dynamic()
+        tags = {tag: val for tag, val in reversed(entries)}
+        if DT_STRTAB not in tags:
+            raise InvalidInputError(f"{self.path}: No dynamic string table")
+        strtab = self._vaddr_to_offset(tags[DT_STRTAB])
+        strsz = tags.get(DT_STRSZ)
+        if strsz is None:
+            raise InvalidInputError(f"{self.path}: No DT_STRSZ tag")
+
+        def get_string(offset):
+            start = strtab + offset
+            return os.fsdecode(bytes(self.data[start:self.data.index(b"\0", start)]))
+
+        def add_string(s):
+            offset = strsz + len(new_strings)
+            new_strings.extend(os.fsencode(s) + b'\0')
+            return offset
+
+        if self._rpath is not None or self._remove_rpath:
+            entries = [e for e in entries if e[0] not in (DT_RPATH, DT_RUNPATH)]
+
+        front = []
+        needed = {get_string(val) for tag, val in entries if tag == DT_NEEDED}
+        for name in self._needed:
+            if name not in needed:
+                front.append([DT_NEEDED, add_string(name)])
+        if self._rpath is not None:
+            tag = DT_RPATH if self._force_rpath else DT_RUNPATH
+            front.append([tag, add_string(self._rpath)])
+        entries = front + entries
+
+        if self._no_default_lib:
+            flags_1 = next((e for e in entries if e[0] == DT_FLAGS_1), None)
+            if flags_1:
+                flags_1[1] |= DF_1_NODEFLIB
+            else:
+                entries.append([DT_FLAGS_1, DF_1_NODEFLIB])
+
+        if new_strings:
+            for e in entries:
+                if e[0] == DT_STRSZ:
+                    e[1] = strsz + len(new_strings)
+
+        self._strtab = (strtab, strsz, tags[DT_STRTAB])
+        return entries
+
+    def _pack_dynamic(self, entries, count):
+        data = b''.join(self._Dyn.pack(*e) for e in entries)
+        return data + self._Dyn.pack(DT_NULL, 0) * (count - len(entries))
+
+
+    def save(self, path=None):
+        """Write the edited ELF file to path (default: the original path)"""
+        out = self.tobytes()
+        path = path or self.path
+        with open(path, 'wb') as f:
+            f.write(out)
+        if path != self.path:
+            shutil.copymode(self.path, path)
+
+    def tobytes(self):
+        """Returns the contents of the edited ELF file
+
+        This may modify (and return) self.data, so it should only be called
+        once.
+        """
+        data = self.data
+        ehdr = dict(self.ehdr)
+        phdrs = [dict(ph) for ph in self.phdrs]
+        shdrs = [dict(sh) for sh in self.shdrs]
+
+        # Contents of the new segment: name => bytes
+        moved = {}
+
+        interp_ph = None
+        if self._interp is not None:
+            interp = os.fsencode(self._interp) + b'\0'
+            interp_ph = next((ph for ph in phdrs if ph['p_type'] == PT_INTERP), None)
+            if interp_ph is None:
+                raise InvalidInputError(f"{self.path}: not a dynamic executable (no interp segment)")
+            if len(interp) <= interp_ph['p_filesz']:
+                off = interp_ph['p_offset']
+                data[off:off + interp_ph['p_filesz']] = interp.ljust(interp_ph['p_filesz'], b'\0')
+            else:
+                moved['interp'] = interp
+
+        new_strings = bytearray()
+        entries = self._edit_dynamic(new_strings)
+        dyn_ph = None
+        if entries is not None:
+            dyn_ph = next(ph for ph in phdrs if ph['p_type'] == PT_DYNAMIC)
+            capacity = dyn_ph['p_filesz'] // self._Dyn.size
+            if new_strings:
+                strtab, strsz, _ = self._strtab
+                moved['dynstr'] = bytes(data[strtab:strtab + strsz]) + new_strings
+            if new_strings or len(entries) + 1 > capacity:
+                # The contents are filled in once the layout is known
+                moved['dynamic'] = (len(entries) + 1) * self._Dyn.size
+            else:
+                off = dyn_ph['p_offset']
+                data[off:off + capacity * self._Dyn.size] = self._pack_dynamic(entries, capacity)
+
+        removed = self._get_stripped_sections()
+
+        if not moved and not removed:
+            return data
+        return self._relayout(ehdr, phdrs, shdrs, moved, removed, entries)
+
+    def _relayout(self, ehdr, phdrs, shdrs, moved, removed, entries):
+        """Lay out a new file with the moved contents and sections removed"""
+        data = self.data
+
+        # Everything up to the end of the last segment stays in place
+        head_end = max([ph['p_offset'] + ph['p_filesz'] for ph in phdrs]
+                       + [ehdr['e_phoff'] + len(phdrs) * self._Phdr.size, self._Ehdr.size])
+        out = bytearray(data[:head_end])
+
+        # Followed by the remaining (non-allocated) sections
+        tail = sorted((i for i, sh in enumerate(shdrs)
+                       if i and i not in removed and sh['sh_type'] != SHT_NOBITS
+                       and sh['sh_offset'] >= head_end),
+                      key=lambda i: shdrs[i]['sh_offset'])
+        for i in tail:
+            sh = shdrs[i]
+            pos = _align(len(out), sh['sh_addralign'])
+            out += bytes(pos - len(out)) + data[sh['sh_offset']:sh['sh_offset'] + sh['sh_size']]
+            sh['sh_offset'] = pos
+
+        if moved:
+            self._add_segment(out, ehdr, phdrs, shdrs, moved, entries)
+
+        # Remove stripped sections, and renumber the rest
+        if removed:
+            index = {}
+            for i in range(len(shdrs)):
+                if i not in removed:
+                    index[i] = len(index)
+            for sh in shdrs:
+                sh['sh_link'] = index.get(sh['sh_link'], 0)
+                if sh['sh_type'] in (SHT_REL, SHT_RELA) or sh['sh_flags'] & SHF_INFO_LINK:
+                    sh['sh_info'] = index.get(sh['sh_info'], 0)
+            shdrs = [sh for i, sh in enumerate(shdrs) if i not in removed]
+            ehdr['e_shstrndx'] = index[ehdr['e_shstrndx']]
+
+        # Section header table
+        if shdrs:
+            pos = _align(len(out), 8)
+            out += bytes(pos - len(out))
+            ehdr['e_shoff'] = pos
+            ehdr['e_shnum'] = len(shdrs)
+            for sh in shdrs:
+                out += self._Shdr.pack(sh)
+
+        # Program header table (in place, or moved to the new segment)
+        ehdr['e_phnum'] = len(phdrs)
+        phtab = b''.join(self._Phdr.pack(ph) for ph in phdrs)
+        out[ehdr['e_phoff']:ehdr['e_phoff'] + len(phtab)] = phtab
+
+        out[:self._Ehdr.size] = self._Ehdr.pack(ehdr)
+        return out
+
+    def _add_segment(self, out, ehdr, phdrs, shdrs, moved, entries):
+        """Append a new PT_LOAD segment containing the moved contents"""
+        loads = [ph for ph in phdrs if ph['p_type'] == PT_LOAD]
+        if not loads:
+            raise InvalidInputError(f"{self.path}: No loadable segments")
+
+        # The new segment must have the same offset-to-address delta as the
+        # first, since older kernels locate the program headers (AT_PHDR)
+        # using that of the first segment.
+        first = min(loads, key=lambda ph: ph['p_vaddr'])
+        delta = first['p_vaddr'] - first['p_offset']
+        page = min(max(ph['p_align'] for ph in loads), _MAX_PAGE_SIZE)
+        if delta % page:
+            raise InvalidInputError(f"{self.path}: Unsupported segment layout")
+        vend = max(ph['p_vaddr'] + ph['p_memsz'] for ph in loads)
+
+        # A free program header entry can be reused; otherwise the table is
+        # moved to the new segment, with room for another entry.
+        null = next((ph for ph in phdrs if ph['p_type'] == PT_NULL), None)
+        if null:
+            phdrs.remove(null)
+        else:
+            moved = {'phdrs': (len(phdrs) + 1) * self._Phdr.size, **moved}
+
+        # The segment must start on a page after the end of the others
+        offset = max(_align(len(out), 16), _align(vend, page) - delta)
+        layout = {}
+        pos = offset
+        for name, content in moved.items():
+            pos = _align(pos, 8)
+            size = content if isinstance(content, int) else len(content)
+            layout[name] = (pos, pos + delta, size)
+            pos += size
+        out += bytes(offset - len(out))
+
+        seg = dict(first, p_type=PT_LOAD, p_flags=PF_R | PF_W, p_offset=offset,
+                   p_vaddr=offset + delta, p_paddr=offset + delta,
+                   p_filesz=pos - offset, p_memsz=pos - offset, p_align=page)
+        last = max(i for i, ph in enumerate(phdrs) if ph['p_type'] == PT_LOAD)
+        phdrs.insert(last + 1, seg)
+
+        def update_segment(p_type, name):
+            off, addr, size = layout[name]
+            for ph in phdrs:
+                if ph['p_type'] == p_type:
+                    ph.update(p_offset=off, p_vaddr=addr, p_paddr=addr,
+                              p_filesz=size, p_memsz=size)
+
+        def update_section(match, name):
+            off, addr, size = layout[name]
+            for sh in shdrs:
+                if sh['sh_flags'] & SHF_ALLOC and match(sh):
+                    sh.update(sh_offset=off, sh_addr=addr, sh_size=size)
+
+        contents = {}
+        if 'phdrs' in layout:
+            update_segment(PT_PHDR, 'phdrs')
+            ehdr['e_phoff'] = layout['phdrs'][0]
+            contents['phdrs'] = bytes(layout['phdrs'][2])   # Written later
+        if 'interp' in layout:
+            old_addr = next(ph['p_vaddr'] for ph in phdrs if ph['p_type'] == PT_INTERP)
+            update_section(lambda sh: sh['sh_addr'] == old_addr, 'interp')
+            update_segment(PT_INTERP, 'interp')
+            contents['interp'] = moved['interp']
+        if 'dynstr' in layout:
+            _, _, old_addr = self._strtab
+            update_section(lambda sh: sh['sh_type'] == SHT_STRTAB and sh['sh_addr'] == old_addr,
+                           'dynstr')
+            contents['dynstr'] = moved['dynstr']
+            for e in entries:
+                if e[0] == DT_STRTAB:
+                    e[1] = layout['dynstr'][1]
+        if 'dynamic' in layout:
+            update_section(lambda sh: sh['sh_type'] == SHT_DYNAMIC, 'dynamic')
+            update_segment(PT_DYNAMIC, 'dynamic')
+            contents['dynamic'] = self._pack_dynamic(entries, len(entries) + 1)
+
+        for name, (off, _, size) in layout.items():
+            out[len(out):] = bytes(off - len(out))
+            out += contents[name]
+
+
+def patch_elf(path, interpreter=None, rpath=None, force_rpath=False, no_default_lib=False,
+              add_needed=None, strip=False):
+    """Make several changes to an ELF file in a single pass (see ELFEditor)"""
+    editor = ELFEditor(path)
+    if strip:
+        editor.strip()
     if interpreter:
-        args += ['--set-interpreter', interpreter]
+        editor.set_interp(interpreter)
     if rpath:
-        args += ['--set-rpath', rpath]
-    if force_rpath:
-        # There is a bug in patchelf that requires --remove-rpath to be used
-        # first before --force-rpath is effective.
-        # https://github.com/NixOS/patchelf/issues/94
-        # This was fixed in v0.11 but that's newer than Debian Buster.
-        remove_rpath(path)
-
-        args.append('--force-rpath')
+        editor.set_rpath(rpath, force_rpath=force_rpath)
     if add_needed:
-        for lib in coerce_sequence(add_needed):
-            args += ['--add-needed', lib]
-    args.append(path)
-
-    tool_patchelf.run_check(*args)
-
-    # There is a bug in patchelf that requires the --force-rpath and
-    # --no-default-lib steps to be run in separate invocations.
-    # https://github.com/NixOS/patchelf/issues/223
+        editor.add_needed(add_needed)
     if no_default_lib:
-        tool_patchelf.run_check('--no-default-lib', path)
+        editor.set_no_default_lib()
+    editor.save()
 
 def remove_rpath(path):
-    tool_patchelf.run_check('--remove-rpath', path)
+    editor = ELFEditor(path)
+    editor.remove_rpath()
+    editor.save()
 
 def strip_elf(path):
-    tool_strip.run_check(path)
+    editor = ELFEditor(path)
+    editor.strip()
+    editor.save()
+
+
+class _SectionWriter(io.RawIOBase):
+    """Writes the data of a section being appended (see ELFSectionAppender)
+
+    tell() returns the position relative to the start of the section.
+    """
+    def __init__(self, appender):
+        self._appender = appender
+        self._size = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._size
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed section")
+        n = self._appender.fileobj.write(data)
+        self._size += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._appender._end_section(self._size)
+        super().close()
+
+
+class ELFSectionAppender:
+    """Writes a copy of an ELF file with sections appended, in one pass
+
+    This replaces objcopy --add-section. The ELF file is copied to fileobj,
+    followed by the data of each section, as it is written, and finally a new
+    section header table. Section data is never copied, so large sections
+    (e.g. the archive) can be streamed directly to the output file.
+    """
+
+    def __init__(self, fileobj, elfpath):
+        """
+        Parameters:
+        fileobj:    Seekable file object to write, at offset 0 (not closed by
+                    this class)
+        elfpath:    Path to the ELF file to which sections are appended
+        """
+        self.fileobj = fileobj
+        self._elf = elf = _ELFImage(elfpath)
+        self._shdrs = [dict(sh) for sh in elf.shdrs]
+        shstrtab = self._shdrs[elf.ehdr['e_shstrndx']]
+        self._names = bytearray(elf.data[shstrtab['sh_offset']:
+                                         shstrtab['sh_offset'] + shstrtab['sh_size']])
+
+        # Copy everything but the section header table (normally at the end)
+        end = len(elf.data)
+        if elf.ehdr['e_shoff'] + len(elf.shdrs) * elf._Shdr.size == end:
+            end = elf.ehdr['e_shoff']
+        fileobj.write(elf.data[:end])
+        self._pos = end
+        self._section = None
+
+    def _pad_to(self, align):
+        pad = -self._pos % align if align > 1 else 0
+        self.fileobj.write(bytes(pad))
+        self._pos += pad
+
+    def open_section(self, name, align=1):
+        """Start a new section, returning a file object to write its data to
+
+        The file object must be closed before any other section is added.
+        """
+        if self._section:
+            raise InternalError(f"Section {self._section['name']} is still open")
+        self._pad_to(align)
+        self._section = dict(name=name, offset=self._pos, align=align)
+        return _SectionWriter(self)
+
+    def _end_section(self, size):
+        sec = self._section
+        self._section = None
+        self._pos += size
+
+        self._shdrs.append(dict(
+            sh_name = len(self._names),
+            sh_type = SHT_PROGBITS,
+            sh_flags = 0,
+            sh_addr = 0,
+            sh_offset = sec['offset'],
+            sh_size = size,
+            sh_link = 0,
+            sh_info = 0,
+            sh_addralign = sec['align'],
+            sh_entsize = 0,
+        ))
+        self._names += sec['name'].encode() + b'\0'
+
+    def add_section(self, name, data, align=1):
+        """Add a section with the given data"""
+        with self.open_section(name, align) as f:
+            f.write(data)
+
+    def close(self):
+        """Write the section name table and section header table"""
+        if self._section:
+            raise InternalError(f"Section {self._section['name']} is still open")
+        elf = self._elf
+
+        # The section names are moved to the end, with the new names
+        shstrtab = self._shdrs[elf.ehdr['e_shstrndx']]
+        shstrtab.update(sh_offset=self._pos, sh_size=len(self._names))
+        self.fileobj.write(self._names)
+        self._pos += len(self._names)
+
+        self._pad_to(8)
+        ehdr = dict(elf.ehdr, e_shoff=self._pos, e_shnum=len(self._shdrs))
+        for sh in self._shdrs:
+            self.fileobj.write(elf._Shdr.pack(sh))
+        self._pos += len(self._shdrs) * elf._Shdr.size
+
+        self.fileobj.seek(0)
+        self.fileobj.write(elf._Ehdr.pack(ehdr))
+        self.fileobj.seek(self._pos)
+
+
+def elf_dump_section(elfpath, secname, outpath):
+    """Write the contents of a section to a file (empty if it's absent)"""
+    with open_elf(elfpath) as elf:
+        srange = elf.get_section_range(secname)
+
+    with open(outpath, 'wb') as fout:
+        if srange is None:
+            return
+        offset, size = srange
+        with open(elfpath, 'rb') as fin:
+            fin.seek(offset)
+            while size:
+                data = fin.read(min(size, 1 << 20))
+                if not data:
+                    raise InvalidInputError(f"{elfpath}: Section {secname} is truncated")
+                fout.write(data)
+                size -= len(data)
 
 
 ################################################################################
@@ -255,6 +841,12 @@ class StaticELFError(Error):
         super().__init__(message)
 
 
+# Some values have several names (e.g. DT_LOOS); use the first
+_D_TAGS = {}
+for _name, _val in ENUM_D_TAG.items():
+    _D_TAGS.setdefault(_val, _name)
+
+
 class ELFFileX(ELFFile):
     def __init__(self, stream, path=None):
         self.__path = path
@@ -276,36 +868,115 @@ class ELFFileX(ELFFile):
             return isinstance(sec, sectype)
         return single(self.iter_sections(), key=key, default=None)
 
+    def _find_segment_index(self, p_type):
+        for i in range(self.num_segments()):
+            if self._get_segment_header(i)['p_type'] == p_type:
+                return i
+        return None
+
+    def _find_segment(self, p_type):
+        """Returns the first segment of the given type, or None
+
+        Unlike iter_segments(), this only constructs the segment found; some
+        (e.g. DynamicSegment) are expensive to construct.
+        """
+        i = self._find_segment_index(p_type)
+        return None if i is None else self.get_segment(i)
+
     def get_prog_interp(self):
-        for seg in self.iter_segments():
-            # Amazingly, this is slightly faster than
-            # if isinstance(seg, InterpSegment):
-            try:
-                return seg.get_interp_name()
-            except AttributeError:
-                continue
+        seg = self._find_segment('PT_INTERP')
+        if seg:
+            return seg.get_interp_name()
 
         raise InvalidInputError(
             f"{self.__path}: not a dynamic executable (no interp segment)")
 
 
     def get_dynamic_segment(self):
-        for seg in self.iter_segments():
-            if seg['p_type'] == 'PT_DYNAMIC':
-                assert isinstance(seg, DynamicSegment)
-                return seg
-        return None
+        # Creating a DynamicSegment is expensive, so only do it once
+        try:
+            return self.__dynamic_segment
+        except AttributeError:
+            pass
+
+        seg = self._find_segment('PT_DYNAMIC')
+        assert seg is None or isinstance(seg, DynamicSegment)
+        self.__dynamic_segment = seg
+        return seg
 
     def is_dynamic(self):
         return bool(self.get_dynamic_segment())
 
 
-    def get_single_dynamic_tag(self, name):
+    def get_dynamic_tags(self):
+        """Returns a list of all of the dynamic tags"""
+        # Each iteration re-parses the tags, so only do it once
+        try:
+            return self.__dynamic_tags
+        except AttributeError:
+            pass
+
         dyn = self.get_dynamic_segment()
-        if dyn:
-            return single(dyn.iter_tags(name), default=None)
+        self.__dynamic_tags = list(dyn.iter_tags()) if dyn else []
+        return self.__dynamic_tags
+
+    # Dynamic tags with string values (offsets into the string table)
+    _STRING_TAGS = {'DT_NEEDED', 'DT_SONAME', 'DT_RPATH', 'DT_RUNPATH'}
+
+    def get_dynamic_entries(self):
+        """Returns a list of (tag name, value) of each dynamic entry
+
+        The values of DT_NEEDED, DT_SONAME, DT_RPATH and DT_RUNPATH are
+        strings; others are integers. This reads the dynamic segment directly,
+        which is much faster than get_dynamic_tags().
+        """
+        i = self._find_segment_index('PT_DYNAMIC')
+        if i is None:
+            return []
+        hdr = self._get_segment_header(i)
+        self.stream.seek(hdr['p_offset'])
+        data = self.stream.read(hdr['p_filesz'])
+
+        order = '<' if self.little_endian else '>'
+        fmt = struct.Struct(order + ('qQ' if self.elfclass == 64 else 'iI'))
+        entries = []
+        strtab = None
+        for d_tag, d_val in fmt.iter_unpack(data[:len(data) - len(data) % fmt.size]):
+            if d_tag == 0:      # DT_NULL
+                break
+            name = _D_TAGS.get(d_tag, d_tag)
+            if name == 'DT_STRTAB':
+                strtab = self._vaddr_to_offset(d_val)
+            entries.append((name, d_val))
+
+        def get_string(offset):
+            if strtab is None:
+                raise ELFError("Dynamic string table not found")
+            self.stream.seek(strtab + offset)
+            buf = b''
+            while b'\0' not in buf:
+                chunk = self.stream.read(256)
+                if not chunk:
+                    break
+                buf += chunk
+            return buf.split(b'\0', 1)[0].decode('utf-8', errors='surrogateescape')
+
+        return [(name, get_string(val) if name in self._STRING_TAGS else val)
+                for name, val in entries]
+
+    def _vaddr_to_offset(self, vaddr):
+        """Map a virtual address to a file offset, using the PT_LOAD segments"""
+        for i in range(self.num_segments()):
+            hdr = self._get_segment_header(i)
+            if (hdr['p_type'] == 'PT_LOAD'
+                    and hdr['p_vaddr'] <= vaddr < hdr['p_vaddr'] + hdr['p_filesz']):
+                return vaddr - hdr['p_vaddr'] + hdr['p_offset']
         return None
 
+    def get_single_dynamic_tag(self, name):
+        tags = (t for t in self.get_dynamic_tags() if t.entry.d_tag == name)
+        return single(tags, default=None)
+
     def get_rpath(self):
         """Returns the value of the DT_RPATH tag of the ELF file"""
         return self.get_single_dynamic_tag('DT_RPATH')
@@ -314,6 +985,27 @@ class ELFFileX(ELFFile):
         """Returns the value of the DT_RUNPATH tag of the ELF file"""
         return self.get_single_dynamic_tag('DT_RUNPATH')
 
+    def get_abi_ident(self):
+        """Returns the (class, endianness, machine) of the ELF file
+
+        The dynamic linker only loads libraries which match all of these.
+        """
+        return (self.elfclass, self.little_endian, self['e_machine'])
+
+    def get_section_range(self, name):
+        """Returns the (file offset, size) of a section, or None if absent"""
+        sec = self.get_section_by_name(name)
+        if sec is None:
+            return None
+        return sec['sh_offset'], sec['sh_size']
+
+    def get_section_data(self, name):
+        """Returns the contents of a section, or None if absent"""
+        sec = self.get_section_by_name(name)
+        if sec is None:
+            return None
+        return sec.data()
+
 
 def open_elf(path, mode='rb'):
     try:
@@ -322,6 +1014,41 @@ def open_elf(path, mode='rb'):
         raise InvalidInputError(f"{path}: Invalid ELF image: {e}")
 
 
+_E_MACHINES = {v: k for k, v in ENUM_E_MACHINE.items() if k != '_default_'}
+
+# Size of the start of an ELF header needed by parse_abi_ident():
+# e_ident, e_type, e_machine
+ABI_IDENT_SIZE = 20
+
+def parse_abi_ident(header):
+    """Returns the ABI ident (see ELFFileX.get_abi_ident()) of the ELF file
+    starting with header, or None if it isn't an ELF file
+
+    Only the first ABI_IDENT_SIZE bytes of the file are needed.
+    """
+    if len(header) < ABI_IDENT_SIZE or header[:4] != b'\x7fELF':
+        return None
+    ei_class, ei_data = header[4], header[5]
+    if ei_class not in (1, 2) or ei_data not in (1, 2):
+        return None
+    little_endian = (ei_data == 1)
+    machine = int.from_bytes(header[18:20], 'little' if little_endian else 'big')
+    return (32 * ei_class, little_endian, _E_MACHINES.get(machine, machine))
+
+def get_abi_ident(path):
+    """Returns the ABI ident of a file (see ELFFileX.get_abi_ident())
+
+    Returns None if the file isn't an ELF file. This only reads the start of
+    the ELF header, so it's much cheaper than open_elf().
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(ABI_IDENT_SIZE)
+    except OSError:
+        return None
+    return parse_abi_ident(header)
+
+
 def get_machine(path):
     with open_elf(path) as elf:
         return elf['e_machine']
@@ -20,6 +20,14 @@ class MissingToolError(Error):
         self.program = program
         self.package = package
 
+class MissingModuleError(Error):
+    """A Python module required for an optional feature is missing"""
+    def __init__(self, module, extra):
+        super().__init__(f"Couldn't import '{module}'. "
+                         f"Is it installed? (pip install staticx[{extra}])")
+        self.module = module
+        self.extra = extra
+
 class InvalidInputError(Error):
     """Input provided by the user is invalid"""
     pass
@@ -1,7 +1,10 @@
 from tempfile import NamedTemporaryFile, mkdtemp
+import hashlib
 import tarfile
 import os
+import sys
 
+from .archive import decompress, open_decompressed, parse_block_table, parse_index
 from .constants import *
 from .elf import *
 from .errors import ArchiveError
@@ -15,7 +18,59 @@ def open_archive(archive):
     size = os.stat(f.name).st_size
     if size == 0:
         raise ArchiveError(f"{archive} does not appear to contain a staticx archive section")
-    return tarfile.open(fileobj=f, mode='r', format=tarfile.GNU_FORMAT)
+
+    # Not all decompressors can seek, so read the archive as a stream
+    fileobj = open_decompressed(f) or f
+    return tarfile.open(fileobj=fileobj, mode='r|', format=tarfile.GNU_FORMAT)
+
+
+class IndexedArchive:
+    """Random access to the members of a staticx archive, using its index"""
+
+    def __init__(self, archive):
+        with open_elf(archive) as elf:
+            index = elf.get_section_data(INDEX_SECTION)
+            if index is None:
+                raise ArchiveError(f"{archive} does not contain an archive index")
+            self.entries = {e.name: e for e in parse_index(index)}
+
+            self.range = elf.get_section_range(ARCHIVE_SECTION)
+            blocks = elf.get_section_data(BLOCKS_SECTION)
+            self.blocks = parse_block_table(blocks) if blocks else None
+
+        self.path = archive
+
+    def read(self, name):
+        """Returns the data of the named member, verifying its digest"""
+        entry = self.entries.get(name)
+        if entry is None:
+            raise ArchiveError(f"No member named {name!r}")
+        if entry.type in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+            return self.read(entry.linkname)
+
+        with open(self.path, 'rb') as f:
+            if self.blocks:
+                data = self._read_compressed(f, entry)
+            else:
+                f.seek(self.range[0] + entry.offset)
+                data = f.read(entry.size)
+
+        if hashlib.sha256(data).digest() != entry.sha256:
+            raise ArchiveError(f"Digest mismatch for member {name!r}")
+        return data
+
+    def _read_compressed(self, f, entry):
+        # Decompress only the blocks spanned by the member
+        data = b''
+        ustart = 0
+        end = entry.offset + entry.size
+        for coffset, csize, usize in self.blocks:
+            if coffset >= entry.coffset and ustart < end:
+                f.seek(self.range[0] + coffset)
+                block = decompress(f.read(csize))
+                data += block[max(entry.offset - ustart, 0):end - ustart]
+            ustart += usize
+        return data
 
 
 def main():
@@ -28,8 +83,24 @@ def main():
             help="Optional output directory into which archive is to be extracted")
     ap.add_argument('-v', '--verbose', action='store_true',
             help="Verbose output")
+    ap.add_argument('-m', '--member',
+            help="Extract only the named member (to outdir, or stdout) using "
+                 "the archive index")
     args = ap.parse_args()
 
+    if args.member:
+        try:
+            data = IndexedArchive(args.archive).read(args.member)
+        except ArchiveError as e:
+            raise SystemExit(str(e))
+
+        if args.outdir:
+            with open(os.path.join(args.outdir, os.path.basename(args.member)), 'wb') as f:
+                f.write(data)
+        else:
+            sys.stdout.buffer.write(data)
+        return
+
     try:
         ar = open_archive(args.archive)
     except ArchiveError as e:
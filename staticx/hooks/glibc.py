@@ -1,6 +1,7 @@
 from ..assets import copy_asset_to_tempfile
 from ..errors import InternalError
-from ..elf import open_elf, get_shobj_deps, patch_elf
+from ..elf import open_elf
+from ..ldso import get_shobj_deps
 from ..utils import make_executable
 from elftools.elf.gnuversions import GNUVerNeedSection
 import logging
@@ -18,7 +19,7 @@ def process_glibc_prog(sx):
         raise InternalError("GLIBC binary detected but libnssfix.so not available")
 
     # Make the user program depend on libnssfix.so
-    patch_elf(sx.tmpprog, add_needed=LIBNSSFIX)
+    sx.add_prog_needed(LIBNSSFIX)
 
     # Add libnssfix.so and its dependencies to the archive.
     # These include the configured libnss_*.so "service" libs and their
@@ -2,7 +2,8 @@ import os
 import logging
 import tempfile
 
-from ..elf import get_shobj_deps, is_dynamic_elf, LddError
+from ..elf import is_dynamic_elf, LddError
+from ..ldso import get_shobj_deps
 from ..errors import Error, UnsupportedRpathError, UnsupportedRunpathError
 from ..utils import make_executable, mkdirs_for
 
@@ -60,6 +61,9 @@ class PyInstallHook:
         return self
 
     def __exit__(self, *exc_info):
+        # Libraries may be added from our tmpdir in the background
+        if exc_info[0] is None:
+            self.sx.flush()
         self.tmpdir.cleanup()
 
     def process(self):
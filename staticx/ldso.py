@@ -0,0 +1,374 @@
+"""Discover the shared library dependencies of a dynamic ELF file
+
+This emulates the library search of the dynamic linker (GNU or musl ld.so)
+in-process, rather than running ldd, which actually loads the file with the
+host's ld.so: that is slow, and can't handle programs for a different libc.
+ldd is still used if STATICX_LDD is set, or if a library can't be found.
+"""
+import logging
+import os
+import struct
+from collections import namedtuple
+from functools import lru_cache
+
+from elftools.common.exceptions import ELFError
+
+from .elf import get_abi_ident, get_shobj_deps_ldd, open_elf, StaticELFError, DF_1_NODEFLIB
+from .errors import *
+
+LD_SO_CACHE = '/etc/ld.so.cache'
+
+# Set to also run ldd, and warn if its results differ
+STATICX_LDD_CHECK = 'STATICX_LDD_CHECK'
+
+
+class LibraryNotFoundError(Error):
+    """A needed library couldn't be found"""
+    def __init__(self, name, needed_by):
+        super().__init__(f"Couldn't find {name} (needed by {needed_by})")
+        self.name = name
+        self.needed_by = needed_by
+
+
+DynInfo = namedtuple('DynInfo',
+        ['ident', 'interp', 'soname', 'needed', 'rpath', 'runpath', 'flags_1'])
+DynInfo.__doc__ = """The dynamic linking information of an ELF file
+
+ident:      (class, endianness, machine); see ELFFileX.get_abi_ident()
+interp:     Program interpreter, or None
+soname:     DT_SONAME, or None
+needed:     List of DT_NEEDED names
+rpath:      List of DT_RPATH directories
+runpath:    List of DT_RUNPATH directories
+flags_1:    DT_FLAGS_1
+"""
+
+
+def _split_path(value):
+    return [d for d in value.split(':') if d] if value else []
+
+
+@lru_cache(maxsize=None)
+def _read_dyninfo(path, _stat_key):
+    with open_elf(path) as elf:
+        entries = elf.get_dynamic_entries()
+        if not entries:
+            raise StaticELFError(path=path)
+        try:
+            interp = elf.get_prog_interp()
+        except InvalidInputError:
+            interp = None
+
+        def values(tag):
+            return [v for t, v in entries if t == tag]
+
+        def first(tag, default=None):
+            return next(iter(values(tag)), default)
+
+        return DynInfo(
+            ident = elf.get_abi_ident(),
+            interp = interp,
+            soname = first('DT_SONAME'),
+            needed = values('DT_NEEDED'),
+            rpath = _split_path(first('DT_RPATH')),
+            runpath = _split_path(first('DT_RUNPATH')),
+            flags_1 = first('DT_FLAGS_1', 0),
+        )
+
+def read_dyninfo(path):
+    """Returns the DynInfo of an ELF file
+
+    Results are memoized for as long as the file is unchanged.
+    """
+    st = os.stat(path)
+    return _read_dyninfo(path, (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns))
+
+
+_CACHE_MAGIC_NEW = b'glibc-ld.so.cache1.1'
+_CACHE_MAGIC_OLD = b'ld.so-1.7.0'
+_CACHE_HEADER_NEW = struct.Struct('=20sII')     # magic+version, nlibs, len_strings
+_CACHE_HEADER_NEW_SIZE = 48
+_CACHE_ENTRY_NEW = struct.Struct('=iIIIQ')      # flags, key, value, osversion, hwcap
+_CACHE_ENTRY_OLD_SIZE = 12
+
+def parse_ld_so_cache(data):
+    """Parse the contents of a glibc ld.so.cache
+
+    Returns a list of (name, path) tuples, in cache order, of the entries
+    which don't depend on hardware capabilities. Only the "new" format (glibc
+    2.3+), possibly following an "old" format cache, is supported.
+    """
+    start = 0
+    if data.startswith(_CACHE_MAGIC_OLD):
+        # The new format cache follows the old one (8-byte aligned)
+        nlibs, = struct.unpack_from('=I', data, 12)
+        start = 16 + nlibs * _CACHE_ENTRY_OLD_SIZE
+        start = (start + 7) & ~7
+
+    if data[start:start+len(_CACHE_MAGIC_NEW)] != _CACHE_MAGIC_NEW:
+        raise ValueError("Unsupported ld.so.cache format")
+
+    def get_str(offset):
+        # String offsets are relative to the new format header
+        offset += start
+        end = data.index(b'\0', offset)
+        return os.fsdecode(data[offset:end])
+
+    _, nlibs, _ = _CACHE_HEADER_NEW.unpack_from(data, start)
+    entries = []
+    pos = start + _CACHE_HEADER_NEW_SIZE
+    for _ in range(nlibs):
+        flags, key, value, _, hwcap = _CACHE_ENTRY_NEW.unpack_from(data, pos)
+        pos += _CACHE_ENTRY_NEW.size
+        if hwcap:
+            continue
+        entries.append((get_str(key), get_str(value)))
+    return entries
+
+
+# Multiarch directories (Debian and derivatives) by machine
+_MULTIARCH = {
+    'EM_X86_64':    'x86_64-linux-gnu',
+    'EM_386':       'i386-linux-gnu',
+    'EM_AARCH64':   'aarch64-linux-gnu',
+    'EM_ARM':       'arm-linux-gnueabihf',
+    'EM_RISCV':     'riscv64-linux-gnu',
+    'EM_PPC64':     'powerpc64le-linux-gnu',
+    'EM_S390':      's390x-linux-gnu',
+}
+
+
+# glibc's system library dir ($LIB) and $PLATFORM (the kernel's AT_PLATFORM)
+# by (class, machine). Where AT_PLATFORM names the CPU model (e.g. power9),
+# it can't be known from the file, and is None. Others default to lib64 or lib.
+_GLIBC_ABI = {
+    (64, 'EM_X86_64'):      ('lib64', 'x86_64'),
+    (32, 'EM_X86_64'):      ('libx32', 'x86_64'),
+    (32, 'EM_386'):         ('lib', 'i686'),
+    (64, 'EM_AARCH64'):     ('lib', 'aarch64'),
+    (32, 'EM_ARM'):         ('lib', None),
+    (64, 'EM_RISCV'):       ('lib64/lp64d', None),
+    (64, 'EM_PPC64'):       ('lib64', None),
+    (64, 'EM_S390'):        ('lib64', None),
+    (64, 'EM_SPARCV9'):     ('lib64', 'sparc64'),
+}
+
+def _glibc_abi(ident):
+    """Returns the ($LIB, $PLATFORM) of files with the given ident"""
+    elfclass, _, machine = ident
+    return _GLIBC_ABI.get((elfclass, machine),
+                          ('lib64' if elfclass == 64 else 'lib', None))
+
+
+class Resolver:
+    """Finds the libraries an ELF file depends on, as ld.so would
+
+    Everything read from the filesystem is memoized, so the dependency graph
+    is shared by all queries (e.g. by hooks) during a build.
+    """
+
+    def __init__(self, ld_so_cache=LD_SO_CACHE):
+        self.ld_so_cache = ld_so_cache
+        self._cache_entries = None
+
+    def _get_cache_entries(self):
+        if self._cache_entries is None:
+            try:
+                with open(self.ld_so_cache, 'rb') as f:
+                    entries = parse_ld_so_cache(f.read())
+            except (OSError, ValueError, struct.error) as e:
+                logging.debug(f"Not using {self.ld_so_cache}: {e}")
+                entries = []
+            # Only set once complete, as several builds may share the resolver
+            cache_entries = {}
+            for name, path in entries:
+                cache_entries.setdefault(name, []).append(path)
+            self._cache_entries = cache_entries
+        return self._cache_entries
+
+    @staticmethod
+    def _expand(dirs, origin, ident):
+        """Expand dynamic string tokens in RPATH/RUNPATH directories
+
+        $LIB and $PLATFORM are those of the file's ABI, not the host's, as
+        the file may be for another machine. Like ld.so, directories with a
+        token which can't be expanded are skipped.
+        """
+        lib, platform = _glibc_abi(ident)
+        for d in dirs:
+            for token, value in (('ORIGIN', origin), ('LIB', lib),
+                                 ('PLATFORM', platform)):
+                if ('${' + token + '}') not in d and ('$' + token) not in d:
+                    continue
+                if value is None:
+                    break
+                d = d.replace('${' + token + '}', value).replace('$' + token, value)
+            else:
+                yield d
+
+    @staticmethod
+    def _default_dirs(ident, musl):
+        if musl:
+            return ['/lib', '/usr/local/lib', '/usr/lib']
+        dirs = []
+        triplet = _MULTIARCH.get(ident[2])
+        if triplet:
+            dirs += [f'/lib/{triplet}', f'/usr/lib/{triplet}']
+        lib, _ = _glibc_abi(ident)
+        dirs += [f'/{lib}', f'/usr/{lib}']
+        if ident[0] == 64 and lib != 'lib64':
+            # Some distributions (e.g. Fedora) use lib64 on every 64-bit ABI
+            dirs += ['/lib64', '/usr/lib64']
+        if lib != 'lib':
+            dirs += ['/lib', '/usr/lib']
+        return dirs
+
+    @staticmethod
+    def _musl_path_dirs(interp):
+        # e.g. /lib/ld-musl-x86_64.so.1 => /etc/ld-musl-x86_64.path
+        arch = os.path.basename(interp).split('.so')[0][len('ld-musl-'):]
+        try:
+            with open(f'/etc/ld-musl-{arch}.path') as f:
+                return [d for d in f.read().replace('\n', ':').split(':') if d]
+        except OSError:
+            return None
+
+    @staticmethod
+    def _first_compatible(paths, ident):
+        """Returns the first of paths which is an ELF file matching ident"""
+        for path in paths:
+            if get_abi_ident(path) == ident:
+                return path
+        return None
+
+    def _search(self, name, dirs, ident):
+        return self._first_compatible((os.path.join(d, name) for d in dirs), ident)
+
+    def get_deps(self, path, libpath=None):
+        """Returns the paths of all of the libraries path depends on
+
+        The libraries are listed in load (breadth-first) order, followed by the
+        program interpreter, like ldd.
+
+        Parameters:
+        path:       Path to a dynamic ELF file (program or shared object)
+        libpath:    List of additional directories to search first (like
+                    LD_LIBRARY_PATH)
+        """
+        info = read_dyninfo(path)
+        ident = info.ident
+        musl = bool(info.interp) and 'ld-musl' in os.path.basename(info.interp)
+
+        env_dirs = list(libpath or []) + _split_path(os.getenv('LD_LIBRARY_PATH'))
+
+        sys_dirs = None
+        if musl:
+            sys_dirs = self._musl_path_dirs(info.interp)
+        if sys_dirs is None:
+            sys_dirs = self._default_dirs(ident, musl)
+
+        # Libraries already loaded, by DT_NEEDED name and SONAME
+        loaded = {}
+        result = []
+
+        if info.interp:
+            # The interpreter is already loaded. musl's provides libc.so too.
+            for name in (os.path.basename(info.interp), read_dyninfo(info.interp).soname):
+                if name:
+                    loaded[name] = info.interp
+            if musl:
+                loaded['libc.so'] = info.interp
+
+        # (path, info, RPATH directories of the loading objects)
+        queue = [(path, info, [])]
+        for obj_path, obj_info, parent_rpaths in queue:
+            origin = os.path.dirname(os.path.realpath(obj_path)
+                                     if obj_path == path else os.path.abspath(obj_path))
+            rpath = list(self._expand(obj_info.rpath, origin, ident))
+            runpath = list(self._expand(obj_info.runpath, origin, ident))
+
+            # RPATH applies to the dependencies of dependencies too, unless
+            # the object has a RUNPATH
+            if obj_info.runpath and not musl:
+                rpaths = []
+            else:
+                rpaths = rpath + parent_rpaths
+
+            for name in obj_info.needed:
+                if name in loaded:
+                    continue
+
+                if '/' in name:
+                    found = self._first_compatible([name], ident)
+                elif musl:
+                    # musl searches LD_LIBRARY_PATH, then RPATH and RUNPATH
+                    found = (self._search(name, env_dirs, ident)
+                             or self._search(name, rpaths + runpath, ident)
+                             or self._search(name, sys_dirs, ident))
+                else:
+                    found = (self._search(name, rpaths, ident)
+                             or self._search(name, env_dirs, ident)
+                             or self._search(name, runpath, ident))
+                    if not found and not obj_info.flags_1 & DF_1_NODEFLIB:
+                        cached = self._get_cache_entries().get(name, [])
+                        found = (self._first_compatible(cached, ident)
+                                 or self._search(name, sys_dirs, ident))
+
+                if not found:
+                    raise LibraryNotFoundError(name, obj_path)
+                found = os.path.abspath(found)
+
+                dep_info = read_dyninfo(found)
+                loaded[name] = found
+                if dep_info.soname:
+                    loaded.setdefault(dep_info.soname, found)
+                if found not in result:
+                    result.append(found)
+                    queue.append((found, dep_info, rpaths))
+
+        if info.interp and info.interp not in result:
+            result.append(info.interp)
+
+        return result
+
+
+_resolver = Resolver()
+
+
+def _check_deps(path, deps, libpath):
+    """Compare deps to the results of ldd, and warn about any differences"""
+    try:
+        ldd_deps = get_shobj_deps_ldd(path, libpath=libpath)
+    except ToolError as e:
+        logging.warning(f"{STATICX_LDD_CHECK}: ldd failed for {path}: {e}")
+        return
+    # Compare names, as they may be found via different (symlinked) dirs
+    names = {os.path.basename(d) for d in deps}
+    ldd_names = {os.path.basename(d) for d in ldd_deps}
+    if names != ldd_names:
+        logging.warning(f"{STATICX_LDD_CHECK}: Dependencies of {path} differ from ldd:\n"
+                        f"  only found in-process: {sorted(names - ldd_names)}\n"
+                        f"  only found by ldd: {sorted(ldd_names - names)}")
+
+
+def get_shobj_deps(path, libpath=None):
+    """Discover the dependencies of a shared object (*.so file)
+
+    Returns a list of the absolute paths of the libraries.
+    """
+    # Respect an explicitly-chosen ldd, e.g. for a different libc
+    if os.getenv('STATICX_LDD'):
+        return get_shobj_deps_ldd(path, libpath=libpath)
+
+    try:
+        deps = _resolver.get_deps(path, libpath=libpath)
+    except StaticELFError:
+        raise
+    except (LibraryNotFoundError, InvalidInputError, ELFError, OSError) as e:
+        logging.info(f"Falling back to ldd for {path}: {e}")
+        return get_shobj_deps_ldd(path, libpath=libpath)
+
+    if os.getenv(STATICX_LDD_CHECK):
+        _check_deps(path, deps, libpath)
+
+    return deps
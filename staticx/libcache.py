@@ -0,0 +1,185 @@
+"""Persistent cache of prepared libraries, shared by builds
+
+Preparing a library (auditing, patching and stripping it) gives the same
+result every time for the same library contents and options, so the results
+are cached across runs, keyed by a digest of those.
+
+Each entry is a single file named by its key. An empty entry means the
+library is used unchanged. Entries are written to a temporary file which then
+atomically replaces the entry, so any number of builds can share a cache.
+The modification time of an entry is its last use, for LRU eviction.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from tempfile import NamedTemporaryFile
+
+import elftools
+
+from .constants import DEFAULT_CACHE_MAX_SIZE
+from .errors import *
+from .utils import sha256_fileobj
+from .version import __version__
+
+# Bump when the way libraries are prepared changes
+CACHE_FORMAT = 1
+
+_TMP_PREFIX = '.tmp-'
+
+
+def default_cache_dir():
+    """Returns the default cache directory ($XDG_CACHE_HOME/staticx-build)"""
+    xdg = os.getenv('XDG_CACHE_HOME')
+    if xdg and xdg.startswith('/'):
+        return os.path.join(xdg, 'staticx-build')
+    return os.path.expanduser('~/.cache/staticx-build')
+
+
+def env_cache_dir():
+    """Returns the cache directory enabled by the environment, or None
+
+    STATICX_BUILD_CACHE_DIR gives the directory; otherwise, if
+    STATICX_BUILD_CACHE is set, the default one is used.
+    """
+    path = os.getenv('STATICX_BUILD_CACHE_DIR')
+    if path:
+        return path
+    if os.getenv('STATICX_BUILD_CACHE'):
+        return default_cache_dir()
+    return None
+
+
+def parse_size(value):
+    """Parse a size in bytes, with an optional K, M, G, or T suffix"""
+    units = 'KMGT'
+    value = value.strip()
+    shift = 0
+    if value and value[-1].upper() in units:
+        shift = 10 * (units.index(value[-1].upper()) + 1)
+        value = value[:-1]
+    try:
+        size = int(value)
+    except ValueError:
+        raise ValueError(f"Invalid size: {value!r}") from None
+    if size < 0:
+        raise ValueError(f"Invalid size: {value!r}")
+    return size << shift
+
+
+class LibraryCache:
+    def __init__(self, path, max_size=DEFAULT_CACHE_MAX_SIZE):
+        """
+        Parameters:
+        path:       Cache directory (created if necessary)
+        max_size:   Size in bytes above which least-recently-used entries are
+                    evicted, by evict()
+        """
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # get() may be called by several builds' threads at once
+        self._lock = threading.Lock()
+
+        try:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+        except OSError as e:
+            raise InvalidInputError(f"Failed to create cache dir {path}: {e}")
+
+    def get_key(self, libpath, **options):
+        """Returns the cache key for preparing libpath with the given options"""
+        with open(libpath, 'rb') as f:
+            digest = sha256_fileobj(f)
+        key = dict(
+            format = CACHE_FORMAT,
+            staticx = __version__,
+            elftools = elftools.__version__,
+            options = options,
+            sha256 = digest,
+        )
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key, libpath, dest):
+        """Look up a prepared library
+
+        Returns libpath if it is used unchanged, dest (a copy of the cached
+        library) if it was modified, or None if it isn't in the cache.
+        """
+        entry = self._entry_path(key)
+        try:
+            # Mark the entry as recently used
+            os.utime(entry)
+            size = os.stat(entry).st_size
+            if size:
+                _link_or_copy(entry, dest)
+        except FileNotFoundError:
+            # Not cached, or just evicted
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return dest if size else libpath
+
+    def put(self, key, libpath, result):
+        """Store the result (a path) of preparing libpath"""
+        with NamedTemporaryFile(prefix=_TMP_PREFIX, dir=self.path, delete=False) as f:
+            tmp = f.name
+        try:
+            if result != libpath:
+                _link_or_copy(result, tmp, replace=True)
+            os.replace(tmp, self._entry_path(key))
+        except OSError as e:
+            logging.warning(f"Failed to cache {libpath}: {e}")
+            _remove(tmp)
+
+    def evict(self):
+        """Remove least-recently-used entries until within max_size"""
+        entries = []
+        total = 0
+        with os.scandir(self.path) as it:
+            for e in it:
+                try:
+                    st = e.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if e.name.startswith(_TMP_PREFIX):
+                    # Left behind by a crashed build (or in use by another)
+                    if st.st_mtime < time.time() - 3600:
+                        _remove(e.path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            logging.debug(f"Evicting {path} from the library cache")
+            _remove(path)
+            total -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _link_or_copy(src, dst, replace=False):
+    """Hardlink src to dst, or copy it if they're on different filesystems"""
+    if replace:
+        _remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
@@ -0,0 +1,133 @@
+"""Batch manifests, listing programs to staticx in one invocation
+
+A manifest is a TOML file with a [[program]] table for each program, giving
+its prog and output, and optionally any of the options of generate() which can
+differ between programs (see api.BATCH_OPTIONS). Options given at the top level
+(except base, which is specific to each output) apply to every program, unless
+it overrides them:
+
+    strip = true
+    compression = "zstd"
+
+    [[program]]
+    prog = "build/bin/foo"
+    output = "dist/foo"
+
+    [[program]]
+    prog = "build/bin/bar"
+    output = "dist/bar"
+    libs = ["build/lib/libbar-plugin.so"]
+    compression-profile = "size"
+
+Option names may use dashes (like the command line options) or underscores.
+Relative paths are relative to the directory of the manifest.
+"""
+import os
+import sys
+
+from .errors import *
+from .libcache import parse_size
+
+# Expected types of the values of the options (see api.BATCH_OPTIONS)
+_OPTION_TYPES = {
+    'prog':                 str,
+    'output':               str,
+    'libs':                 list,
+    'strip':                bool,
+    'compress':             bool,
+    'debug':                bool,
+    'bundle_dir':           str,
+    'compression':          str,
+    'base':                 str,
+    'prog_name':            str,
+    'compression_profile':  str,
+    'size_budget':          (int, str),
+    'target_threads':       int,
+}
+
+# Options which are paths, relative to the manifest
+_PATH_OPTIONS = ('prog', 'output', 'base')
+
+
+def _import_toml():
+    if sys.version_info >= (3, 11):
+        import tomllib
+        return tomllib
+    try:
+        import tomli
+    except ImportError:
+        raise MissingModuleError('tomli', 'batch') from None
+    return tomli
+
+
+def _parse_options(table, where, basedir):
+    """Returns the options of a manifest table, with paths made absolute"""
+    options = {}
+    for key, value in table.items():
+        name = key.replace('-', '_')
+        if name not in _OPTION_TYPES:
+            raise InvalidInputError(f"Unknown option {key!r} in {where}")
+        if not isinstance(value, _OPTION_TYPES[name]):
+            raise InvalidInputError(f"Invalid value of {key!r} in {where}: {value!r}")
+
+        if name in _PATH_OPTIONS:
+            value = os.path.join(basedir, value)
+        elif name == 'libs':
+            if not all(isinstance(lib, str) for lib in value):
+                raise InvalidInputError(f"Invalid value of {key!r} in {where}: {value!r}")
+            value = [os.path.join(basedir, lib) for lib in value]
+        elif name == 'size_budget' and isinstance(value, str):
+            try:
+                value = parse_size(value)
+            except ValueError as e:
+                raise InvalidInputError(f"Invalid value of {key!r} in {where}: {e}") from None
+        options[name] = value
+    return options
+
+
+def parse_manifest(data, basedir='.', defaults=None):
+    """Parse a batch manifest (a TOML string)
+
+    Parameters:
+    data:       Contents of the manifest
+    basedir:    Directory to which relative paths are relative
+    defaults:   Options for every program which the manifest doesn't set
+
+    Returns a list of builds for generate_many().
+    """
+    toml = _import_toml()
+    try:
+        manifest = toml.loads(data)
+    except toml.TOMLDecodeError as e:
+        raise InvalidInputError(f"Invalid manifest: {e}") from None
+
+    programs = manifest.pop('program', None)
+    if not programs or not isinstance(programs, list):
+        raise InvalidInputError("Manifest has no [[program]] tables")
+
+    common = dict(defaults or {})
+    common.update(_parse_options(manifest, 'the manifest', basedir))
+    if {'prog', 'output', 'base'} & common.keys():
+        raise InvalidInputError("prog, output and base can only be given for each [[program]]")
+
+    builds = []
+    for n, program in enumerate(programs, 1):
+        if not isinstance(program, dict):
+            raise InvalidInputError(f"Invalid [[program]] {n}: {program!r}")
+        build = dict(common)
+        build.update(_parse_options(program, f"[[program]] {n}", basedir))
+        if 'prog' not in build or 'output' not in build:
+            raise InvalidInputError(f"[[program]] {n} needs a prog and output")
+        builds.append(build)
+    return builds
+
+
+def load_manifest(path, defaults=None):
+    """Load a batch manifest from a file (see parse_manifest())"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = f.read()
+    except OSError as e:
+        raise InvalidInputError(f"Failed to read manifest {path}: {e}") from None
+    return parse_manifest(data, basedir=os.path.dirname(os.path.abspath(path)),
+                          defaults=defaults)
@@ -0,0 +1,163 @@
+"""Structured build reports, with timings and size attribution
+
+A report is a dict which can be serialized as JSON (see write_report()), e.g.
+for tracking size and build-time regressions:
+
+    staticx_version:    Version of staticx
+    prog_name:          Name of the program
+    output:             Output path
+    compression:        Compression format and profile used
+    compression_profile
+    output_size:        Size of the output, in bytes
+    archive_size:       Size of the (compressed) archive
+    archive_raw_size:   Size of the archive uncompressed (the tar stream)
+    compression_ratio:  archive_raw_size / archive_size
+    wall_time:          Time the build took, in seconds
+    phases:             {phase: {wall, cpu}} (see Timings)
+    libraries:          [{name, path, wall, cpu}] for the preparation of each
+                        library
+    members:            [{name, type, size, compressed_size, compression_ratio}]
+                        for each archive member
+
+Blocks are compressed as a whole, so the compressed size of a member is
+attributed to it in proportion to the data it has in each block. Tar headers
+and padding aren't attributed to any member.
+"""
+import bisect
+import json
+import tarfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Archive member types, by tar type flag
+_MEMBER_TYPES = {
+    tarfile.REGTYPE:    'file',
+    tarfile.SYMTYPE:    'symlink',
+    tarfile.LNKTYPE:    'hardlink',
+    tarfile.DIRTYPE:    'directory',
+}
+
+
+class Timings:
+    """Wall-clock and CPU time spent in each phase of a build
+
+    The wall-clock time of a phase is only counted on the thread which
+    created this (the one running the build), so the phases add up to the
+    build time; the CPU time of a phase is counted on every thread, e.g. the
+    worker threads preparing libraries and compressing blocks. The time spent
+    in a phase measured within another phase, on the same thread, only counts
+    for the inner one.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self._thread = threading.get_ident()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def measure(self, phase):
+        """Context manager measuring the time spent in phase
+
+        It gives a dict, which is set to the wall-clock and CPU time of this
+        measurement (wherever it was made) at the end.
+        """
+        times = {}
+        stack = self._local.__dict__.setdefault('stack', [])
+        # Time spent in nested phases: [wall, cpu]
+        nested = [0.0, 0.0]
+        stack.append(nested)
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield times
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            stack.pop()
+            if stack:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+            times.update(wall=wall - nested[0], cpu=cpu - nested[1])
+            self._add(phase, **times)
+
+    def get_report(self):
+        """Returns the phases part of a report"""
+        with self._lock:
+            return {phase: {k: round(v, 6) for k, v in times.items()}
+                    for phase, times in self.phases.items()}
+
+    def _add(self, phase, wall, cpu):
+        if threading.get_ident() != self._thread:
+            wall = 0.0
+        with self._lock:
+            times = self.phases.setdefault(phase, dict(wall=0.0, cpu=0.0))
+            times['wall'] += wall
+            times['cpu'] += cpu
+
+
+def attribute_compressed_sizes(entries, blocks):
+    """Returns the compressed size attributed to each archive member
+
+    Parameters:
+    entries:    IndexEntry of each member
+    blocks:     (compressed offset, compressed size, uncompressed size) of each
+                compressed block, or None for an uncompressed archive
+    """
+    if blocks is None:
+        return [e.size for e in entries]
+
+    # Uncompressed start of each block
+    starts = []
+    upos = 0
+    for _, _, usize in blocks:
+        starts.append(upos)
+        upos += usize
+
+    sizes = []
+    for e in entries:
+        csize = 0.0
+        end = e.offset + e.size
+        i = max(bisect.bisect_right(starts, e.offset) - 1, 0)
+        while e.size and i < len(blocks) and starts[i] < end:
+            _, bcsize, busize = blocks[i]
+            overlap = min(end, starts[i] + busize) - max(e.offset, starts[i])
+            csize += bcsize * overlap / busize
+            i += 1
+        sizes.append(round(csize))
+    return sizes
+
+
+def _ratio(raw, compressed):
+    return round(raw / compressed, 3) if compressed else None
+
+
+def get_members_report(entries, blocks):
+    """Returns the members part of a report"""
+    members = []
+    for e, csize in zip(entries, attribute_compressed_sizes(entries, blocks)):
+        members.append(dict(
+            name = e.name,
+            type = _MEMBER_TYPES.get(e.type, e.type.decode()),
+            size = e.size,
+            compressed_size = csize,
+            compression_ratio = _ratio(e.size, csize),
+        ))
+    return members
+
+
+def get_archive_report(archive_size, archive_raw_size):
+    """Returns the archive sizes part of a report"""
+    return dict(
+        archive_size = archive_size,
+        archive_raw_size = archive_raw_size,
+        compression_ratio = _ratio(archive_raw_size, archive_size),
+    )
+
+
+def write_report(report, path):
+    """Write a report (or any JSON-serializable object) to path, as JSON"""
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
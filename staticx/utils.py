@@ -1,5 +1,6 @@
 import os
 import errno
+import hashlib
 import shutil
 from collections.abc import Iterable
 from tempfile import NamedTemporaryFile
@@ -38,6 +39,31 @@ def copy_to_tempfile(srcpath, **kwargs):
     return fdst
 
 
+def sha256_fileobj(f, bufsize=1 << 20):
+    """Compute the SHA-256 hex digest of the remaining content of f"""
+    h = hashlib.sha256()
+    while True:
+        data = f.read(bufsize)
+        if not data:
+            break
+        h.update(data)
+    return h.hexdigest()
+
+
+class HashingWriter:
+    """File object wrapper which computes the SHA-256 of the data written"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+
 def copy_fileobj_to_tempfile(fsrc, **kwargs):
     fdst = NamedTemporaryFile(**kwargs)
     shutil.copyfileobj(fsrc, fdst)
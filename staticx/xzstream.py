@@ -0,0 +1,338 @@
+""".xz streams with any BCJ filter
+
+The lzma module can only use the filters liblzma had when Python was built,
+and (so far) doesn't offer those for ARM64 or RISC-V at all. Streams with those
+filters are written here: the data is filtered (see bcjfilter), compressed as
+raw LZMA2 by liblzma, and wrapped in the .xz container. Streams which liblzma
+can't decode are likewise unwrapped and decoded here. Where the lzma module
+does have a filter, liblzma applies it (much faster), in the same container.
+
+See the .xz file format specification (version 1.2.0) for the container.
+"""
+import hashlib
+import io
+import lzma
+import struct
+import zlib
+from functools import lru_cache
+
+from .bcjfilter import BCJ_CONVERTERS, BCJ_FILTER_IDS
+
+STREAM_HEADER_MAGIC = b'\xFD7zXZ\x00'
+STREAM_FOOTER_MAGIC = b'YZ'
+
+LZMA2_FILTER_ID = 0x21
+
+_CHECK_SIZES = {
+    lzma.CHECK_NONE:    0,
+    lzma.CHECK_CRC32:   4,
+    lzma.CHECK_CRC64:   8,
+    lzma.CHECK_SHA256:  32,
+}
+
+# Size of the pieces in which a block is fed to the decompressor
+_CHUNK_SIZE = 1 << 20
+
+
+def _encode_vli(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _decode_vli(data, pos):
+    value = 0
+    for i in range(9):
+        b = data[pos + i]
+        value |= (b & 0x7F) << (7 * i)
+        if not b & 0x80:
+            return value, pos + i + 1
+    raise lzma.LZMAError("Invalid variable-length integer")
+
+
+def _lzma2_dict_size_prop(dict_size):
+    """Returns the LZMA2 property byte for (at least) dict_size"""
+    for prop in range(40):
+        if (2 | (prop & 1)) << (prop // 2 + 11) >= dict_size:
+            return prop
+    return 40
+
+def _lzma2_dict_size(prop):
+    if prop > 40:
+        raise lzma.LZMAError("Invalid LZMA2 dictionary size")
+    if prop == 40:
+        return 0xFFFFFFFF
+    return (2 | (prop & 1)) << (prop // 2 + 11)
+
+
+def _pad4(data):
+    return data + bytes(-len(data) % 4)
+
+def _crc32(data):
+    return struct.pack('<I', zlib.crc32(data))
+
+
+@lru_cache(maxsize=None)
+def _has_native_filter(arch):
+    """Returns whether liblzma, through the lzma module, has the BCJ filter
+    for arch"""
+    fid = getattr(lzma, 'FILTER_' + arch, None)
+    if fid is None:
+        return False
+    try:
+        lzma.compress(b'', format=lzma.FORMAT_RAW,
+                      filters=[dict(id=fid), dict(id=lzma.FILTER_LZMA2)])
+    except (ValueError, lzma.LZMAError):
+        # Python was built with a newer liblzma than it runs with
+        return False
+    return True
+
+
+def compress(data, filters):
+    """Compress data as a .xz stream
+
+    The stream has a CRC32 check, rather than CRC64 (the liblzma default),
+    which libxz supports unless XZ_USE_CRC64 is enabled in libxz/xz_config.h.
+
+    filters is a filter chain for the lzma module, whose first filter may be
+    a BCJ filter given by its architecture name (e.g. dict(arch='ARM64')).
+    """
+    first = filters[0]
+    arch = first.get('arch')
+    if arch is None:
+        return lzma.compress(data, format=lzma.FORMAT_XZ,
+                             check=lzma.CHECK_CRC32, filters=filters)
+    if arch not in BCJ_CONVERTERS:
+        first = dict(id=getattr(lzma, 'FILTER_' + arch))
+        return lzma.compress(data, format=lzma.FORMAT_XZ,
+                             check=lzma.CHECK_CRC32, filters=[first] + filters[1:])
+
+    # The only filter after a BCJ filter is LZMA2 (with a dict_size)
+    lzma2 = filters[-1]
+    if len(filters) != 2 or lzma2['id'] != lzma.FILTER_LZMA2:
+        raise ValueError(f"Unsupported filter chain for {arch}: {filters}")
+
+    if _has_native_filter(arch):
+        cdata = lzma.compress(data, format=lzma.FORMAT_RAW,
+                              filters=[dict(id=BCJ_FILTER_IDS[arch]), lzma2])
+    else:
+        filtered = bytearray(data)
+        BCJ_CONVERTERS[arch](filtered)
+        cdata = lzma.compress(filtered, format=lzma.FORMAT_RAW, filters=[lzma2])
+
+    flags = bytes([0, lzma.CHECK_CRC32])
+    header = STREAM_HEADER_MAGIC + flags + _crc32(flags)
+
+    # Block header: 2 filters, with the compressed and uncompressed sizes
+    dict_size = lzma2['dict_size']
+    bh = (bytes([0x01 | 0x40 | 0x80]) + _encode_vli(len(cdata)) + _encode_vli(len(data))
+          + _encode_vli(BCJ_FILTER_IDS[arch]) + _encode_vli(0)
+          + _encode_vli(LZMA2_FILTER_ID) + _encode_vli(1)
+          + bytes([_lzma2_dict_size_prop(dict_size)]))
+    bh = _pad4(bytes([(len(bh) + 4) // 4]) + bh)
+    bh += _crc32(bh)
+    assert len(bh) == (bh[0] + 1) * 4
+
+    block = bh + _pad4(cdata) + _crc32(data)
+    unpadded_size = len(bh) + len(cdata) + 4
+
+    index = _pad4(b'\x00' + _encode_vli(1)
+                  + _encode_vli(unpadded_size) + _encode_vli(len(data)))
+    index += _crc32(index)
+
+    backward = struct.pack('<I', len(index) // 4 - 1) + flags
+    footer = _crc32(backward) + backward + STREAM_FOOTER_MAGIC
+
+    return header + block + index + footer
+
+
+def decompress(data):
+    """Decompress data, which may consist of several concatenated .xz streams"""
+    return b''.join(_decode_streams(io.BytesIO(data)))
+
+
+def open(fileobj):
+    """Returns a file object reading the decompressed contents of fileobj
+
+    fileobj may contain several concatenated .xz streams, which are decoded
+    one block at a time.
+    """
+    return io.BufferedReader(_BlockReader(_decode_streams(fileobj)))
+
+
+class _BlockReader(io.RawIOBase):
+    """Reads the data of an iterator of (decoded) blocks"""
+
+    def __init__(self, blocks):
+        self._blocks = blocks
+        self._buf = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            block = next(self._blocks, None)
+            if block is None:
+                return 0
+            self._buf = memoryview(block)
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+
+class _Input:
+    """Reads exact amounts of data from a file object, counting them"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pos = 0
+        self._pushback = b''
+        self._offset = 0
+
+    def read(self, size, exact=True):
+        data = self._pushback[self._offset:self._offset+size]
+        self._offset += len(data)
+        if len(data) < size:
+            data += self.fileobj.read(size - len(data))
+        if exact and len(data) != size:
+            raise lzma.LZMAError("Truncated .xz stream")
+        self.pos += len(data)
+        return data
+
+    def unread(self, data):
+        """Return data (just read) to be read again"""
+        self._pushback = data + self._pushback[self._offset:]
+        self._offset = 0
+        self.pos -= len(data)
+
+
+_CONVERTER_IDS = {BCJ_FILTER_IDS[arch]: arch for arch in BCJ_CONVERTERS}
+
+
+def _decode_streams(fileobj):
+    """Generates the decoded blocks of the .xz streams in fileobj
+
+    The containers are parsed here, and the blocks decoded by liblzma (as raw
+    streams) except for any filter which the lzma module lacks, which is
+    undone here. Unlike lzma.decompress(), this doesn't ignore a stream which
+    can't be decoded (and so, any after it).
+    """
+    inp = _Input(fileobj)
+    while True:
+        magic = inp.read(4, exact=False)
+        if not magic:
+            break
+        if magic == bytes(4):
+            # Stream padding
+            continue
+        inp.unread(magic)
+        yield from _decode_stream(inp)
+
+
+def _parse_block_header(header):
+    """Returns the [(filter ID, properties)] of a block header"""
+    if _crc32(header[:-4]) != header[-4:]:
+        raise lzma.LZMAError("Corrupt .xz block header")
+
+    flags = header[1]
+    p = 2
+    try:
+        if flags & 0x40:
+            _, p = _decode_vli(header, p)
+        if flags & 0x80:
+            _, p = _decode_vli(header, p)
+        filters = []
+        for _ in range((flags & 0x03) + 1):
+            fid, p = _decode_vli(header, p)
+            psize, p = _decode_vli(header, p)
+            filters.append((fid, header[p:p+psize]))
+            p += psize
+    except IndexError:
+        raise lzma.LZMAError("Corrupt .xz block header") from None
+    return filters
+
+
+def _get_block_decoder(filters):
+    """Returns (raw decompressor, BCJ converter or None) for a filter chain"""
+    chain = []
+    convert = None
+    for n, (fid, props) in enumerate(filters):
+        if fid == LZMA2_FILTER_ID:
+            chain.append(dict(id=lzma.FILTER_LZMA2, dict_size=_lzma2_dict_size(props[0])))
+        elif props:
+            # e.g. a BCJ start offset, which staticx doesn't use
+            raise lzma.LZMAError(f"Unsupported properties of filter {fid:#x}")
+        elif n == 0 and fid in _CONVERTER_IDS and not _has_native_filter(_CONVERTER_IDS[fid]):
+            # Only the first filter can be undone after the others
+            convert = BCJ_CONVERTERS[_CONVERTER_IDS[fid]]
+        else:
+            chain.append(dict(id=fid))
+    try:
+        return lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=chain), convert
+    except ValueError as e:
+        raise lzma.LZMAError(f"Unsupported .xz filter chain: {e}") from None
+
+
+def _decode_stream(inp):
+    """Generates the decoded blocks of the .xz stream read from inp"""
+    header = inp.read(12)
+    if header[:6] != STREAM_HEADER_MAGIC or _crc32(header[6:8]) != header[8:12]:
+        raise lzma.LZMAError("Invalid .xz stream header")
+    check = header[7] & 0x0F
+    if check not in _CHECK_SIZES:
+        raise lzma.LZMAError(f"Unsupported .xz check type {check}")
+
+    nblocks = 0
+    while True:
+        start = inp.pos
+        size = inp.read(1)[0]
+        if size == 0x00:
+            # Index indicator
+            break
+        filters = _parse_block_header(bytes([size]) + inp.read(size * 4 + 3))
+        dec, convert = _get_block_decoder(filters)
+
+        block = bytearray()
+        while not dec.eof:
+            chunk = inp.read(_CHUNK_SIZE, exact=False)
+            if not chunk:
+                raise lzma.LZMAError("Truncated .xz stream")
+            block += dec.decompress(chunk)
+        inp.unread(dec.unused_data)
+        if convert:
+            convert(block, encoding=False)
+
+        # Block padding, then the check of the uncompressed data
+        inp.read(-(inp.pos - start) % 4)
+        digest = inp.read(_CHECK_SIZES[check])
+        if check == lzma.CHECK_CRC32 and digest != _crc32(block):
+            raise lzma.LZMAError("Corrupt .xz block (CRC32 mismatch)")
+        if check == lzma.CHECK_SHA256 and digest != hashlib.sha256(block).digest():
+            raise lzma.LZMAError("Corrupt .xz block (SHA-256 mismatch)")
+
+        nblocks += 1
+        yield bytes(block)
+
+    # Index: the records aren't needed, only its size
+    index = bytearray(b'\x00')
+    index += inp.read(1)
+    while index[-1] & 0x80:
+        index += inp.read(1)
+    count, _ = _decode_vli(index, 1)
+    if count != nblocks:
+        raise lzma.LZMAError("Corrupt .xz index")
+    for _ in range(2 * count):
+        index += inp.read(1)
+        while index[-1] & 0x80:
+            index += inp.read(1)
+    index += inp.read(-len(index) % 4)
+    if _crc32(index) != inp.read(4):
+        raise lzma.LZMAError("Corrupt .xz index")
+
+    footer = inp.read(12)
+    if footer[10:12] != STREAM_FOOTER_MAGIC or footer[8:10] != header[6:8]:
+        raise lzma.LZMAError("Invalid .xz stream footer")
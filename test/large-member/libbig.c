@@ -0,0 +1,4 @@
+int big_answer(void)
+{
+    return 42;
+}
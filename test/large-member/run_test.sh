@@ -0,0 +1,40 @@
+#!/bin/bash
+set -e
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Verify bootloader memory use doesn't depend on archive member size"
+
+app="$(which true)"
+outfile="./app.staticx"
+member_mib=256
+max_rss_mib=64
+
+# Each decoder thread holds a decompressed block; keep the bound host-independent
+export STATICX_THREADS=2
+
+# Build a library with a large amount of (compressible) data
+gcc -Wall -Werror -shared -fPIC -o libbig.so libbig.c
+head -c ${member_mib}M /dev/zero > zeros.bin
+objcopy --add-section .bigdata=zeros.bin libbig.so libbig-data.so
+rm zeros.bin
+
+# Make a staticx executable including it
+echo -e "\nMaking staticx executable (\$STATICX_FLAGS=$STATICX_FLAGS):"
+staticx $STATICX_FLAGS -l ./libbig-data.so $app $outfile
+
+# Run that executable, measuring the peak RSS of it and its child
+echo -e "\nRunning staticx executable"
+rss_kib=$(python3 - $outfile <<'PYEOF'
+import resource, subprocess, sys
+subprocess.run([sys.argv[1]], check=True)
+print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+PYEOF
+)
+echo "Peak RSS: $rss_kib KiB (extracting a $member_mib MiB member)"
+
+if (( rss_kib > max_rss_mib * 1024 )); then
+    echo "Peak RSS exceeds $max_rss_mib MiB"
+    exit 1
+fi
@@ -6,9 +6,51 @@ cd "$(dirname "${BASH_SOURCE[0]}")"
 ./date.sh
 ./busybox.sh
 
+# Test each compression format
+./staticx-compression.sh
+
+# Test member deduplication
+./staticx-dedup.sh
+
+# Test parallel library preparation
+./staticx-jobs.sh
+
+# Test the library cache
+./staticx-lib-cache.sh
+
+# Test rebuilding with --base
+./staticx-base.sh
+
+# Test batch mode
+./staticx-batch.sh
+
+# Test the build report
+./staticx-report.sh
+
 # Test environment variables
 ./staticx-env-vars.sh
 
+# Test the bundle cache
+./staticx-cache.sh
+
+# Test the in-memory bundle
+./staticx-memory-bundle.sh
+
+# Test a shared bundle
+./staticx-shared-bundle.sh
+
+# Test a fixed bundle dir
+./staticx-bundle-dir.sh
+
+# Test bundle cleanup
+./staticx-cleanup.sh
+
+# Test exec mode
+./staticx-exec.sh
+
+# Test startup tracing
+./staticx-trace.sh
+
 # Run test an executable linked against musl-libc
 musl/run_test.sh
 
@@ -30,4 +72,7 @@ no-default-lib/run_test.sh
 # Run test against broken NSS
 nss-isolated/run_test.sh
 
+# Verify bootloader memory use with a large archive member
+large-member/run_test.sh
+
 echo "All tests successful!"
@@ -0,0 +1,60 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX rebuild with --base"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+# Uncompressed archives have no blocks to reuse
+if [[ " $STATICX_FLAGS " =~ " --no-compress "|" --compression"[=\ ]"none " ]]; then
+    echo "Archive not compressed... skipping."
+    exit 0
+fi
+
+app="$(which sh)"
+outfile="./sh.staticx"
+
+tmpdir="$(mktemp -d)"
+trap 'rm -rf "$tmpdir"' EXIT
+
+echo -e "\nMaking staticx executable (\$STATICX_FLAGS=$STATICX_FLAGS):"
+staticx $STATICX_FLAGS $app $outfile
+cp $outfile "$tmpdir/first"
+
+# Rebuilding the same program reuses every block, and gives the same output
+echo -e "\nRebuilding staticx executable with --base:"
+staticx $STATICX_FLAGS --base $outfile --loglevel INFO $app $outfile 2>"$tmpdir/log"
+
+if ! grep -E "Reused ([0-9]+) of \1 blocks" "$tmpdir/log" >/dev/null; then
+    echo "Rebuild didn't reuse all blocks:"
+    grep "Reused" "$tmpdir/log"
+    exit 1
+fi
+if ! cmp "$tmpdir/first" $outfile; then
+    echo "Rebuild with --base differs from the original"
+    exit 1
+fi
+
+output=$($outfile -c 'echo hello')
+if [[ "$output" != "hello" ]]; then
+    echo "Unexpected output: \"$output\""
+    exit 1
+fi
+
+# A larger member only changes its own blocks: those of the members after it
+# (e.g. the program) are still reused
+extra_lib="$(ldconfig -p | awk '$1 == "libm.so.6" {print $NF; exit}')"
+echo -e "\nRebuilding staticx executable with --base and an extra library:"
+staticx $STATICX_FLAGS -l "$extra_lib" --base $outfile --loglevel INFO $app "$tmpdir/extra" 2>"$tmpdir/log"
+grep "Reused" "$tmpdir/log"
+if grep -E "Reused 0 of" "$tmpdir/log" >/dev/null; then
+    echo "Rebuild didn't reuse any blocks"
+    exit 1
+fi
+
+output=$("$tmpdir/extra" -c 'echo hello')
+if [[ "$output" != "hello" ]]; then
+    echo "Unexpected output: \"$output\""
+    exit 1
+fi
@@ -0,0 +1,69 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX batch mode"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+tmpdir="$(mktemp -d)"
+trap 'rm -rf "$tmpdir"' EXIT
+
+cat > "$tmpdir/manifest.toml" <<MANIFEST
+strip = true
+
+[[program]]
+prog = "$(which sh)"
+output = "sh.staticx"
+
+[[program]]
+prog = "$(which date)"
+output = "date.staticx"
+MANIFEST
+
+echo -e "\nMaking staticx executables from a manifest (\$STATICX_FLAGS=$STATICX_FLAGS):"
+staticx $STATICX_FLAGS --no-cache --batch "$tmpdir/manifest.toml" | tee "$tmpdir/summary"
+
+output=$("$tmpdir/sh.staticx" -c 'echo hello')
+if [[ "$output" != "hello" ]]; then
+    echo "Unexpected output: \"$output\""
+    exit 1
+fi
+"$tmpdir/date.staticx"
+
+# Each output is the same as when it's built alone
+staticx $STATICX_FLAGS --no-cache --strip "$(which sh)" "$tmpdir/sh-alone.staticx"
+if ! cmp "$tmpdir/sh.staticx" "$tmpdir/sh-alone.staticx"; then
+    echo "Output differs between batch and single builds"
+    exit 1
+fi
+
+# A program which fails doesn't stop the others, but fails the batch
+cat >> "$tmpdir/manifest.toml" <<MANIFEST
+
+[[program]]
+prog = "missing"
+output = "missing.staticx"
+MANIFEST
+rm "$tmpdir/sh.staticx"
+
+echo -e "\nMaking staticx executables from a manifest with a missing program:"
+if staticx $STATICX_FLAGS --no-cache --batch "$tmpdir/manifest.toml" > "$tmpdir/summary"; then
+    echo "Expected the batch to fail"
+    exit 1
+fi
+cat "$tmpdir/summary"
+if ! grep -q "missing.staticx: FAILED" "$tmpdir/summary"; then
+    echo "Failure not reported in the summary"
+    exit 1
+fi
+if [[ ! -x "$tmpdir/sh.staticx" ]]; then
+    echo "Other programs weren't built"
+    exit 1
+fi
+
+# --base is specific to each output, so it can't apply to the whole batch
+if staticx $STATICX_FLAGS --base "$tmpdir/sh.staticx" --batch "$tmpdir/manifest.toml" 2>/dev/null; then
+    echo "Expected --base with --batch to be rejected"
+    exit 1
+fi
@@ -0,0 +1,103 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX fixed bundle dir"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+app="$(which sh)"
+outfile="./sh.staticx"
+
+root="$(mktemp -d)"
+trap "rm -rf $root" EXIT
+
+echo -e "\nMaking staticx executable (\$STATICX_FLAGS=$STATICX_FLAGS):"
+staticx $STATICX_FLAGS --bundle-dir "$root/bundles/%h" $app $outfile
+
+bundle_dir=$($outfile -c 'echo $STATICX_BUNDLE_DIR')
+echo "STATICX_BUNDLE_DIR: $bundle_dir"
+if [[ "$(dirname "$bundle_dir")" != "$root/bundles" ]]; then
+    echo "Bundle dir is not in $root/bundles"
+    exit 1
+fi
+
+# The program was patched at build time, and the bundle is kept for reuse
+prog="$bundle_dir/$(basename $app)"
+if ! readelf -l "$prog" | grep -q "interpreter: $bundle_dir/"; then
+    echo "Program interpreter was not set at build time"
+    exit 1
+fi
+prog_stat="$(stat -c '%i %Y' "$prog")"
+
+output=$($outfile -c 'echo $STATICX_BUNDLE_DIR')
+if [[ "$output" != "$bundle_dir" ]]; then
+    echo "Second run used a different bundle dir: $output"
+    exit 1
+fi
+if [[ "$(stat -c '%i %Y' "$prog")" != "$prog_stat" ]]; then
+    echo "Bundle was extracted again"
+    exit 1
+fi
+
+# A damaged bundle is extracted again
+rm "$prog"
+$outfile -c 'exit 0'
+if [ ! -f "$prog" ]; then
+    echo "Damaged bundle was not repaired"
+    exit 1
+fi
+
+# An existing directory which isn't a bundle is left alone, and a temporary
+# bundle dir used instead
+mkdir -p "$root/other"
+touch "$root/other/keep"
+staticx $STATICX_FLAGS --bundle-dir "$root/other" $app $outfile
+output=$($outfile -c 'echo $STATICX_BUNDLE_DIR' 2>"$root/log")
+if [[ "$output" == "$root/other" ]] || [ ! -f "$root/other/keep" ]; then
+    echo "Existing directory was used as a bundle dir"
+    exit 1
+fi
+if ! grep -q "it exists and is not a staticx bundle" "$root/log"; then
+    echo "Unexpected error:"
+    cat "$root/log"
+    exit 1
+fi
+
+# A sticky parent dir which anyone can write to (like /tmp) can be used
+mkdir -m 1777 "$root/sticky"
+staticx $STATICX_FLAGS --bundle-dir "$root/sticky/%h" $app $outfile
+output=$($outfile -c 'echo $STATICX_BUNDLE_DIR')
+if [[ "$(dirname "$output")" != "$root/sticky" ]]; then
+    echo "Bundle dir in a sticky dir was not used: $output"
+    exit 1
+fi
+
+# A parent dir owned by someone else is not, with the reason
+if [[ $(id -u) -eq 0 ]]; then
+    mkdir "$root/theirs"
+    chown nobody "$root/theirs"
+    staticx $STATICX_FLAGS --bundle-dir "$root/theirs/%h" $app $outfile
+    output=$($outfile -c 'echo $STATICX_BUNDLE_DIR' 2>"$root/log")
+    if [[ "$(dirname "$output")" == "$root/theirs" ]] || \
+            ! grep -q "is owned by uid" "$root/log"; then
+        echo "Bundle dir owned by another user was used: $output"
+        cat "$root/log"
+        exit 1
+    fi
+fi
+
+# In a sticky dir, a lock file someone else created first is not trusted
+if [[ $(id -u) -eq 0 ]]; then
+    touch "$root/sticky/squatted.lock"
+    chown nobody "$root/sticky/squatted.lock"
+    chmod 666 "$root/sticky/squatted.lock"
+    staticx $STATICX_FLAGS --bundle-dir "$root/sticky/squatted" $app $outfile
+    output=$($outfile -c 'echo $STATICX_BUNDLE_DIR' 2>"$root/log")
+    if [[ "$output" == "$root/sticky/squatted" ]] || \
+            ! grep -q "is owned by another user" "$root/log"; then
+        echo "Lock file owned by another user was used: $output"
+        cat "$root/log"
+        exit 1
+    fi
+fi
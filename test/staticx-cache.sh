@@ -0,0 +1,74 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX bundle cache"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+app="$(which sh)"
+outfile="./sh.staticx"
+outfile2="./sh-strip.staticx"
+
+echo -e "\nMaking staticx executable (\$STATICX_FLAGS=$STATICX_FLAGS):"
+staticx $STATICX_FLAGS $app $outfile
+
+cache_dir="$(mktemp -d)"
+trap 'rm -rf "$cache_dir"' EXIT
+export STATICX_CACHE_DIR="$cache_dir"
+
+# The first run populates the cache
+bundle_dir=$($outfile -c 'echo $STATICX_BUNDLE_DIR')
+echo "STATICX_BUNDLE_DIR: $bundle_dir"
+if [[ "$(dirname "$bundle_dir")" != "$STATICX_CACHE_DIR" ]]; then
+    echo "STATICX_BUNDLE_DIR not in cache: \"$bundle_dir\""
+    exit 1
+fi
+if [ ! -d "$bundle_dir" ]; then
+    echo "Cached bundle dir was removed: \"$bundle_dir\""
+    exit 1
+fi
+
+# Later runs reuse it
+bundle_dir2=$($outfile -c 'echo $STATICX_BUNDLE_DIR')
+if [[ "$bundle_dir2" != "$bundle_dir" ]]; then
+    echo "Cached bundle dir not reused: \"$bundle_dir2\" != \"$bundle_dir\""
+    exit 1
+fi
+
+# A different archive evicts the first when over the size limit. It has an
+# extra library, so it differs whatever $STATICX_FLAGS are.
+extra_lib="$(ldconfig -p | awk '$1 == "libm.so.6" {print $NF; exit}')"
+staticx $STATICX_FLAGS -l "$extra_lib" $app $outfile2
+STATICX_CACHE_MAX_SIZE=1 $outfile2 -c true
+if [ -d "$bundle_dir" ]; then
+    echo "Cached bundle dir not evicted: \"$bundle_dir\""
+    exit 1
+fi
+
+# An in-use entry must not be evicted
+$outfile -c 'sleep 2' &
+sleep 1
+STATICX_CACHE_MAX_SIZE=1 $outfile2 -c true
+if [ ! -d "$bundle_dir" ]; then
+    echo "In-use cached bundle dir was evicted: \"$bundle_dir\""
+    exit 1
+fi
+wait
+
+# A damaged entry is detected (using the archive index) and repopulated
+libc="$(ls "$bundle_dir"/libc.so.*)"
+: > "$libc"
+$outfile -c true
+if [ ! -s "$libc" ]; then
+    echo "Damaged cached bundle dir was not repopulated: \"$bundle_dir\""
+    exit 1
+fi
+
+# Without a cache dir, a temporary bundle dir is used
+unset STATICX_CACHE_DIR
+bundle_dir3=$($outfile -c 'echo $STATICX_BUNDLE_DIR')
+if [[ "$bundle_dir3" != "/tmp/staticx-"* ]]; then
+    echo "STATICX_BUNDLE_DIR looks wrong: \"$bundle_dir3\""
+    exit 1
+fi
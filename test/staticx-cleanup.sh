@@ -0,0 +1,66 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX bundle cleanup"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+app="$(which sh)"
+outfile="./sh.staticx"
+
+echo -e "\nMaking staticx executable (\$STATICX_FLAGS=$STATICX_FLAGS):"
+staticx $STATICX_FLAGS $app $outfile
+
+# Files, nested directories, and a symlink which must not be followed
+keep_dir="$(mktemp -d)"
+touch "$keep_dir/keep"
+make_tree='d=$STATICX_BUNDLE_DIR; mkdir -p $d/a/b/c; touch $d/a/b/c/f $d/a/g;
+    ln -s '"$keep_dir"' $d/a/link; echo $d'
+
+check_removed() {
+    local bundle_dir="$1"
+    for i in $(seq 50); do
+        [ -e "$bundle_dir" ] || break
+        sleep 0.1
+    done
+    if [ -e "$bundle_dir" ]; then
+        echo "Bundle dir was not removed: \"$bundle_dir\""
+        exit 1
+    fi
+    if [ ! -e "$keep_dir/keep" ]; then
+        echo "Cleanup followed a symlink out of the bundle dir"
+        exit 1
+    fi
+}
+
+echo -e "\nSynchronous cleanup:"
+bundle_dir=$($outfile -c "$make_tree")
+if [ -e "$bundle_dir" ]; then
+    echo "Bundle dir was not removed: \"$bundle_dir\""
+    exit 1
+fi
+check_removed "$bundle_dir"
+
+echo -e "\nBackground cleanup:"
+export STATICX_CLEANUP=background
+bundle_dir=$($outfile -c "$make_tree")
+check_removed "$bundle_dir"
+
+# Verify the exit status is the program's
+set +e
+$outfile -c 'exit 42'
+rc=$?
+$outfile -c 'kill -TERM $$'
+sig_rc=$?
+set -e
+if [[ $rc -ne 42 ]]; then
+    echo "Wrong exit status: $rc"
+    exit 1
+fi
+if [[ $sig_rc -ne $((128 + 15)) ]]; then
+    echo "Wrong exit status after SIGTERM: $sig_rc"
+    exit 1
+fi
+
+rm -r "$keep_dir"
@@ -0,0 +1,32 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX compression formats"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+app="$(which sh)"
+outfile="./sh.staticx"
+
+for compression in xz zstd lz4 none; do
+    echo -e "\nMaking staticx executable with --compression=$compression (\$STATICX_FLAGS=$STATICX_FLAGS):"
+    staticx $STATICX_FLAGS --compression=$compression $app $outfile
+
+    output=$($outfile -c 'echo hello')
+    if [[ "$output" != "hello" ]]; then
+        echo "Unexpected output with $compression: \"$output\""
+        exit 1
+    fi
+done
+
+for profile in size startup auto; do
+    echo -e "\nMaking staticx executable with --compression-profile=$profile (\$STATICX_FLAGS=$STATICX_FLAGS):"
+    staticx $STATICX_FLAGS --compression-profile=$profile $app $outfile
+
+    output=$($outfile -c 'echo hello')
+    if [[ "$output" != "hello" ]]; then
+        echo "Unexpected output with profile $profile: \"$output\""
+        exit 1
+    fi
+done
@@ -0,0 +1,36 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX member deduplication"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+app="$(which sh)"
+outfile="./sh.staticx"
+
+tmpdir="$(mktemp -d)"
+trap 'rm -rf "$tmpdir"' EXIT
+
+# Add a copy of libc under another name; it is stored as a hardlink
+libc="$(ldd $app | awk '/libc\.so/ { print $3 }')"
+cp "$libc" "$tmpdir/libdup.so"
+
+echo -e "\nMaking staticx executable (\$STATICX_FLAGS=$STATICX_FLAGS):"
+staticx $STATICX_FLAGS -l "$tmpdir/libdup.so" $app $outfile
+
+if ! sx-extract -v $outfile | grep "link to libdup.so" >/dev/null; then
+    echo "libc was not stored as a hardlink"
+    exit 1
+fi
+
+# Both names refer to the same file in the bundle
+libc_name="$(basename "$libc")"
+output=$(STATICX_KEEP_TEMPS=1 $outfile -c \
+    'cd $STATICX_BUNDLE_DIR && echo $(stat -c %i libdup.so '"$libc_name"') $PWD')
+read ino1 ino2 bundle_dir <<< $output
+rm -rf "$bundle_dir"
+if [[ -z "$ino1" || "$ino1" != "$ino2" ]]; then
+    echo "Unexpected output: \"$output\""
+    exit 1
+fi
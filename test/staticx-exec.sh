@@ -0,0 +1,52 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX exec mode"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+app="$(which sh)"
+outfile="./sh.staticx"
+
+echo -e "\nMaking staticx executable (\$STATICX_FLAGS=$STATICX_FLAGS):"
+staticx $STATICX_FLAGS $app $outfile
+
+export STATICX_EXEC=1
+real_outfile="$(realpath $outfile)"
+
+# Verify the program is not running as a child of the bootloader
+output=$($outfile -c 'echo $STATICX_BUNDLE_DIR $(readlink /proc/$PPID/exe)')
+read bundle_dir parent_exe <<< "$output"
+echo "STATICX_BUNDLE_DIR: $bundle_dir"
+echo "Parent: $parent_exe"
+if [[ "$parent_exe" == "$real_outfile" ]]; then
+    echo "Program was run as a child of the bootloader"
+    exit 1
+fi
+
+# The bundle dir is removed (asynchronously) after the program exits
+for i in $(seq 50); do
+    [ -e "$bundle_dir" ] || break
+    sleep 0.1
+done
+if [ -e "$bundle_dir" ]; then
+    echo "Bundle dir was not removed: \"$bundle_dir\""
+    exit 1
+fi
+
+# Verify the exit status is the program's
+set +e
+$outfile -c 'exit 42'
+rc=$?
+$outfile -c 'kill -TERM $$'
+sig_rc=$?
+set -e
+if [[ $rc -ne 42 ]]; then
+    echo "Wrong exit status: $rc"
+    exit 1
+fi
+if [[ $sig_rc -ne $((128 + 15)) ]]; then
+    echo "Wrong exit status after SIGTERM: $sig_rc"
+    exit 1
+fi
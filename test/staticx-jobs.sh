@@ -0,0 +1,31 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX parallel library preparation and compression"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+app="$(which sh)"
+outfile="./sh.staticx"
+
+tmpdir="$(mktemp -d)"
+trap 'rm -rf "$tmpdir"' EXIT
+
+# The output must be the same regardless of the number of jobs
+for jobs in 1 4; do
+    echo -e "\nMaking staticx executable with --jobs=$jobs (\$STATICX_FLAGS=$STATICX_FLAGS):"
+    staticx $STATICX_FLAGS --jobs=$jobs $app $outfile
+    cp $outfile "$tmpdir/out-$jobs"
+
+    output=$($outfile -c 'echo hello')
+    if [[ "$output" != "hello" ]]; then
+        echo "Unexpected output with --jobs=$jobs: \"$output\""
+        exit 1
+    fi
+done
+
+if ! cmp "$tmpdir/out-1" "$tmpdir/out-4"; then
+    echo "Output differs between serial and parallel builds"
+    exit 1
+fi
@@ -0,0 +1,40 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX library cache"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+app="$(which sh)"
+outfile="./sh.staticx"
+
+tmpdir="$(mktemp -d)"
+trap 'rm -rf "$tmpdir"' EXIT
+cachedir="$tmpdir/cache"
+
+# The first build populates the cache; the second uses only cached libraries
+for run in 1 2; do
+    echo -e "\nMaking staticx executable (run $run) (\$STATICX_FLAGS=$STATICX_FLAGS):"
+    staticx $STATICX_FLAGS --strip --cache-dir "$cachedir" --loglevel INFO \
+        $app $outfile 2>"$tmpdir/log"
+
+    output=$($outfile -c 'echo hello')
+    if [[ "$output" != "hello" ]]; then
+        echo "Unexpected output (run $run): \"$output\""
+        exit 1
+    fi
+done
+
+if ! grep "Library cache: [0-9]* hits, 0 misses" "$tmpdir/log" >/dev/null; then
+    echo "Second build didn't use the library cache:"
+    grep "Library cache" "$tmpdir/log"
+    exit 1
+fi
+
+# The cache is limited in size
+staticx $STATICX_FLAGS --strip --cache-dir "$cachedir" --cache-max-size 0 $app $outfile
+if [[ -n "$(ls -A "$cachedir")" ]]; then
+    echo "Library cache not evicted"
+    exit 1
+fi
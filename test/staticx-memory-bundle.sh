@@ -0,0 +1,42 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX in-memory bundle"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+app="$(which sh)"
+outfile="./sh.staticx"
+
+echo -e "\nMaking staticx executable (\$STATICX_FLAGS=$STATICX_FLAGS):"
+staticx $STATICX_FLAGS $app $outfile
+
+export STATICX_MEMORY_BUNDLE=1
+
+# Namespaces may be unavailable (e.g. unprivileged user namespaces disabled)
+if $outfile -c true 2>&1 | grep -q "In-memory bundle unavailable"; then
+    echo "In-memory bundle unavailable; skipping"
+    exit 0
+fi
+
+# Verify the bundle dir is a tmpfs, and the program still runs from it
+output=$($outfile -c 'echo $STATICX_BUNDLE_DIR $(stat -f -c %T $STATICX_BUNDLE_DIR)')
+read bundle_dir fstype <<< "$output"
+echo "STATICX_BUNDLE_DIR: $bundle_dir ($fstype)"
+if [[ "$fstype" != "tmpfs" ]]; then
+    echo "Bundle dir is not a tmpfs: \"$fstype\""
+    exit 1
+fi
+
+# The mount point is removed afterwards
+if [ -e "$bundle_dir" ]; then
+    echo "Bundle dir was not removed: \"$bundle_dir\""
+    exit 1
+fi
+
+# The mount is not visible outside of the program
+if grep -q " $bundle_dir " /proc/self/mountinfo; then
+    echo "Bundle dir mount leaked: \"$bundle_dir\""
+    exit 1
+fi
@@ -0,0 +1,48 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX build report"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+app="$(which sh)"
+outfile="./sh.staticx"
+
+tmpdir="$(mktemp -d)"
+trap 'rm -rf "$tmpdir"' EXIT
+
+echo -e "\nMaking staticx executable with --report (\$STATICX_FLAGS=$STATICX_FLAGS):"
+staticx $STATICX_FLAGS --report "$tmpdir/report.json" $app $outfile
+
+output=$($outfile -c 'echo hello')
+if [[ "$output" != "hello" ]]; then
+    echo "Unexpected output: \"$output\""
+    exit 1
+fi
+
+python3 - "$tmpdir/report.json" "$outfile" <<'PYTHON'
+import json
+import os
+import sys
+
+with open(sys.argv[1]) as f:
+    report = json.load(f)
+
+assert report['output_size'] == os.path.getsize(sys.argv[2]), report['output_size']
+for phase in ('bootloader', 'hooks', 'dependencies', 'prepare', 'tar', 'sections'):
+    assert phase in report['phases'], phase
+
+# The phases account for the build time, on the main thread
+total = sum(t['wall'] for t in report['phases'].values())
+assert total <= report['wall_time'] + 0.001, (total, report['wall_time'])
+
+names = {m['name'] for m in report['members']}
+assert 'sh' in names and 'libc.so.6' in names, names
+assert {lib['name'] for lib in report['libraries']} <= names
+
+# Everything but tar headers and padding is attributed to a member
+attributed = sum(m['compressed_size'] for m in report['members'])
+assert attributed <= report['archive_size'], (attributed, report['archive_size'])
+print(f"Report: {report['output_size']} bytes in {report['wall_time']:.2f} s")
+PYTHON
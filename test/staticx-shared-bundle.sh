@@ -0,0 +1,51 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX shared bundle"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+app="$(which sh)"
+outfile="./sh.staticx"
+
+echo -e "\nMaking staticx executable (\$STATICX_FLAGS=$STATICX_FLAGS):"
+staticx $STATICX_FLAGS $app $outfile
+
+export TMPDIR="$(mktemp -d)"
+trap "rm -rf $TMPDIR" EXIT
+export STATICX_SHARED_BUNDLE=1
+
+check_empty() {
+    local shared_root="$TMPDIR/staticx-shared-$(id -u)"
+    if [ -n "$(ls -A "$shared_root")" ]; then
+        echo "Shared bundle was not removed:"
+        ls -A "$shared_root"
+        exit 1
+    fi
+}
+
+# Concurrent launches share one bundle dir
+outputs="$TMPDIR/outputs"
+for i in $(seq 5); do
+    $outfile -c 'echo $STATICX_BUNDLE_DIR; sleep 1' >> "$outputs" &
+done
+wait
+cat "$outputs"
+if [[ $(sort -u "$outputs" | wc -l) -ne 1 ]]; then
+    echo "Concurrent launches used different bundle dirs"
+    exit 1
+fi
+rm "$outputs"
+
+# The last one out removes it
+check_empty
+
+# A launcher which is killed doesn't keep the bundle alive
+$outfile -c 'sleep 1' &
+pid=$!
+sleep 0.5
+kill -KILL $pid
+wait $pid || true
+$outfile -c 'exit 0'
+check_empty
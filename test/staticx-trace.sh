@@ -0,0 +1,58 @@
+#!/bin/bash
+set -e
+
+echo -e "\n\n--------------------------------------------------------------------------------"
+echo -e "Test StaticX startup tracing"
+
+cd "$(dirname "${BASH_SOURCE[0]}")"
+
+app="$(which sh)"
+outfile="./sh.staticx"
+
+echo -e "\nMaking staticx executable (\$STATICX_FLAGS=$STATICX_FLAGS):"
+staticx $STATICX_FLAGS $app $outfile
+
+trace_file="$(mktemp)"
+trap 'rm -f "$trace_file"' EXIT
+
+# Tracing to a file must not disturb the program's output
+output=$(STATICX_TRACE="$trace_file" $outfile -c 'echo hello')
+if [[ "$output" != "hello" ]]; then
+    echo "Unexpected output: \"$output\""
+    exit 1
+fi
+
+# Verify each line is JSON, and each phase is reported
+python3 - "$trace_file" <<'PYEOF'
+import json, sys
+with open(sys.argv[1]) as f:
+    events = [json.loads(line) for line in f]
+for e in events:
+    print(e)
+phases = {e['phase'] for e in events}
+expected = {'start', 'identify', 'mmap', 'find_sections', 'member', 'decode',
+            'extract', 'patch', 'spawn', 'child', 'cleanup', 'exit'}
+missing = expected - phases
+if missing:
+    sys.exit(f"Missing phases: {missing}")
+PYEOF
+
+# Member names needn't be UTF-8, but the trace must still be valid JSON
+tmpdir="$(mktemp -d)"
+trap 'rm -f "$trace_file"; rm -rf "$tmpdir"' EXIT
+extra_lib="$(ldconfig -p | awk '$1 == "libm.so.6" {print $NF; exit}')"
+odd_lib="$tmpdir/"$'lib\xff-caf\xc3\xa9.so'
+cp "$extra_lib" "$odd_lib"
+
+echo -e "\nMaking staticx executable with a non-UTF-8 library name:"
+staticx $STATICX_FLAGS -l "$odd_lib" $app $outfile
+STATICX_TRACE="$trace_file" $outfile -c 'exit 0'
+
+python3 - "$trace_file" <<'PYEOF'
+import json, sys
+with open(sys.argv[1], encoding='utf-8') as f:
+    events = [json.loads(line) for line in f]
+names = {e['name'] for e in events if e['phase'] == 'member'}
+if 'libÿ-café.so' not in names:
+    sys.exit(f"Non-UTF-8 member name not escaped: {names}")
+PYEOF
@@ -0,0 +1,129 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from staticx.api import PreparedLibraries, StaticxGenerator, expand_bundle_dir, generate_many
+from staticx.errors import InvalidInputError
+
+HASH = 'ab' * 32
+
+def test_expand_bundle_dir_hash():
+    assert expand_bundle_dir('/run/staticx/%h', HASH) == '/run/staticx/' + HASH
+
+def test_expand_bundle_dir_fixed():
+    assert expand_bundle_dir('/opt/app/', HASH) == '/opt/app'
+
+def test_expand_bundle_dir_percent():
+    assert expand_bundle_dir('/run/100%%', HASH) == '/run/100%'
+
+@pytest.mark.parametrize('template', [
+    'relative/%h',
+    '/',
+    '/run/%x',
+    '/run/%',
+    '/run/a:b',
+    '/run/$ORIGIN',
+    '/' + 'x' * 300,
+])
+def test_expand_bundle_dir_invalid(template):
+    with pytest.raises(InvalidInputError):
+        expand_bundle_dir(template, HASH)
+
+
+def test_appends_in_order():
+    appended = []
+    futures = [Future() for _ in range(3)]
+
+    with StaticxGenerator('/bin/true', jobs=2) as gen:
+        for i, future in enumerate(futures):
+            gen._enqueue(future, lambda result, i=i: appended.append((i, result)))
+        gen._enqueue(None, lambda _: appended.append((3, None)))
+
+        # Appends wait for all previous futures
+        futures[2].set_result('c')
+        futures[1].set_result('b')
+        assert appended == []
+        futures[0].set_result('a')
+        gen._append_ready()
+        assert appended == [(0, 'a'), (1, 'b'), (2, 'c'), (3, None)]
+
+
+def test_invalid_jobs():
+    with pytest.raises(InvalidInputError):
+        StaticxGenerator('/bin/true', jobs=0)
+
+
+def test_prog_as_bytes():
+    with open('/bin/true', 'rb') as f:
+        data = f.read()
+
+    with StaticxGenerator(data, prog_name='true') as gen:
+        assert gen.prog_name == 'true'
+        with open(gen.orig_prog, 'rb') as f:
+            assert f.read() == data
+
+
+def test_prog_as_fileobj():
+    with open('/bin/true', 'rb') as f:
+        with StaticxGenerator(f) as gen:
+            assert gen.prog_name == 'true'
+            assert gen.orig_prog != '/bin/true'
+
+
+def test_prog_as_bytes_without_name():
+    with pytest.raises(InvalidInputError):
+        StaticxGenerator(b'\x7fELF')
+
+
+def test_prepared_libraries_once(tmp_path):
+    lib = tmp_path / 'libfoo.so'
+    lib.write_bytes(b'library')
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def prepare(libpath, tmpdir):
+        calls.append(libpath)
+        started.set()
+        release.wait()
+        return os.path.join(tmpdir, 'copy')
+
+    with PreparedLibraries() as prepared:
+        with ThreadPoolExecutor(2) as pool:
+            first = pool.submit(prepared.get, str(lib), False, prepare)
+            started.wait()
+            # The second caller waits for the first
+            second = pool.submit(prepared.get, str(lib), False, prepare)
+            release.set()
+            assert first.result() == second.result()
+        assert calls == [str(lib)]
+        assert first.result().startswith(prepared.tmpdir)
+
+        # Different options are prepared separately
+        prepared.get(str(lib), True, prepare)
+        assert len(calls) == 2
+
+
+def test_prepared_libraries_error(tmp_path):
+    lib = tmp_path / 'libfoo.so'
+    lib.write_bytes(b'library')
+
+    def prepare(libpath, tmpdir):
+        raise InvalidInputError("bad library")
+
+    with PreparedLibraries() as prepared:
+        for _ in range(2):
+            with pytest.raises(InvalidInputError):
+                prepared.get(str(lib), False, prepare)
+
+
+@pytest.mark.parametrize('builds', [
+    [dict(prog='/bin/true')],
+    [dict(prog='/bin/true', output='a', jobs=2)],
+    [dict(prog='/bin/true', output='a'), dict(prog='/bin/false', output='./a')],
+])
+def test_generate_many_invalid(builds):
+    with pytest.raises(InvalidInputError):
+        generate_many(builds)
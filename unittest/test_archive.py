@@ -0,0 +1,290 @@
+import hashlib
+import io
+import lzma
+import os
+import struct
+import tarfile
+
+import pytest
+
+from staticx.archive import (BlockSource, SxArchive, XZBlockWriter, decompress,
+                             parse_block_info, parse_block_table, parse_index)
+from staticx.constants import ARCHIVE_ALIGN, BLOCK_TABLE_MAGIC, BLOCK_TABLE_VERSION, PAD_DIRNAME
+
+
+def parse_block_table(table):
+    magic, version, count = struct.unpack_from('<4sIQ', table)
+    assert magic == BLOCK_TABLE_MAGIC
+    assert version == BLOCK_TABLE_VERSION
+    assert len(table) == 16 + 24*count
+    return [struct.unpack_from('<QQQ', table, 16 + 24*i) for i in range(count)]
+
+
+def write_blocks(data, block_size, jobs=1):
+    f = io.BytesIO()
+    w = XZBlockWriter(f, block_size=block_size, jobs=jobs)
+    w.write(data[:1000])
+    w.write(data[1000:])
+    assert w.tell() == len(data)
+    w.close()
+    return f.getvalue(), parse_block_table(w.get_block_table())
+
+
+def test_xz_block_writer_blocks():
+    data = os.urandom(10000)
+    cdata, blocks = write_blocks(data, block_size=4096)
+
+    assert [usize for _, _, usize in blocks] == [4096, 4096, 1808]
+
+    # Each block is an independent stream
+    coffset = uoffset = 0
+    for offset, csize, usize in blocks:
+        assert offset == coffset
+        block = lzma.decompress(cdata[offset:offset+csize], format=lzma.FORMAT_XZ)
+        assert block == data[uoffset:uoffset+usize]
+        coffset += csize
+        uoffset += usize
+    assert coffset == len(cdata)
+
+    # The whole thing is also a valid (multi-stream) xz file
+    assert lzma.decompress(cdata) == data
+
+
+def test_xz_block_writer_parallel():
+    # Parallel compression gives the same result
+    data = os.urandom(1000) * 50
+    assert write_blocks(data, block_size=4096, jobs=4) == write_blocks(data, block_size=4096)
+
+
+def test_xz_block_writer_empty():
+    cdata, blocks = write_blocks(b'', block_size=4096)
+    assert cdata == b''
+    assert blocks == []
+
+
+def write_members(members, block_size=4096, base=None):
+    """Write members (a list of data), each as a member started with
+    start_member(); returns the BlockWriter, and the BlockSource of the result"""
+    f = io.BytesIO()
+    w = XZBlockWriter(f, block_size=block_size, base=base)
+    for data in members:
+        w.start_member(len(data))
+        w.write(data)
+    w.close()
+    source = BlockSource(io.BytesIO(f.getvalue()), 0, w.blocks,
+                         parse_block_info(w.get_block_info()))
+    return w, source
+
+
+def test_xz_block_writer_base():
+    data = os.urandom(10000)
+    w, base = write_members([data])
+    assert base.compression == 'xz'
+    cdata = base.fileobj.getvalue()
+
+    # Change only the last block
+    new = data[:9000] + b'x' * 1000
+    f = io.BytesIO()
+    w2 = XZBlockWriter(f, block_size=4096, base=base)
+    w2.write(new)
+    w2.close()
+    assert w2.reused == 2
+
+    assert w2.blocks[:2] == w.blocks[:2]
+    assert f.getvalue()[:w.blocks[2][0]] == cdata[:w.blocks[2][0]]
+    assert lzma.decompress(f.getvalue()) == new
+
+
+def test_xz_block_writer_member_blocks():
+    # Large members start a new block, so a change to the size of one doesn't
+    # stop the blocks of those after it from being reused
+    small, a, b = os.urandom(100), os.urandom(5000), os.urandom(9000)
+    w, base = write_members([small, a, b])
+    assert [usize for _, _, usize in w.blocks] == [100, 4096, 904, 4096, 4096, 808]
+
+    w2, _ = write_members([small, a + b'x' * 10, b], base=base)
+    assert w2.reused == 5
+    assert w2.get_block_offset(100 + 5010) == w2.blocks[3][0]
+
+
+def test_xz_block_writer_base_settings():
+    _, base = write_members([os.urandom(1000)])
+    with pytest.raises(ValueError):
+        XZBlockWriter(io.BytesIO(), block_size=4096, base=base, profile='size')
+
+
+def test_block_source_verifies():
+    data = os.urandom(5000)
+    w, base = write_members([data])
+    (d0, a0), (d1, a1) = w.block_keys
+
+    # Blocks are reused by data digest and BCJ filter
+    assert base.get(d0) == base.fileobj.getvalue()[:w.blocks[0][1]]
+    assert base.get(d0, 'X86') is None
+
+    # A block which doesn't match the block info isn't
+    settings, keys = parse_block_info(w.get_block_info())
+    bad = BlockSource(base.fileobj, 0, w.blocks, (settings, keys[::-1]))
+    assert bad.get(d0) is None
+    assert bad.get(d1) is None
+
+
+def test_xz_block_writer_bcj():
+    # Each block is filtered for the machine code making up most of it
+    f = io.BytesIO()
+    w = XZBlockWriter(f, block_size=4096)
+    w.mark_code(0, 3000, 'ARM64')
+    w.mark_code(5000, 1000, 'X86')
+    w.mark_code(8192, 5000, 'RISCV')
+    data = os.urandom(4 * 4096)
+    w.write(data)
+    w.close()
+    assert w.bcj_blocks == {'ARM64': 1, None: 2, 'RISCV': 1}
+    assert decompress(f.getvalue()) == data
+
+
+def test_uncompressed_archive_alignment(tmp_path):
+    # Include a long name, which needs an extra GNU longname header
+    names = ['a', 'b' * 200, 'c', 'empty']
+    sizes = [1, 5000, 4096, 0]
+
+    arpath = tmp_path / 'archive.tar'
+    with open(arpath, 'wb') as f:
+        with SxArchive(f, mode='w', compression='none') as ar:
+            for name, size in zip(names, sizes):
+                path = tmp_path / 'file'
+                path.write_bytes(os.urandom(size))
+                with open(path, 'rb') as mf:
+                    ar.add_fileobj(name, mf)
+
+    with tarfile.open(arpath) as t:
+        members = [m for m in t.getmembers() if m.isreg()]
+        assert [m.name for m in members] == names
+        for m in members:
+            if m.size:
+                assert m.offset_data % ARCHIVE_ALIGN == 0
+
+
+def build_archive(tmp_path, compression, files):
+    arpath = tmp_path / 'archive.tar'
+    with open(arpath, 'wb') as f:
+        with SxArchive(f, mode='w', compression=compression) as ar:
+            for name, data in files.items():
+                path = tmp_path / 'file'
+                path.write_bytes(data)
+                with open(path, 'rb') as mf:
+                    ar.add_fileobj(name, mf)
+            ar.add_symlink('link', 'a')
+    return arpath.read_bytes(), ar
+
+
+@pytest.mark.parametrize('compression', ['none', 'xz', 'zstd', 'lz4'])
+def test_archive_index(tmp_path, compression):
+    files = {
+        'a': os.urandom(5000),
+        'b': b'',
+        'c': os.urandom(3 * 4096),
+    }
+    ardata, ar = build_archive(tmp_path, compression, files)
+    index = parse_index(ar.index)
+
+    assert [e.name for e in index] == ['a', 'b', 'c', 'link']
+    link = index[-1]
+    assert link.type == tarfile.SYMTYPE
+    assert link.linkname == 'a'
+
+    compress = compression != 'none'
+    if compress:
+        blocks = parse_block_table(ar.block_table)
+        block_offsets = [b[0] for b in blocks]
+        tardata = decompress(ardata)
+    else:
+        tardata = ardata
+
+    for e in index[:-1]:
+        data = files[e.name]
+        assert e.type == tarfile.REGTYPE
+        assert e.size == len(data)
+        assert e.sha256 == hashlib.sha256(data).digest()
+        assert tardata[e.offset:e.offset+e.size] == data
+        if compress:
+            assert e.coffset in block_offsets
+        else:
+            assert e.coffset == e.offset
+
+
+def test_archive_content_hash(tmp_path):
+    def content_hash(compression, data):
+        path = tmp_path / 'file'
+        path.write_bytes(data)
+        with open(tmp_path / 'archive.tar', 'wb') as f, open(path, 'rb') as mf:
+            with SxArchive(f, mode='w', compression=compression) as ar:
+                ar.add_fileobj('a', mf)
+                ar.add_symlink('link', 'a')
+                return ar.content_hash().hexdigest()
+
+    data = os.urandom(5000)
+    assert content_hash('none', data) == content_hash('xz', data)
+    assert content_hash('xz', data) != content_hash('xz', data + b'x')
+
+
+@pytest.mark.parametrize('compression', ['none', 'xz', 'zstd', 'lz4'])
+def test_archive_read(tmp_path, compression):
+    files = {'a': os.urandom(5000), 'b': b'hello'}
+    ardata, _ = build_archive(tmp_path, compression, files)
+
+    with SxArchive(io.BytesIO(ardata), mode='r') as ar:
+        members = {}
+        for m in ar.tar:
+            if m.name != PAD_DIRNAME:
+                members[m.name] = ar.tar.extractfile(m).read() if m.isfile() else None
+    assert members == dict(files, link=None)
+
+
+def elf_data(machine, size):
+    """Returns data starting with the ELF header of a (64-bit, little-endian)
+    shared object for machine"""
+    header = (b'\x7fELF\x02\x01\x01' + bytes(9) + (3).to_bytes(2, 'little')
+              + machine.to_bytes(2, 'little'))
+    return header + os.urandom(size - len(header))
+
+
+def test_archive_bcj(tmp_path):
+    EM_AARCH64 = 183
+    files = {'lib.so': elf_data(EM_AARCH64, 50000), 'data': os.urandom(1000)}
+    ardata, ar = build_archive(tmp_path, 'xz', files)
+    # The end of the tar stream is a block of its own
+    assert ar.bcj_blocks == {'ARM64': 1, None: 1}
+
+    with SxArchive(io.BytesIO(ardata), mode='r') as ar:
+        for m in ar.tar:
+            if m.name == 'lib.so':
+                assert ar.tar.extractfile(m).read() == files['lib.so']
+
+
+@pytest.mark.parametrize('compression', ['none', 'xz'])
+def test_archive_dedup(tmp_path, compression):
+    data = os.urandom(5000)
+    for name in ('a', 'b'):
+        (tmp_path / name).write_bytes(data)
+    (tmp_path / 'c').write_bytes(data + b'x')
+
+    arpath = tmp_path / 'archive.tar'
+    with open(arpath, 'wb') as f:
+        with SxArchive(f, mode='w', compression=compression) as ar:
+            for name in ('a', 'b', 'c'):
+                ar.add_file(str(tmp_path / name))
+
+    # Identical contents are stored once
+    a, b, c = parse_index(ar.index)
+    assert a.type == c.type == tarfile.REGTYPE
+    assert b.type == tarfile.LNKTYPE
+    assert b.linkname == 'a'
+    assert b.size == 0
+
+    outdir = tmp_path / 'out'
+    with open(arpath, 'rb') as f:
+        with SxArchive(f, mode='r') as ar:
+            ar.tar.extractall(outdir)
+    assert (outdir / 'b').read_bytes() == data
+    assert (outdir / 'a').stat().st_ino == (outdir / 'b').stat().st_ino
@@ -0,0 +1,52 @@
+import logging
+import os
+
+from staticx.autotune import choose_compression, get_sample
+
+
+def test_get_sample(tmp_path):
+    small = tmp_path / 'small'
+    small.write_bytes(b'a' * 100)
+    large = tmp_path / 'large'
+    large.write_bytes(b'h' * 1000 + b'm' * 1000 + b't' * 1000)
+
+    # Largest first, from the middle of each file
+    sample = get_sample([str(small), str(large)], size=1100, chunk=1000)
+    assert sample == b'm' * 1000 + b'a' * 100
+
+    assert get_sample([str(tmp_path / 'missing')]) == b''
+
+
+def write_files(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / f'file{i}'
+        path.write_bytes(os.urandom(1000) * 100)
+        paths.append(str(path))
+    return paths
+
+
+def test_choose_compression(tmp_path):
+    compression, profile = choose_compression(write_files(tmp_path), ['xz'])
+    assert compression == 'xz'
+    assert profile in ('size', 'balanced', 'startup')
+
+
+def test_choose_compression_over_budget(tmp_path, caplog):
+    with caplog.at_level(logging.WARNING):
+        compression, _ = choose_compression(write_files(tmp_path), ['xz'], size_budget=1)
+    assert compression == 'xz'
+    assert "size budget" in caplog.text
+
+
+def test_choose_compression_target_threads(tmp_path, caplog, monkeypatch):
+    # The estimates assume the target's threads, not the build machine's
+    monkeypatch.setattr(os, 'cpu_count', lambda: 64)
+    with caplog.at_level(logging.INFO):
+        choose_compression(write_files(tmp_path), ['xz'])
+    assert "assuming 2 decoder threads" in caplog.text
+
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        choose_compression(write_files(tmp_path), ['xz'], target_threads=64)
+    assert "assuming 8 decoder threads" in caplog.text
@@ -0,0 +1,96 @@
+import os
+import random
+
+import pytest
+
+from staticx.bcjfilter import arm64_convert, get_bcj_filter_arch, riscv_convert
+
+
+@pytest.mark.parametrize('ident, arch', [
+    ((64, True, 'EM_X86_64'), 'X86'),
+    ((32, True, 'EM_386'), 'X86'),
+    ((64, True, 'EM_AARCH64'), 'ARM64'),
+    ((64, True, 'EM_RISCV'), 'RISCV'),
+    ((64, False, 'EM_PPC64'), 'POWERPC'),
+    ((64, True, 'EM_PPC64'), None),         # The filter is big-endian only
+    ((32, True, 'EM_ARM'), 'ARM'),
+    ((64, False, 'EM_S390'), None),
+    (None, None),                           # Not an ELF file
+])
+def test_get_bcj_filter_arch(ident, arch):
+    assert get_bcj_filter_arch(ident) == arch
+
+
+def arm64_code(n, seed=0):
+    r = random.Random(seed)
+    words = []
+    for _ in range(n // 4):
+        k = r.random()
+        if k < 0.2:
+            words.append((0x25 << 26) | r.getrandbits(26))                 # BL
+        elif k < 0.4:
+            words.append(0x90000000 | (r.getrandbits(2) << 29)
+                         | (r.getrandbits(14) << 5) | r.getrandbits(5))     # ADRP
+        else:
+            words.append(r.getrandbits(32))
+    return b''.join(w.to_bytes(4, 'little') for w in words)
+
+
+def riscv_code(n, seed=0):
+    r = random.Random(seed)
+    code = bytearray()
+    while len(code) < n:
+        k = r.random()
+        if k < 0.2:
+            # JAL x1
+            code += (0xEF | (r.getrandbits(20) << 12)).to_bytes(4, 'little')
+        elif k < 0.4:
+            # AUIPC x6 + JALR x1, x6
+            code += (0x17 | (6 << 7) | (r.getrandbits(20) << 12)).to_bytes(4, 'little')
+            code += (0x67 | (1 << 7) | (6 << 15) | (r.getrandbits(12) << 20)).to_bytes(4, 'little')
+        elif k < 0.5:
+            code += r.getrandbits(16).to_bytes(2, 'little')
+        else:
+            code += r.getrandbits(32).to_bytes(4, 'little')
+    return bytes(code[:n])
+
+
+@pytest.mark.parametrize('convert, code', [
+    (arm64_convert, arm64_code),
+    (riscv_convert, riscv_code),
+])
+@pytest.mark.parametrize('pos', [0, 0x12344])
+def test_convert_round_trip(convert, code, pos):
+    data = code(10002)
+    buf = bytearray(data)
+    convert(buf, pos)
+    assert buf != data
+    convert(buf, pos, encoding=False)
+    assert buf == data
+
+
+def test_convert_other_data():
+    # Data can't be made worse than by converting its "instructions"
+    data = os.urandom(10000)
+    for convert in (arm64_convert, riscv_convert):
+        buf = bytearray(data)
+        convert(buf)
+        convert(buf, encoding=False)
+        assert buf == data
+
+
+def test_arm64_bl():
+    # The relative target of BL becomes absolute (in instructions)
+    buf = bytearray(8) + (0x94000000 | 0x10).to_bytes(4, 'little')
+    arm64_convert(buf, 0x100)
+    assert int.from_bytes(buf[8:], 'little') == 0x94000000 | (0x10 + (0x108 >> 2))
+
+
+def test_riscv_jal():
+    # JAL x1, +0x800 at 0x1000 becomes a JAL to the absolute address 0x1800
+    # (in a different, big-endian, bit order)
+    jal = 0xEF | (1 << 20)      # imm[11] is bit 20
+    buf = bytearray(jal.to_bytes(4, 'little')) + bytes(8)
+    riscv_convert(buf, 0x1000)
+    assert buf[0] == 0xEF
+    assert ((buf[1] & 0xF0) << 13) | (buf[2] << 9) | (buf[3] << 1) == 0x1800
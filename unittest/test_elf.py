@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import pytest
 import os
+import subprocess
+import sys
 from tempfile import NamedTemporaryFile
+from elftools.elf.sections import SymbolTableSection
 from staticx import elf
 from staticx.errors import MissingToolError
 from staticx.utils import make_executable
@@ -127,3 +130,93 @@ def test_is_dynamic_elf_handles_non_elf():
 
 def test_is_dynamic_elf_handles_elf():
     assert elf.is_dynamic_elf("/bin/true")
+
+
+class TestELFEditor:
+    @pytest.fixture
+    def prog(self, tmp_path):
+        path = tmp_path / 'sh'
+        with open('/bin/sh', 'rb') as fsrc, open(path, 'wb') as fdst:
+            fdst.write(fsrc.read())
+        make_executable(path)
+        return str(path)
+
+    def _run(self, prog):
+        return subprocess.run([prog, '-c', 'exit 3']).returncode
+
+    def test_patch(self, prog):
+        interp = elf.get_prog_interp(prog)
+        libdir = os.path.dirname(elf.get_shobj_deps_ldd(prog)[0])
+
+        # Longer than the existing values, so they have to be moved
+        new_interp = '/' * 100 + interp.lstrip('/')
+        elf.patch_elf(prog, interpreter=new_interp, rpath=libdir + ':' + 'r' * 200,
+                      force_rpath=True, no_default_lib=True, add_needed='libm.so.6')
+
+        with elf.open_elf(prog) as e:
+            assert e.get_prog_interp() == new_interp
+            entries = e.get_dynamic_entries()
+            assert entries[0] == ('DT_NEEDED', 'libm.so.6')
+            assert e.get_rpath().rpath == libdir + ':' + 'r' * 200
+            assert e.get_runpath() is None
+            assert dict(entries)['DT_FLAGS_1'] & elf.DF_1_NODEFLIB
+            # The bootloader finds these by section
+            assert e.get_section_by_name('.interp')['sh_offset'] == \
+                e._find_segment('PT_INTERP')['p_offset']
+            assert e.get_section_by_name('.dynamic')['sh_offset'] == \
+                e._find_segment('PT_DYNAMIC')['p_offset']
+
+        assert self._run(prog) == 3
+
+    def test_remove_rpath(self, prog):
+        elf.patch_elf(prog, rpath='/nonexistent')
+        with elf.open_elf(prog) as e:
+            assert e.get_runpath().runpath == '/nonexistent'
+
+        elf.remove_rpath(prog)
+        with elf.open_elf(prog) as e:
+            assert e.get_rpath() is None
+            assert e.get_runpath() is None
+
+        assert self._run(prog) == 3
+
+    def test_strip(self, tmp_path):
+        prog = str(tmp_path / 'python')
+        editor = elf.ELFEditor(sys.executable)
+        editor.strip()
+        editor.save(prog)
+
+        with elf.open_elf(prog) as e:
+            for sec in e.iter_sections():
+                assert not sec.name.startswith('.debug')
+                assert not (isinstance(sec, SymbolTableSection) and sec.name == '.symtab')
+
+        assert os.access(prog, os.X_OK)
+        subprocess.run([prog, '-c', 'pass'], check=True)
+
+
+def test_section_appender(tmp_path):
+    output = tmp_path / 'sh'
+    with open(output, 'wb') as f:
+        appender = elf.ELFSectionAppender(f, '/bin/sh')
+        with appender.open_section('.test.big', align=4096) as sec:
+            for i in range(100):
+                sec.write(bytes([i]) * 1000)
+            assert sec.tell() == 100000
+        appender.add_section('.test.small', b'hello')
+        appender.close()
+    make_executable(output)
+
+    with elf.open_elf(output) as e:
+        offset, size = e.get_section_range('.test.big')
+        assert offset % 4096 == 0
+        assert size == 100000
+        assert e.get_section_data('.test.small') == b'hello'
+        # The existing sections are intact
+        assert e.get_section_by_name('.dynamic') is not None
+
+    dump = tmp_path / 'dump'
+    elf.elf_dump_section(output, '.test.small', dump)
+    assert dump.read_bytes() == b'hello'
+
+    assert subprocess.run([output, '-c', 'exit 3']).returncode == 3
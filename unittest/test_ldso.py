@@ -0,0 +1,107 @@
+import os
+import shutil
+import struct
+import sys
+
+import pytest
+
+from staticx.elf import get_abi_ident, get_shobj_deps_ldd, open_elf
+from staticx.ldso import Resolver, parse_ld_so_cache
+
+
+def make_ld_so_cache(entries, old_entries=0):
+    """Make an ld.so.cache of (name, path, hwcap) entries"""
+    strings = b''
+    offsets = []
+    base = 48 + 24 * len(entries)
+    for name, path, _ in entries:
+        key = base + len(strings)
+        strings += name.encode() + b'\0'
+        value = base + len(strings)
+        strings += path.encode() + b'\0'
+        offsets.append((key, value))
+
+    new = struct.pack('=20sIIB3xI12x', b'glibc-ld.so.cache1.1', len(entries),
+                      len(strings), 0, 0)
+    for (name, path, hwcap), (key, value) in zip(entries, offsets):
+        new += struct.pack('=iIIIQ', 0x303, key, value, 0, hwcap)
+    new += strings
+
+    if not old_entries:
+        return new
+    old = struct.pack('=11sxI', b'ld.so-1.7.0', old_entries) + bytes(12 * old_entries)
+    old += bytes(-len(old) % 8)
+    return old + new
+
+
+@pytest.mark.parametrize('old_entries', [0, 3])
+def test_parse_ld_so_cache(old_entries):
+    data = make_ld_so_cache([
+        ('libfoo.so.1', '/usr/lib/libfoo.so.1', 0),
+        ('libfoo.so.1', '/usr/lib/glibc-hwcaps/x86-64-v3/libfoo.so.1', 1 << 62),
+        ('libbar.so', '/lib/libbar.so', 0),
+    ], old_entries=old_entries)
+
+    assert parse_ld_so_cache(data) == [
+        ('libfoo.so.1', '/usr/lib/libfoo.so.1'),
+        ('libbar.so', '/lib/libbar.so'),
+    ]
+
+def test_parse_ld_so_cache_invalid():
+    with pytest.raises(ValueError):
+        parse_ld_so_cache(b'not a cache')
+
+
+def test_get_abi_ident(tmp_path):
+    with open_elf(sys.executable) as elf:
+        assert get_abi_ident(sys.executable) == elf.get_abi_ident()
+
+    path = tmp_path / 'notelf'
+    path.write_text('#!/bin/sh\n')
+    assert get_abi_ident(path) is None
+
+
+@pytest.mark.parametrize('prog', ['/bin/sh', sys.executable])
+def test_resolver_matches_ldd(prog):
+    deps = Resolver().get_deps(prog)
+    ldd_deps = get_shobj_deps_ldd(prog)
+    assert {os.path.basename(d) for d in deps} == {os.path.basename(d) for d in ldd_deps}
+
+
+def test_resolver_libpath(tmp_path):
+    prog = '/bin/sh'
+    lib = Resolver().get_deps(prog)[0]
+
+    # Libraries are found in the given libpath first
+    shutil.copy(lib, tmp_path)
+    deps = Resolver().get_deps(prog, libpath=[str(tmp_path)])
+    assert str(tmp_path / os.path.basename(lib)) in deps
+
+
+@pytest.mark.parametrize('ident, lib, platform', [
+    ((64, True, 'EM_X86_64'), 'lib64', 'x86_64'),
+    ((32, True, 'EM_386'), 'lib', 'i686'),
+    ((64, True, 'EM_AARCH64'), 'lib', 'aarch64'),
+])
+def test_resolver_expand(ident, lib, platform):
+    # The tokens are those of the file's ABI, whatever the host's
+    dirs = ['$ORIGIN/../$LIB', '/opt/${PLATFORM}/${LIB}', '/usr/local/lib']
+    assert list(Resolver._expand(dirs, '/app/bin', ident)) == [
+        f'/app/bin/../{lib}', f'/opt/{platform}/{lib}', '/usr/local/lib',
+    ]
+
+
+def test_resolver_expand_unknown_platform():
+    # Like ld.so, directories with a token which can't be expanded are skipped
+    dirs = ['/opt/$PLATFORM', '/opt/$LIB']
+    assert list(Resolver._expand(dirs, '/app', (64, True, 'EM_PPC64'))) == ['/opt/lib64']
+
+
+def test_resolver_default_dirs():
+    assert Resolver._default_dirs((32, True, 'EM_386'), musl=False) == [
+        '/lib/i386-linux-gnu', '/usr/lib/i386-linux-gnu', '/lib', '/usr/lib',
+    ]
+    dirs = Resolver._default_dirs((64, True, 'EM_X86_64'), musl=False)
+    assert dirs.index('/lib64') < dirs.index('/lib')
+    dirs = Resolver._default_dirs((64, True, 'EM_AARCH64'), musl=False)
+    assert dirs.index('/lib') < dirs.index('/lib64')
@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import pytest
+
+from staticx.libcache import LibraryCache, env_cache_dir, parse_size
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return LibraryCache(str(tmp_path / 'cache'))
+
+def make_file(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_get_key(cache, tmp_path):
+    a = make_file(tmp_path / 'a', b'aaa')
+    b = make_file(tmp_path / 'b', b'bbb')
+    a2 = make_file(tmp_path / 'a2', b'aaa')
+
+    # Keyed by content and options, not path
+    assert cache.get_key(a, strip=False) == cache.get_key(a2, strip=False)
+    assert cache.get_key(a, strip=False) != cache.get_key(b, strip=False)
+    assert cache.get_key(a, strip=False) != cache.get_key(a, strip=True)
+
+
+def test_unchanged(cache, tmp_path):
+    lib = make_file(tmp_path / 'lib', b'library')
+    key = cache.get_key(lib)
+    dest = str(tmp_path / 'dest')
+
+    assert cache.get(key, lib, dest) is None
+    cache.put(key, lib, lib)
+    assert cache.get(key, lib, dest) == lib
+    assert not os.path.exists(dest)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_counts_threads(cache, tmp_path):
+    lib = make_file(tmp_path / 'lib', b'library')
+    key = cache.get_key(lib)
+    cache.put(key, lib, lib)
+    dest = str(tmp_path / 'dest')
+
+    def lookup(_):
+        cache.get(key, lib, dest)
+        cache.get('missing', lib, dest)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lookup, range(400)))
+    assert (cache.hits, cache.misses) == (400, 400)
+
+
+def test_modified(cache, tmp_path):
+    lib = make_file(tmp_path / 'lib', b'library')
+    prepared = make_file(tmp_path / 'prepared', b'prepared library')
+    key = cache.get_key(lib)
+    dest = str(tmp_path / 'dest')
+
+    cache.put(key, lib, prepared)
+    assert cache.get(key, lib, dest) == dest
+    with open(dest, 'rb') as f:
+        assert f.read() == b'prepared library'
+
+
+def test_evict(cache, tmp_path):
+    cache.max_size = 250
+    keys = []
+    for i in range(3):
+        lib = make_file(tmp_path / f'lib{i}', b'%d' % i)
+        prepared = make_file(tmp_path / f'prepared{i}', bytes(100))
+        keys.append(cache.get_key(lib))
+        cache.put(keys[-1], lib, prepared)
+        os.utime(os.path.join(cache.path, keys[-1]), (i, i))
+
+    # Using an entry makes it the most recently used
+    assert cache.get(keys[0], str(tmp_path / 'lib0'), str(tmp_path / 'dest'))
+
+    cache.evict()
+    assert sorted(os.listdir(cache.path)) == sorted([keys[0], keys[2]])
+
+
+@pytest.mark.parametrize('value, size', [
+    ('0', 0),
+    ('123', 123),
+    ('4K', 4096),
+    ('1g', 1 << 30),
+    ('2T', 2 << 40),
+])
+def test_parse_size(value, size):
+    assert parse_size(value) == size
+
+@pytest.mark.parametrize('value', ['', 'K', '1.5G', '-1', '1X'])
+def test_parse_size_invalid(value):
+    with pytest.raises(ValueError):
+        parse_size(value)
+
+
+def test_env_cache_dir(monkeypatch):
+    monkeypatch.delenv('STATICX_BUILD_CACHE', raising=False)
+    monkeypatch.delenv('STATICX_BUILD_CACHE_DIR', raising=False)
+    monkeypatch.setenv('XDG_CACHE_HOME', '/xdg')
+    assert env_cache_dir() is None
+
+    monkeypatch.setenv('STATICX_BUILD_CACHE', '1')
+    assert env_cache_dir() == '/xdg/staticx-build'
+
+    monkeypatch.setenv('STATICX_BUILD_CACHE_DIR', '/cache')
+    assert env_cache_dir() == '/cache'
@@ -0,0 +1,72 @@
+import pytest
+
+from staticx.api import BATCH_OPTIONS
+from staticx.errors import InvalidInputError
+from staticx.manifest import _OPTION_TYPES, load_manifest, parse_manifest
+
+
+MANIFEST = '''
+strip = true
+compression = "zstd"
+
+[[program]]
+prog = "bin/foo"
+output = "/dist/foo"
+
+[[program]]
+prog = "bin/bar"
+output = "dist/bar"
+libs = ["lib/libplugin.so"]
+compression-profile = "size"
+size_budget = "2M"
+strip = false
+'''
+
+def test_parse_manifest():
+    builds = parse_manifest(MANIFEST, basedir='/build')
+    assert builds == [
+        dict(prog='/build/bin/foo', output='/dist/foo', strip=True, compression='zstd'),
+        dict(prog='/build/bin/bar', output='/build/dist/bar', strip=False,
+             compression='zstd', libs=['/build/lib/libplugin.so'],
+             compression_profile='size', size_budget=2 << 20),
+    ]
+
+
+def test_parse_manifest_defaults():
+    builds = parse_manifest(MANIFEST, basedir='/build',
+                            defaults=dict(compression='xz', debug=True))
+    # The manifest overrides the defaults
+    assert [b['compression'] for b in builds] == ['zstd', 'zstd']
+    assert [b['debug'] for b in builds] == [True, True]
+
+
+def test_load_manifest(tmp_path):
+    path = tmp_path / 'manifest.toml'
+    path.write_text(MANIFEST)
+    builds = load_manifest(str(path))
+    assert builds[0]['prog'] == str(tmp_path / 'bin' / 'foo')
+
+
+def test_load_manifest_missing(tmp_path):
+    with pytest.raises(InvalidInputError):
+        load_manifest(str(tmp_path / 'missing.toml'))
+
+
+@pytest.mark.parametrize('data', [
+    'not = [valid',
+    'strip = true',
+    '[[program]]\nprog = "a"',
+    'prog = "a"\n[[program]]\noutput = "b"',
+    'base = "a"\n[[program]]\nprog = "a"\noutput = "b"',
+    '[[program]]\nprog = "a"\noutput = "b"\nunknown = 1',
+    '[[program]]\nprog = "a"\noutput = "b"\nstrip = "yes"',
+    '[[program]]\nprog = "a"\noutput = "b"\nlibs = [1]',
+    '[[program]]\nprog = "a"\noutput = "b"\nsize-budget = "lots"',
+])
+def test_parse_manifest_invalid(data):
+    with pytest.raises(InvalidInputError):
+        parse_manifest(data)
+
+
+def test_option_types():
+    assert set(_OPTION_TYPES) == {'prog', 'output', *BATCH_OPTIONS}
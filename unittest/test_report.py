@@ -0,0 +1,82 @@
+import json
+import tarfile
+import threading
+
+import pytest
+
+from staticx.archive import IndexEntry
+from staticx.report import (Timings, attribute_compressed_sizes, get_archive_report,
+                            get_members_report, write_report)
+
+
+def entry(name, offset, size, type=tarfile.REGTYPE):
+    return IndexEntry(name, type, 0o755, size, offset, None, bytes(32), '')
+
+
+def test_timings_nested():
+    timings = Timings()
+    with timings.measure('outer') as outer:
+        with timings.measure('inner') as inner:
+            sum(range(100000))
+
+    # Time in the inner phase only counts for it
+    assert timings.phases['inner']['wall'] == inner['wall'] > 0
+    assert timings.phases['outer']['wall'] == outer['wall'] >= 0
+    assert outer['wall'] < inner['wall'] + 0.1
+
+
+def test_timings_other_thread():
+    timings = Timings()
+    results = []
+
+    def work():
+        with timings.measure('work') as times:
+            sum(range(100000))
+        results.append(times)
+
+    t = threading.Thread(target=work)
+    t.start()
+    t.join()
+
+    # Only CPU time counts for the phase; the measurement has both
+    assert timings.phases['work']['wall'] == 0
+    assert timings.phases['work']['cpu'] > 0
+    assert results[0]['wall'] > 0
+    assert set(timings.get_report()) == {'work'}
+
+
+def test_attribute_compressed_sizes():
+    entries = [
+        entry('a', 512, 1000),
+        entry('link', 1512, 0, type=tarfile.SYMTYPE),
+        entry('b', 2048, 3000),
+    ]
+    # Blocks of 2000 uncompressed bytes
+    blocks = [(0, 1000, 2000), (1000, 500, 2000), (1500, 100, 1000)]
+    assert attribute_compressed_sizes(entries, blocks) == [
+        500,                    # Half of the first block
+        0,
+        488 + 100,              # 1952 bytes of the second, and all the third
+    ]
+
+
+def test_attribute_compressed_sizes_uncompressed():
+    entries = [entry('a', 512, 1000), entry('b', 2048, 3000)]
+    assert attribute_compressed_sizes(entries, None) == [1000, 3000]
+
+
+def test_members_report():
+    members = get_members_report([entry('a', 0, 2000)], [(0, 500, 2000)])
+    assert members == [dict(name='a', type='file', size=2000, compressed_size=500,
+                            compression_ratio=4.0)]
+
+
+def test_archive_report():
+    assert get_archive_report(250, 1000)['compression_ratio'] == 4.0
+    assert get_archive_report(0, 0)['compression_ratio'] is None
+
+
+def test_write_report(tmp_path):
+    path = tmp_path / 'report.json'
+    write_report(dict(a=1), str(path))
+    assert json.loads(path.read_text()) == dict(a=1)
@@ -0,0 +1,90 @@
+import io
+import lzma
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from staticx import xzstream
+
+from test_bcjfilter import arm64_code, riscv_code
+
+
+def lzma2(dict_size=1 << 20):
+    return dict(id=lzma.FILTER_LZMA2, preset=6, dict_size=dict_size)
+
+
+@pytest.mark.parametrize('arch, code', [
+    (None, arm64_code),
+    ('X86', arm64_code),
+    ('ARM64', arm64_code),
+    ('RISCV', riscv_code),
+])
+def test_round_trip(arch, code):
+    data = code(100000)
+    filters = ([dict(arch=arch)] if arch else []) + [lzma2()]
+    cdata = xzstream.compress(data, filters)
+    assert cdata.startswith(xzstream.STREAM_HEADER_MAGIC)
+
+    # Concatenated streams
+    assert xzstream.decompress(cdata * 2) == data * 2
+    assert xzstream.open(io.BytesIO(cdata * 2)).read() == data * 2
+
+
+@pytest.mark.parametrize('arch, code', [
+    ('ARM64', arm64_code),
+    ('RISCV', riscv_code),
+])
+def test_native_filter(monkeypatch, arch, code):
+    if not xzstream._has_native_filter(arch):
+        pytest.skip(f"The lzma module doesn't have the {arch} filter")
+    data = code(100000)
+
+    # liblzma gives the same stream as the Python converter, and each decodes
+    # that of the other
+    cdata = xzstream.compress(data, [dict(arch=arch), lzma2()])
+    monkeypatch.setattr(xzstream, '_has_native_filter', lambda arch: False)
+    assert xzstream.compress(data, [dict(arch=arch), lzma2()]) == cdata
+    assert xzstream.decompress(cdata) == data
+
+
+def test_bcj_compresses_better():
+    # Calls to a few functions, whose relative targets all differ
+    funcs = [0x10000 + 0x400 * i for i in range(16)]
+    data = b''.join((0x94000000 | ((funcs[i % 16] - 4 * i) >> 2 & 0x03FFFFFF)).to_bytes(4, 'little')
+                    for i in range(25000))
+    plain = xzstream.compress(data, [lzma2()])
+    filtered = xzstream.compress(data, [dict(arch='ARM64'), lzma2()])
+    assert len(filtered) < len(plain)
+
+
+def test_corrupt():
+    cdata = bytearray(xzstream.compress(riscv_code(10000), [dict(arch='RISCV'), lzma2()]))
+    cdata[-20] ^= 1
+    with pytest.raises(lzma.LZMAError):
+        xzstream.decompress(bytes(cdata))
+    with pytest.raises(lzma.LZMAError):
+        xzstream.decompress(bytes(cdata[:-30]))
+
+
+def xz_supports(flag):
+    xz = shutil.which('xz')
+    return xz and subprocess.run([xz, '-c', flag, '--lzma2'], input=b'',
+                                 capture_output=True).returncode == 0
+
+
+@pytest.mark.parametrize('arch, flag, code', [
+    ('ARM64', '--arm64', arm64_code),
+    ('RISCV', '--riscv', riscv_code),
+])
+def test_xz_interop(arch, flag, code):
+    if not xz_supports(flag):
+        pytest.skip(f"xz doesn't support {flag}")
+    data = code(100000) + os.urandom(1000)
+
+    # xz decodes our stream, and we decode that of xz
+    cdata = xzstream.compress(data, [dict(arch=arch), lzma2()])
+    assert subprocess.check_output(['xz', '-dc'], input=cdata) == data
+    cdata = subprocess.check_output(['xz', '-c', '--check=crc32', flag, '--lzma2'], input=data)
+    assert xzstream.decompress(cdata) == data